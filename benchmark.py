@@ -0,0 +1,431 @@
+"""
+Benchmark suite for the n-gram analysis.
+
+Generates seeded synthetic search terms or ad copy (with DKI tokens,
+numbers, punctuation and emoji), runs each stage of the analysis on them
+separately and records its wall time and peak memory, so the results of
+two runs (e.g. before and after a change) can be compared.
+
+Example:
+    $ python benchmark.py --rows 10000 100000 --output after.json
+    $ python benchmark.py --rows 10000 100000 --compare before.json
+"""
+
+import numpy as np
+import pandas as pd
+import argparse
+import contextlib
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import ngram_analysis
+
+
+##################
+# SYNTHETIC DATA #
+##################
+
+
+WORDS = (
+    "buy cheap best running shoes for men women kids online shop sale near me free "
+    "shipping new black white red blue size cotton leather jacket dress boots hat "
+    "bag watch phone case charger laptop deal discount code coupon order today now "
+    "official store brand outlet review price vs and with the a of in to how what "
+    "where is are top rated cheapest premium quality delivery return gift ideas "
+    "winter summer spring autumn 2019 2020 uk us london paris berlin"
+).split()
+
+SPECIAL_TOKENS = [
+    "{KeyWord:Running Shoes}",
+    "{KeyWord:Best Deals}",
+    "{LOCATION(City)}",
+    "{COUNTDOWN(2019/12/24 00:00:00)}",
+    "50%",
+    "24/7",
+    "1 000",
+    "10 000",
+    "$99",
+    "2x",
+    "now!",
+    "today.",
+    "(new)",
+    "free?",
+    "shoes,",
+    "🔥",
+    "✅",
+    "😍",
+    "🎁",
+]
+
+TEXT_KINDS = ("search_terms", "ad_copy")
+
+# (shortest, longest) number of tokens of a text.
+TEXT_LENGTHS = {"search_terms": (1, 6), "ad_copy": (6, 16)}
+
+
+def make_token_pool(vocabulary_size):
+    """Helper function which returns the token pool of the generator -
+    the common words, the special tokens and a long tail of product and
+    model names, up to `vocabulary_size` tokens.
+    """
+    tokens = WORDS + SPECIAL_TOKENS
+    tail_size = max(vocabulary_size - len(tokens), 0)
+
+    return np.array(tokens + [f"model{i}" for i in range(tail_size)], dtype=object)
+
+
+def generate_texts(rng, rows, kind="search_terms", vocabulary_size=5000):
+    """Helper function which generates `rows` texts of the given kind.
+
+    Tokens are drawn from a Zipf-like distribution, so a few words are
+    in most of the texts while the long tail appears rarely - like in
+    real search terms. Search terms are short and repeat a lot, ad copy
+    is longer and mostly unique.
+    """
+    tokens = make_token_pool(vocabulary_size)
+    weights = 1 / np.arange(1, len(tokens) + 1)
+    weights = weights / weights.sum()
+
+    # Search terms repeat across campaigns and dates, so they are drawn
+    # from a smaller pool of unique texts.
+    unique_rows = max(rows // 4, 1) if kind == "search_terms" else rows
+
+    shortest, longest = TEXT_LENGTHS[kind]
+    lengths = rng.integers(shortest, longest + 1, size=unique_rows)
+    drawn_tokens = rng.choice(tokens, size=lengths.sum(), p=weights)
+    text_tokens = np.split(drawn_tokens, lengths.cumsum()[:-1])
+    unique_texts = np.array([" ".join(tokens) for tokens in text_tokens], dtype=object)
+
+    # Capitalize some of the texts, as the cleaning should lowercase them.
+    capitalized = rng.random(unique_rows) < 0.3
+    unique_texts[capitalized] = [text.title() for text in unique_texts[capitalized]]
+
+    if unique_rows == rows:
+        return unique_texts
+
+    return unique_texts[rng.integers(0, unique_rows, size=rows)]
+
+
+def generate_input_data(
+    rows, kind="search_terms", metrics=3, vocabulary_size=5000, seed=0
+):
+    """Generates a seeded synthetic raw input DataFrame, in the format
+    `execute_ngram_analysis` expects - the text first, followed by the
+    performance columns.
+
+    Args:
+        - rows (int): The number of rows.
+        - kind (str, optional): One of `TEXT_KINDS`.
+            Defaults to "search_terms".
+        - metrics (int, optional): The number of numeric performance
+            columns. Alternates between integer counts (like clicks)
+            and floats (like cost). Defaults to 3.
+        - vocabulary_size (int, optional): The number of distinct tokens
+            the texts are made of. Defaults to 5000.
+        - seed (int, optional): The seed of the generator, the same
+            arguments always return the same DataFrame. Defaults to 0.
+
+    Returns:
+        - DataFrame: The "text" column, `metrics` numeric columns and
+            the "ad_id" text column.
+
+    Raises:
+        - ValueError: When `kind` isn't one of `TEXT_KINDS`.
+    """
+    if kind not in TEXT_KINDS:
+        raise ValueError(f"Unknown text kind {kind!r}, expected one of {TEXT_KINDS}.")
+
+    rng = np.random.default_rng(seed)
+    input_data_df = pd.DataFrame(
+        {"text": generate_texts(rng, rows, kind, vocabulary_size)}
+    )
+
+    for i in range(1, metrics + 1):
+        if i % 2:
+            input_data_df[f"metric_{i}"] = rng.poisson(20, size=rows)
+        else:
+            input_data_df[f"metric_{i}"] = rng.gamma(2.0, 1.5, size=rows).round(2)
+
+    input_data_df["ad_id"] = pd.Series(rng.integers(0, 1000, size=rows)).map(
+        "ad_{}".format
+    )
+
+    return input_data_df
+
+
+##############
+# BENCHMARKS #
+##############
+
+
+def measure(function, *args, trace_memory=True, **kwargs):
+    """Helper function which calls `function` and measures it.
+
+    Returns:
+        - tuple: The function's return value, the wall time in seconds
+            and the peak memory allocated during the call in bytes (None
+            if `trace_memory` isn't set).
+    """
+    if trace_memory:
+        tracemalloc.start()
+
+    started = time.perf_counter()
+    # The analysis reports its progress with prints.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = function(*args, **kwargs)
+    seconds = time.perf_counter() - started
+
+    peak_memory = None
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return result, seconds, peak_memory
+
+
+def run_stages(input_data_df, engine="vectorized", trace_memory=True):
+    """Runs the stages of the analysis one after another on a copy of
+    `input_data_df`.
+
+    Returns:
+        - list: A dict per stage with its "stage" name, "seconds",
+            "peak_memory_bytes", "rows_in" and "rows_out".
+    """
+    vocabulary = ngram_analysis.NgramVocabulary()
+    stages = [
+        ("clean_input_data", ngram_analysis.clean_input_data, {}),
+        ("create_ngrams", ngram_analysis.create_ngrams, {"vocabulary": vocabulary}),
+        (
+            "calculate_ngram_performance",
+            ngram_analysis.calculate_ngram_performance,
+            {"engine": engine, "vocabulary": vocabulary},
+        ),
+    ]
+
+    results = []
+    stage_input = input_data_df.copy()
+    for stage, function, kwargs in stages:
+        stage_output, seconds, peak_memory = measure(
+            function, stage_input, trace_memory=trace_memory, **kwargs
+        )
+        if isinstance(stage_output, dict):
+            rows_out = sum(
+                len(df)
+                for ngram, df in stage_output.items()
+                if ngram != "Original Processed Data"
+            )
+        else:
+            rows_out = len(stage_output)
+
+        results.append(
+            {
+                "stage": stage,
+                "seconds": seconds,
+                "peak_memory_bytes": peak_memory,
+                "rows_in": len(stage_input),
+                "rows_out": rows_out,
+            }
+        )
+        stage_input = stage_output
+
+    return results
+
+
+def run_benchmark(
+    rows_list,
+    kind="search_terms",
+    metrics=3,
+    vocabulary_size=5000,
+    seed=0,
+    repeat=3,
+    engine="vectorized",
+):
+    """Benchmarks the stages of the analysis on synthetic data of each
+    size in `rows_list`.
+
+    Every size is run `repeat` times for the timings, then once more
+    with `tracemalloc` for the peak memory, since tracing the
+    allocations slows the stages down.
+
+    Returns:
+        - dict: The "settings" and the "environment" of the run, and the
+            "results" - a dict per size and stage with the best and all
+            of the timings in seconds, the peak memory in bytes and the
+            rows in and out of the stage.
+    """
+    results = []
+    for rows in rows_list:
+        input_data_df = generate_input_data(
+            rows, kind=kind, metrics=metrics, vocabulary_size=vocabulary_size, seed=seed
+        )
+
+        timings = [
+            run_stages(input_data_df, engine=engine, trace_memory=False)
+            for _ in range(repeat)
+        ]
+        memory = run_stages(input_data_df, engine=engine, trace_memory=True)
+
+        for stage_number, stage_memory in enumerate(memory):
+            seconds = [run[stage_number]["seconds"] for run in timings]
+            results.append(
+                {
+                    "rows": rows,
+                    "stage": stage_memory["stage"],
+                    "best_seconds": min(seconds) if seconds else None,
+                    "seconds": seconds,
+                    "peak_memory_bytes": stage_memory["peak_memory_bytes"],
+                    "rows_in": stage_memory["rows_in"],
+                    "rows_out": stage_memory["rows_out"],
+                }
+            )
+            print(
+                f"{rows} rows, {stage_memory['stage']}: "
+                f"{min(seconds) if seconds else float('nan'):.3f}s, "
+                f"{stage_memory['peak_memory_bytes'] / 2 ** 20:.1f} MiB"
+            )
+
+    return {
+        "settings": {
+            "kind": kind,
+            "metrics": metrics,
+            "vocabulary_size": vocabulary_size,
+            "seed": seed,
+            "repeat": repeat,
+            "engine": engine,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def compare_benchmarks(baseline, benchmark):
+    """Prints the best time and peak memory of every size and stage in
+    `benchmark` relative to the `baseline` (both as returned by
+    `run_benchmark`).
+    """
+    baseline_results = {
+        (result["rows"], result["stage"]): result for result in baseline["results"]
+    }
+    for result in benchmark["results"]:
+        baseline_result = baseline_results.get((result["rows"], result["stage"]))
+        if baseline_result is None or not baseline_result["best_seconds"]:
+            continue
+
+        time_ratio = result["best_seconds"] / baseline_result["best_seconds"]
+        memory_ratio = (
+            result["peak_memory_bytes"] / baseline_result["peak_memory_bytes"]
+        )
+        print(
+            f"{result['rows']} rows, {result['stage']}: "
+            f"{time_ratio:.2f}x time, {memory_ratio:.2f}x memory"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+    Benchmarks each stage of the n-gram analysis on seeded synthetic
+    data, and saves the timings and peak memory as JSON.
+    """
+    )
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10000, 100000],
+        help="""
+        The numbers of rows to benchmark, e.g. 10000 100000 1000000.
+        """,
+    )
+
+    parser.add_argument(
+        "--kind",
+        choices=TEXT_KINDS,
+        default="search_terms",
+        help="""
+        Short and repeating search terms, or longer ad copy.
+        """,
+    )
+
+    parser.add_argument(
+        "--metrics",
+        type=int,
+        default=3,
+        help="""
+        The number of numeric performance columns.
+        """,
+    )
+
+    parser.add_argument(
+        "--vocabulary-size",
+        type=int,
+        default=5000,
+        help="""
+        The number of distinct tokens the texts are made of.
+        """,
+    )
+
+    parser.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="""
+        How many times each size is timed, the best time is reported.
+        """,
+    )
+
+    parser.add_argument(
+        "--engine",
+        choices=ngram_analysis.AGGREGATION_ENGINES,
+        default="vectorized",
+    )
+
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="""
+        Relative path to the JSON file the results are saved to.
+        """,
+    )
+
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="""
+        Relative path to the JSON results of an earlier run to compare with.
+        """,
+    )
+
+    args = parser.parse_args()
+
+    benchmark = run_benchmark(
+        args.rows,
+        kind=args.kind,
+        metrics=args.metrics,
+        vocabulary_size=args.vocabulary_size,
+        seed=args.seed,
+        repeat=args.repeat,
+        engine=args.engine,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(benchmark, f, indent=2)
+        print(f"Saved to {args.output} successfully.")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_benchmarks(json.load(f), benchmark)
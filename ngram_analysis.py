@@ -2,28 +2,251 @@
 Script for performing a range n-gram split on passed data.
 
 TODO:
-* Support multi-processing < for the n-gram performance calculations
-    wait for swifter module update.
-    For now making it multi-processing friendly may actually slow it
-    down due to calling overheads. Pandas' apply is sufficient.
 * Support automatic downloading of data from Facebook and Google Ads.
 
 * Known issues - https://github.com/explosion/spaCy/issues/3665
 """
 
+import numpy as np
+import openpyxl
 import pandas as pd
-import nltk
 import spacy
 import argparse
 import re
 import os
+import json
+import sys
+import threading
+import time
+import warnings
+import cProfile
+import pstats
 
 from spacy.tokenizer import Tokenizer
 
-from multiprocessing import Pool
-from itertools import product
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Pool, shared_memory
+from array import array
+from itertools import chain, islice, repeat
 
-pd.options.mode.chained_assignment = None
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak RSS isn't reported there.
+    resource = None
+
+try:
+    import pyarrow
+except ImportError:
+    # Text columns are then read as Python objects.
+    pyarrow = None
+
+
+###################
+# INSTRUMENTATION #
+###################
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size of the process to the current
+    one, so `peak_rss_bytes` then returns the peak since the reset.
+
+    Returns:
+        - bool: Whether it could be reset, which only Linux allows.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+
+    return True
+
+
+def peak_rss_bytes():
+    """Returns the peak resident set size of the process in bytes since
+    it started or since the last `reset_peak_rss`, or None where it
+    can't be measured.
+    """
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes on Linux.
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class AnalysisStats:
+    """Collects the wall time, rows in and out, unique n-grams and peak
+    RSS of each stage of an analysis (see `measure_stage`).
+
+    The peak RSS of a stage is only its own where the peak can be reset
+    (see `reset_peak_rss`), elsewhere it's None and only the peak of the
+    whole process is reported. Since the RSS is shared by the process,
+    the stages of analyses run in several threads at once overlap.
+
+    Examples:
+        >>> from ngram_analysis import AnalysisStats
+        >>> stats = AnalysisStats()
+        >>> execute_ngram_analysis("ads.csv", stats=stats)
+        >>> stats.stages[0]
+        {"stage": "read", "rows_in": None, "rows_out": 1000, ...}
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    def to_dict(self):
+        peak_rss = [
+            stage["peak_rss_bytes"]
+            for stage in self.stages
+            if stage["peak_rss_bytes"] is not None
+        ]
+        return {
+            "seconds": sum(stage["seconds"] for stage in self.stages),
+            "peak_rss_bytes": max(peak_rss) if peak_rss else peak_rss_bytes(),
+            "stages": self.stages,
+        }
+
+    def save(self, path, **metadata):
+        """Appends the stats with the `metadata` as one line of JSON to
+        the file at `path`, so every analysis of a folder can log into
+        the same file.
+        """
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({**metadata, **self.to_dict()}) + "\n")
+
+
+@contextmanager
+def measure_stage(stats, stage, rows_in=None):
+    """Context manager which measures the wall time and the peak RSS of
+    the stage run inside of it and adds it to the `stats`
+    (AnalysisStats), if any.
+
+    Yields the stage's record, so the "rows_out" and "unique_ngrams"
+    can be filled in once they're known.
+
+    Examples:
+        >>> with measure_stage(stats, "clean", rows_in=len(df)) as record:
+        ...     df = clean_input_data(df)
+        ...     record["rows_out"] = len(df)
+    """
+    record = {
+        "stage": stage,
+        "seconds": None,
+        "rows_in": rows_in,
+        "rows_out": None,
+        "unique_ngrams": None,
+        "peak_rss_bytes": None,
+    }
+    peak_rss_reset = stats is not None and reset_peak_rss()
+    start_time = time.perf_counter()
+    yield record
+    record["seconds"] = time.perf_counter() - start_time
+
+    if stats is not None:
+        if peak_rss_reset:
+            record["peak_rss_bytes"] = peak_rss_bytes()
+        stats.stages.append(record)
+
+
+###########################
+# READING THE INPUT DATA #
+###########################
+
+
+# Text columns with at most this share of unique values in the sample
+# (like ad IDs or campaign names) are read as categoricals.
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+
+def infer_csv_schema(input_file, sample_rows=10000, usecols=None):
+    """Infers the dtypes of the text columns of the csv from its first
+    `sample_rows` rows.
+
+    The first column is the text that will be analyzed and stays an
+    object column (a non-text one is left to `clean_input_data` to
+    reject). ID-like text columns are read as categoricals, the
+    other text columns as Arrow-backed strings when `pyarrow` is
+    installed. Numeric columns are left out, since a narrower dtype
+    picked from a sample would silently overflow on larger values
+    further down the file, see `downcast_numeric_columns` instead.
+
+    Returns:
+        - dict: The column name and dtype, for `pd.read_csv(dtype=...)`.
+    """
+    sample_df = pd.read_csv(input_file, nrows=sample_rows, usecols=usecols)
+
+    dtypes = {}
+    for column in sample_df.columns:
+        if sample_df[column].dtype != "O":
+            continue
+        if column == sample_df.columns[0]:
+            dtypes[column] = object
+            continue
+        if sample_df[column].nunique() <= CATEGORY_MAX_UNIQUE_RATIO * len(sample_df):
+            dtypes[column] = "category"
+        elif pyarrow is not None:
+            dtypes[column] = "string[pyarrow]"
+
+    return dtypes
+
+
+def downcast_numeric_columns(input_data_df):
+    """Downcasts the numeric performance columns of `input_data_df` in
+    place. Integers get the smallest integer dtype which holds all of
+    their values, floats become float32 only if no value changes.
+
+    The aggregations sum them in 64 bits (see `upcast_for_sum`), so the
+    results are the same as without downcasting.
+    """
+    for column in input_data_df.columns[1:]:
+        series = input_data_df[column]
+        if pd.api.types.is_integer_dtype(series.dtype):
+            input_data_df[column] = pd.to_numeric(series, downcast="integer")
+        elif pd.api.types.is_float_dtype(series.dtype) and series.dtype != np.float32:
+            downcast_series = series.astype(np.float32)
+            if downcast_series.astype(series.dtype).equals(series):
+                input_data_df[column] = downcast_series
+
+    return input_data_df
+
+
+def read_input_data(
+    input_file, compact_dtypes=True, usecols=None, chunksize=None, sample_rows=10000
+):
+    """Reads the raw input csv.
+
+    Args:
+        - input_file (str): The relative path to the csv.
+        - compact_dtypes (bool, optional): If set, the text columns are
+            read with the dtypes of `infer_csv_schema` and the numeric
+            columns are downcast with `downcast_numeric_columns`.
+            Defaults to True.
+        - usecols (list, optional): The only columns to read. They keep
+            their order in the file, so the first one of them in the
+            file is the text that will be analyzed. Defaults to None.
+        - chunksize (int, optional): If set, an iterator of DataFrames
+            of this many rows is returned. Defaults to None.
+        - sample_rows (int, optional): The number of rows the schema is
+            inferred from. Defaults to 10000.
+
+    Returns:
+        - DataFrame or iterator: The raw input data, or its chunks.
+    """
+    if not compact_dtypes:
+        return pd.read_csv(input_file, usecols=usecols, chunksize=chunksize)
+
+    dtypes = infer_csv_schema(input_file, sample_rows=sample_rows, usecols=usecols)
+    input_data = pd.read_csv(
+        input_file, usecols=usecols, dtype=dtypes, chunksize=chunksize
+    )
+    if chunksize:
+        return (downcast_numeric_columns(chunk) for chunk in input_data)
+
+    return downcast_numeric_columns(input_data)
 
 
 ##############################
@@ -31,20 +254,346 @@ pd.options.mode.chained_assignment = None
 ##############################
 
 
-def lemmatize_series(input_series, nlp):
-    """Helper function for using apply on data to get the lemma.
+LEMMATIZER_DISABLED_PIPES = ["parser", "ner"]
+
+
+def load_lemmatizer_model(model_name="en"):
+    """Helper function which loads the spaCy model used for
+    lemmatization. Only `lemma_` is used, so the parser and the named
+    entity recognizer are disabled.
+    """
+    nlp = spacy.load(model_name, disable=LEMMATIZER_DISABLED_PIPES)
+    # We don't want to seperate anything that wasn't specified
+    # in stop_characters
+    supress_re = re.compile(r"""[\.]""")
+    nlp.tokenizer = Tokenizer(
+        nlp.vocab,
+        infix_finditer=supress_re.finditer,
+        suffix_search=supress_re.search,
+        prefix_search=supress_re.search,
+    )
+
+    # Weird bug present in current v2.1.4 of Spacy fix
+    nlp.tokenizer.add_special_case(
+        "who's", [{spacy.attrs.ORTH: "who's", spacy.attrs.LEMMA: "who's"}]
+    )
+
+    return nlp
+
+
+def lemmatize_texts(nlp, texts, batch_size=1000):
+    """Helper function which streams the texts through `nlp.pipe` and
+    returns the list of lemmatized texts.
+    """
+    return [
+        " ".join([word.lemma_ for word in doc])
+        for doc in nlp.pipe(texts, batch_size=batch_size)
+    ]
+
+
+# spaCy model and batch size of a Lemmatizer's worker process, set once
+# by `init_lemmatizer_worker`.
+_worker_nlp = None
+_worker_batch_size = None
+
+
+def init_lemmatizer_worker(model_name, batch_size):
+    """Pool initializer which loads the spaCy model once per worker."""
+    global _worker_nlp, _worker_batch_size
+    _worker_nlp = load_lemmatizer_model(model_name)
+    _worker_batch_size = batch_size
+
+
+def lemmatize_in_worker(texts):
+    """Helper function for lemmatizing a batch of texts inside of a
+    Lemmatizer's worker.
 
     Need it at top level due to how the multiprocessing module
     handles such things.
     """
-    output_series = input_series.apply(
-        lambda s: " ".join([word.lemma_ for word in nlp(s)])
+    return lemmatize_texts(_worker_nlp, texts, _worker_batch_size)
+
+
+class LemmaCache:
+    """Least recently used cache of cleaned text -> lemmatized text,
+    which can be persisted to a local JSON file so later runs skip
+    spaCy for the texts already seen.
+
+    The whole text is the key, because spaCy's lemmas depend on the
+    part of speech and therefore on the surrounding words.
+
+    Args:
+        - path (str, optional): The JSON file the cache is loaded from
+            and saved to. If None, the cache only lives in memory.
+            Defaults to None.
+        - max_size (int, optional): How many texts are kept at most,
+            the least recently used are evicted first.
+            Defaults to 100000.
+    """
+
+    def __init__(self, path=None, max_size=100000):
+        self.path = path
+        self.max_size = max_size
+        self.model_version = None
+        self._entries = OrderedDict()
+
+        if path is not None and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                cache_data = json.load(f)
+            self.model_version = cache_data["model_version"]
+            self._entries.update(cache_data["entries"][-max_size:])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set_model_version(self, model_version):
+        """Drops every entry if they were created by a different model."""
+        if self.model_version != model_version:
+            self._entries.clear()
+            self.model_version = model_version
+
+    def get(self, text):
+        """Returns the cached lemmatized text or None."""
+        lemmatized_text = self._entries.get(text)
+        if lemmatized_text is not None:
+            self._entries.move_to_end(text)
+
+        return lemmatized_text
+
+    def put(self, text, lemmatized_text):
+        self._entries[text] = lemmatized_text
+        self._entries.move_to_end(text)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        """Writes the cache to `path`, least recently used entries first."""
+        if self.path is None:
+            return
+
+        # Folder workers may save the same cache at once, and the last
+        # one to finish wins.
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "model_version": self.model_version,
+                    "entries": list(self._entries.items()),
+                },
+                f,
+            )
+        os.replace(temporary_path, self.path)
+
+
+def lemmatizer_model_version(nlp):
+    """Helper function which identifies the spaCy model and version, so
+    cached lemmas can be invalidated when either changes.
+    """
+    meta = nlp.meta
+    return (
+        f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}"
+        f"/spacy-{spacy.__version__}"
     )
 
-    return output_series
 
+class Lemmatizer:
+    """Lemmatization service which keeps a pool of worker processes,
+    each loading the spaCy model once, so the model is never pickled
+    and the pool can be reused across chunks and files.
+
+    Every unique text is lemmatized only once, and the results are kept
+    in a LemmaCache which is saved on `close` when it has a path.
+
+    Use it as a context manager or call `close` when done. It can be
+    shared by threads, which then lemmatize one at a time.
+
+    Examples:
+        >>> from ngram_analysis import Lemmatizer
+        >>> with Lemmatizer(batch_size=500) as lemmatizer:
+        ...     lemmatizer.lemmatize(pd.Series(["rocks are computed"]))
+        0    rock be compute
+        dtype: object
+
+    Args:
+        - model_name (str, optional): The spaCy model to load.
+            Defaults to "en".
+        - processes (int, optional): Number of worker processes. With 1
+            the texts are lemmatized in the calling process.
+            Defaults to the number of CPUs.
+        - batch_size (int, optional): How many texts are sent to a
+            worker at once and streamed through `nlp.pipe`.
+            Defaults to 1000.
+        - cache_path (str, optional): Passed to LemmaCache as the file
+            the cache is persisted to. Defaults to None.
+        - cache_size (int, optional): Passed to LemmaCache as the
+            maximum number of cached texts. Defaults to 100000.
+
+    Raises:
+        - OSError: When the spaCy model can't be loaded.
+    """
+
+    def __init__(
+        self,
+        model_name="en",
+        processes=None,
+        batch_size=1000,
+        cache_path=None,
+        cache_size=100000,
+    ):
+        self.batch_size = batch_size
+        self.processes = processes or os.cpu_count()
+        # Also used for small inputs, where sending them to the
+        # workers would cost more than lemmatizing them here.
+        self.nlp = load_lemmatizer_model(model_name)
+        self.cache = LemmaCache(cache_path, max_size=cache_size)
+        self.cache.set_model_version(lemmatizer_model_version(self.nlp))
+        # Neither the spaCy model nor the cache are thread-safe.
+        self._lock = threading.Lock()
+
+        self._pool = None
+        if self.processes > 1:
+            self._pool = Pool(
+                self.processes,
+                initializer=init_lemmatizer_worker,
+                initargs=(model_name, batch_size),
+            )
+
+    def lemmatize(self, input_series):
+        """Returns the Series of lemmatized texts of `input_series`."""
+        lemmatized_texts = {}
+        uncached_texts = []
+        with self._lock:
+            for text in input_series.unique():
+                lemmatized_text = self.cache.get(text)
+                if lemmatized_text is None:
+                    uncached_texts.append(text)
+                else:
+                    lemmatized_texts[text] = lemmatized_text
+
+            for text, lemmatized_text in zip(
+                uncached_texts, self._lemmatize_texts(uncached_texts)
+            ):
+                self.cache.put(text, lemmatized_text)
+                lemmatized_texts[text] = lemmatized_text
+
+        return input_series.map(lemmatized_texts)
+
+    def _lemmatize_texts(self, texts):
+        if self._pool is None or len(texts) <= self.batch_size:
+            lemmatized_texts = lemmatize_texts(self.nlp, texts, self.batch_size)
+        else:
+            batches = [
+                texts[i : i + self.batch_size]
+                for i in range(0, len(texts), self.batch_size)
+            ]
+            lemmatized_texts = list(
+                chain.from_iterable(self._pool.imap(lemmatize_in_worker, batches))
+            )
+
+        return lemmatized_texts
+
+    def close(self):
+        with self._lock:
+            self.cache.save()
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Leave out curly braces and | sign which denotes DKI and the end of
+# the headline/description in AdWords.
+# We just want to remove the most popular punctuation to remove
+# redundant duplicate ngrams while also want to have an insight
+# into how less common characters influence the performance.
+STOP_CHARACTERS = '.,:;?!()"'
+STOP_CHARACTERS_TABLE = str.maketrans(STOP_CHARACTERS, " " * len(STOP_CHARACTERS))
+
+# Dynamic Keyword Insertions and numbers, which are kept as one word.
+SPACED_SUBSTRING_RE = re.compile(r"{.*?}|\d[\d ]*\d")
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def delete_spaces_in_match(match):
+    """Helper function for `str.replace` which removes the whitespace
+    from the matched substring.
+
+    Examples:
+        >>> from ngram_analysis import SPACED_SUBSTRING_RE, delete_spaces_in_match
+        >>> test = "test stuff {=venueprice venue} and 1 800 800"
+        >>> SPACED_SUBSTRING_RE.sub(delete_spaces_in_match, test)
+        "test stuff {=venuepricevenue} and 1800800"
+    """
+    return WHITESPACE_RE.sub("", match.group())
+
+
+def clean_single_text(text):
+    """Helper function which lowercases the text, replaces the stop
+    characters with spaces, removes the spaces inside of Dynamic Keyword
+    Insertions and between digits, and finally collapses the remaining
+    whitespace.
+    """
+    text = text.lower().translate(STOP_CHARACTERS_TABLE)
+    text = SPACED_SUBSTRING_RE.sub(delete_spaces_in_match, text)
+
+    return WHITESPACE_RE.sub(" ", text)
+
+
+def clean_text(text_series):
+    """Helper function which cleans the whole text column at once.
+
+    Every unique text is cleaned only once in a single pass, and the rows
+    with the same text share the cleaned string. Chaining the `.str`
+    methods instead would keep an intermediate copy of the column per
+    step alive until the garbage collector runs.
+    """
+    cleaned_texts = {
+        text: clean_single_text(text) for text in text_series.dropna().unique()
+    }
+
+    return text_series.map(cleaned_texts)
+
+
+def prepare_input_data(input_data_df):
+    """Helper function which returns the rows of `input_data_df` with
+    text, with the added "Unique Occurences" column. `input_data_df`
+    itself isn't modified.
+
+    Raises:
+        - TypeError: When the first column of the DataFrame isn't an
+            object.
+        - ValueError: When the DataFrame already has a "Unique
+            Occurences" column, e.g. when it's an analysis itself.
+    """
+    if not input_data_df.iloc[:, 0].dtype == "O":
+        raise TypeError(f"The first column of the input file is not text based.")
+    if "Unique Occurences" in input_data_df.columns:
+        raise ValueError(
+            'The input already has a "Unique Occurences" column, which is '
+            "added by the analysis. Rename or drop it first."
+        )
+    warn_ratio_like_columns(input_data_df)
+
+    is_text = pd.notnull(input_data_df.iloc[:, 0])
+    if not is_text.all():
+        input_data_df = input_data_df[is_text]
+    # The columns are added to a shallow copy, so the caller's
+    # DataFrame is left as it is without copying the data.
+    input_data_df = input_data_df.copy(deep=False)
+
+    # Used in counting how many times a given keyword occured
+    input_data_df.insert(1, "Unique Occurences", 1)
 
-def clean_input_data(input_data_df, lemmatize=False):
+    return input_data_df
+
+
+def clean_input_data(input_data_df, lemmatize=False, lemmatizer=None, stats=None):
     """Helper function for cleaning the main text column
     (default: first one).
 
@@ -62,11 +611,18 @@ def clean_input_data(input_data_df, lemmatize=False):
             normalize only words that are more or less sure with
             omitting word that have special characters in them.
             Defaults to False.
+        - lemmatizer (Lemmatizer, optional): The lemmatization service
+            to use, so its worker pool can be reused. If not passed, a
+            new one is started and closed for this call only.
+            Defaults to None.
+        - stats (AnalysisStats, optional): Collects the "clean" and
+            "lemmatize" stages. Defaults to None.
 
     Returns:
-        - DataFrame: Modified `input_data_df` which has now an added
-            column `cleaned_text` which contains the processed and
-            cleaned text.
+        - DataFrame: The rows of `input_data_df` with text, with the
+            added "Unique Occurences" column and the `cleaned_text`
+            column which contains the processed and cleaned text.
+            `input_data_df` itself isn't modified.
 
     Raises:
         - TypeError: When the first column of the DataFrame isn't an
@@ -80,95 +636,173 @@ def clean_input_data(input_data_df, lemmatize=False):
             still quite useful.
     """
 
-    def delete_spaces_in_substrings(s, pat=r"{.*?}|\d[\d ]*\d"):
-        """Helper inner function for removing spaces in a substring of
-        a given string. Substrings are determined by the pat argument,
-        which is a regex pattern.
+    # TODO: Rewrite this section using spacy's functions
+    with measure_stage(stats, "clean", rows_in=len(input_data_df)) as record:
+        input_data_df = prepare_input_data(input_data_df)
+        input_data_df["cleaned_text"] = clean_text(input_data_df.iloc[:, 0])
+        record["rows_out"] = len(input_data_df)
 
-        Examples:
-            >>> from ngram_analysis import delete_spaces_in_substrings
-            >>> test = "test stuff {=venueprice venue} and 1 800 800"
-            >>> delete_spaces_in_substrings(test)
-            "test stuff {=venuepricevenue} and 1800800"
-        """
-        matches = re.findall(pat, s)
+    if lemmatize:
+        print("Lemmatizing the cleaned text...")
+        with measure_stage(stats, "lemmatize", rows_in=len(input_data_df)) as record:
+            if lemmatizer is None:
+                with Lemmatizer() as lemmatizer:
+                    input_data_df["cleaned_text"] = lemmatizer.lemmatize(
+                        input_data_df["cleaned_text"]
+                    )
+            else:
+                input_data_df["cleaned_text"] = lemmatizer.lemmatize(
+                    input_data_df["cleaned_text"]
+                )
+            record["rows_out"] = len(input_data_df)
 
-        if matches:
-            for match in matches:
-                match_replacement = re.sub(r"\s+", "", match)
-                s = re.sub(match, match_replacement, s)
+    return input_data_df
 
-        return s
 
-    # -----------------------
-    # Parent's Function Logic
-    # -----------------------
+def ngram_range(tokens, start, end):
+    """Helper function which returns a list with the set of unique
+    n-grams for each n between start and end (inclusive), tokenizing
+    the text only once.
 
-    # TODO: Rewrite this section using spacy's functions
-    if not input_data_df.iloc[:, 0].dtype == "O":
-        raise TypeError(f"The first column of the input file is not text based.")
+    Examples:
+        >>> from ngram_analysis import ngram_range
+        >>> ngram_range("jack and jill".split(), 2, 3)
+        [{"jack and", "and jill"}, {"jack and jill"}]
+    """
+    ngram_sets = [set() for _ in range(start, end + 1)]
+    for i in range(len(tokens)):
+        for n in range(start, min(end, len(tokens) - i) + 1):
+            ngram_sets[n - start].add(" ".join(tokens[i : i + n]))
 
-    # Used in counting how many times a given keyword occured
-    input_data_df["Unique Occurences"] = 1
-    cols = input_data_df.columns.tolist()
-    cols.insert(1, cols.pop(cols.index("Unique Occurences")))
-    input_data_df = input_data_df[cols]
+    return ngram_sets
 
-    input_data_df["cleaned_text"] = input_data_df.iloc[:, 0]
 
-    input_data_df = input_data_df[pd.notnull(input_data_df.iloc[:, 0])]
+class NgramVocabulary:
+    """Interning table which maps tokens and n-grams to integer IDs.
 
-    # Leave out curly braces and | sign which denotes DKI and the end of
-    # the headline/description in AdWords.
-    # We just want to remove the most popular punctuation to remove
-    # redundant duplicate ngrams while also want to have an insight
-    # into how less common characters influence the performance.
-    stop_characters = '.,:;?!()"'
+    Every token is interned once, and every n-gram is stored as its
+    (n-1)-gram prefix ID plus the ID of its last token. This way
+    n-grams of any order can be hashed, compared and grouped as plain
+    integers, and are only decoded back to strings for the output.
 
-    input_data_df["cleaned_text"] = input_data_df["cleaned_text"].str.lower()
+    Examples:
+        >>> from ngram_analysis import NgramVocabulary
+        >>> vocabulary = NgramVocabulary()
+        >>> token_ids = vocabulary.encode_tokens("jack and jill".split())
+        >>> vocabulary.encode_ngrams(token_ids, 2)
+        {1, 3}
+        >>> vocabulary.decode([1, 3])
+        ["jack and", "and jill"]
+    """
 
-    input_data_df["cleaned_text"].replace(
-        {f"[{stop_characters}]": " "}, inplace=True, regex=True
-    )
-    input_data_df["cleaned_text"] = input_data_df["cleaned_text"].apply(
-        lambda s: delete_spaces_in_substrings(s)
-    )
+    def __init__(self):
+        self.tokens = []
+        self.token_ids = {}
+        # For each n-gram ID - the ID of its (n-1)-gram prefix (-1 for
+        # 1-grams) and the ID of its last token.
+        self.prefixes = []
+        self.last_tokens = []
+        self.ngram_ids = {}
 
-    input_data_df["cleaned_text"].replace({r"\s+": " "}, inplace=True, regex=True)
+    def __len__(self):
+        return len(self.prefixes)
 
-    if lemmatize:
-        print("Lemmatizing the cleaned text...")
-        nlp = spacy.load("en")
-        # We don't want to seperate anything that wasn't specified
-        # in stop_characters
-        supress_re = re.compile(r"""[\.]""")
-        nlp.tokenizer = Tokenizer(
-            nlp.vocab,
-            infix_finditer=supress_re.finditer,
-            suffix_search=supress_re.search,
-            prefix_search=supress_re.search,
-        )
+    @classmethod
+    def from_arrays(cls, tokens, prefixes, last_tokens):
+        """Rebuilds a vocabulary from its `tokens` and the `prefixes` and
+        `last_tokens` of its n-grams (see `NgramStore`), so it can be
+        used to encode further n-grams with the same IDs.
+        """
+        vocabulary = cls()
+        vocabulary.tokens = list(tokens)
+        vocabulary.token_ids = {
+            token: token_id for token_id, token in enumerate(vocabulary.tokens)
+        }
+        vocabulary.prefixes = np.asarray(prefixes).tolist()
+        vocabulary.last_tokens = np.asarray(last_tokens).tolist()
+        vocabulary.ngram_ids = {
+            key: ngram_id
+            for ngram_id, key in enumerate(
+                zip(vocabulary.prefixes, vocabulary.last_tokens)
+            )
+        }
 
-        # Weird bug present in current v2.1.4 of Spacy fix
-        nlp.tokenizer.add_special_case(
-            "who's", [{spacy.attrs.ORTH: "who's", spacy.attrs.LEMMA: "who's"}]
-        )
+        return vocabulary
 
-        cpu_count = os.cpu_count()
+    def encode_tokens(self, tokens):
+        """Returns the list of token IDs, interning the unseen tokens."""
+        token_ids = self.token_ids
+        encoded = []
+        for token in tokens:
+            token_id = token_ids.get(token)
+            if token_id is None:
+                token_id = token_ids[token] = len(self.tokens)
+                self.tokens.append(token)
+            encoded.append(token_id)
 
-        with Pool() as pool:
-            data_split = pd.np.array_split(input_data_df["cleaned_text"], cpu_count)
+        return encoded
 
-            input_data_df["cleaned_text"] = pd.concat(
-                pool.starmap(lemmatize_series, product(data_split, [nlp]))
-            )
+    def ngram_id(self, prefix_id, token_id):
+        """Returns the ID of the n-gram made of the `prefix_id` n-gram
+        (-1 for none) followed by `token_id`, interning it if unseen.
+        """
+        key = (prefix_id, token_id)
+        ngram_id = self.ngram_ids.get(key)
+        if ngram_id is None:
+            ngram_id = self.ngram_ids[key] = len(self.prefixes)
+            self.prefixes.append(prefix_id)
+            self.last_tokens.append(token_id)
 
-    return input_data_df
+        return ngram_id
+
+    def encode_ngrams(self, token_ids, n):
+        """Returns the set of unique n-gram IDs of the token ID sequence."""
+        return self.encode_ngram_range(token_ids, n, n)[0]
+
+    def encode_ngram_range(self, token_ids, start, end):
+        """Returns a list with the set of unique n-gram IDs for each n
+        between start and end (inclusive), in a single pass.
+
+        Each n-gram is extended from the (n-1)-gram starting at the same
+        position, so every order costs one lookup per token.
+        """
+        ngram_sets = [set() for _ in range(start, end + 1)]
+        for i in range(len(token_ids)):
+            ngram_id = -1
+            for n, token_id in enumerate(token_ids[i : i + end], 1):
+                ngram_id = self.ngram_id(ngram_id, token_id)
+                if n >= start:
+                    ngram_sets[n - start].add(ngram_id)
 
+        return ngram_sets
 
-def create_ngrams(input_data_cleaned_df, start=1, end=4):
+    def decode(self, ngram_ids):
+        """Returns the list of n-gram strings for the given n-gram IDs."""
+        decoded = []
+        for ngram_id in ngram_ids:
+            tokens = []
+            while ngram_id != -1:
+                tokens.append(self.tokens[self.last_tokens[ngram_id]])
+                ngram_id = self.prefixes[ngram_id]
+            decoded.append(" ".join(reversed(tokens)))
+
+        return decoded
+
+
+def create_ngrams(
+    input_data_cleaned_df, start=1, end=4, vocabulary=None, stats=None, pruning=None
+):
     """Helper function for creating n-grams.
-    n is range between start and end (inclusive).
+    n is range between start and end (inclusive). Every text is split
+    once and all the n-gram orders are generated in the same pass.
+
+    If a `vocabulary` (NgramVocabulary) is passed, the n-gram columns
+    contain sets of integer n-gram IDs instead of strings. If `stats`
+    (AnalysisStats) are passed, they collect the "create_ngrams" stage.
+    If a `pruning` (NgramPruning) with `min_occurrences` is passed too,
+    the n-grams with a rare prefix aren't even created, see
+    `apriori_ngram_incidence`, so only pass it when the DataFrame holds
+    all of the rows.
 
     Examples:
         `df` contains `cleaned_text` and inside - "jack and jill"
@@ -180,116 +814,2965 @@ def create_ngrams(input_data_cleaned_df, start=1, end=4):
         df["3-gram"]: {"jack and jill"}
         df["4-gram"]: set()
     """
+    with measure_stage(
+        stats, "create_ngrams", rows_in=len(input_data_cleaned_df)
+    ) as record:
+        if vocabulary is not None and pruning is not None and pruning.min_occurrences:
+            ngram_incidences = apriori_ngram_incidence(
+                input_data_cleaned_df, vocabulary, pruning, start, end
+            )
+            row_count = len(input_data_cleaned_df)
+            for ngram, (row_positions, ngram_ids) in ngram_incidences.items():
+                # The incidence is sorted by row, so each row takes the next
+                # of its n-grams.
+                ngram_ids = iter(ngram_ids.tolist())
+                row_counts = np.bincount(row_positions, minlength=row_count)
+                input_data_cleaned_df[ngram] = [
+                    set(islice(ngram_ids, count)) for count in row_counts.tolist()
+                ]
+            record["rows_out"] = row_count
+            record["unique_ngrams"] = len(vocabulary)
 
-    for n in range(start, end + 1):
-        n_gram = f"{n}-gram"
+            return input_data_cleaned_df
 
-        # set(nltk.ngrams(...)) returns a tuple of ngrams, that's why
-        # we join them.
-        input_data_cleaned_df[n_gram] = input_data_cleaned_df["cleaned_text"].apply(
-            lambda s: set(" ".join(gram) for gram in set(nltk.ngrams(s.split(), n)))
-        )
+        if vocabulary is not None:
+            row_ngrams = [
+                vocabulary.encode_ngram_range(
+                    vocabulary.encode_tokens(s.split()), start, end
+                )
+                for s in input_data_cleaned_df["cleaned_text"]
+            ]
+            record["unique_ngrams"] = len(vocabulary)
+        else:
+            row_ngrams = [
+                ngram_range(s.split(), start, end)
+                for s in input_data_cleaned_df["cleaned_text"]
+            ]
+
+        for offset, n in enumerate(range(start, end + 1)):
+            input_data_cleaned_df[f"{n}-gram"] = [
+                ngram_sets[offset] for ngram_sets in row_ngrams
+            ]
+        record["rows_out"] = len(input_data_cleaned_df)
 
     return input_data_cleaned_df
 
 
+def create_ngram_incidence(
+    input_data_cleaned_df, vocabulary, start=1, end=4, stats=None, pruning=None
+):
+    """Counterpart of `create_ngrams` which returns the flat incidence
+    (see `ngram_incidence`) of every n-gram column instead of adding
+    the per-row sets of n-grams to the DataFrame.
+
+    Only two int64 values are kept per n-gram occurrence, instead of a
+    set per row and n, so it takes a fraction of the memory. Use it when
+    the "Original Processed Data" isn't needed. A `pruning` is used like
+    in `create_ngrams`.
+
+    Returns:
+        - dict: The n-gram column name and a tuple of the positional row
+            numbers and the n-gram IDs (both int64 ndarrays) of each
+            unique n-gram of each row.
+    """
+    ngram_orders = range(start, end + 1)
+    row_positions = [array("q") for _ in ngram_orders]
+    ngram_ids = [array("q") for _ in ngram_orders]
+
+    with measure_stage(
+        stats, "create_ngrams", rows_in=len(input_data_cleaned_df)
+    ) as record:
+        if pruning is not None and pruning.min_occurrences:
+            ngram_incidences = apriori_ngram_incidence(
+                input_data_cleaned_df, vocabulary, pruning, start, end
+            )
+            record["rows_out"] = len(input_data_cleaned_df)
+            record["unique_ngrams"] = len(vocabulary)
+
+            return ngram_incidences
+
+        for position, s in enumerate(input_data_cleaned_df["cleaned_text"]):
+            row_ngram_sets = vocabulary.encode_ngram_range(
+                vocabulary.encode_tokens(s.split()), start, end
+            )
+            for offset, ngram_set in enumerate(row_ngram_sets):
+                ngram_ids[offset].extend(ngram_set)
+                row_positions[offset].extend(repeat(position, len(ngram_set)))
+
+        ngram_incidences = {
+            f"{n}-gram": (
+                np.frombuffer(row_positions[offset], dtype=np.int64),
+                np.frombuffer(ngram_ids[offset], dtype=np.int64),
+            )
+            for offset, n in enumerate(ngram_orders)
+        }
+        record["rows_out"] = len(input_data_cleaned_df)
+        record["unique_ngrams"] = len(vocabulary)
+
+    return ngram_incidences
+
+
+def encode_corpus(cleaned_text_series, vocabulary):
+    """Helper function which splits every cleaned text into tokens and
+    interns them in the `vocabulary`.
+
+    Returns:
+        - tuple: The offsets (int64 ndarray, one more than there are
+            texts) and the token IDs (int64 ndarray) of all of the
+            texts, the tokens of the i-th text being
+            `token_ids[token_offsets[i]:token_offsets[i + 1]]`.
+    """
+    token_counts = array("q", [0])
+    token_ids = array("q")
+    for s in cleaned_text_series:
+        text_token_ids = vocabulary.encode_tokens(s.split())
+        token_ids.extend(text_token_ids)
+        token_counts.append(len(text_token_ids))
+
+    return (
+        np.cumsum(np.frombuffer(token_counts, dtype=np.int64)),
+        np.frombuffer(token_ids, dtype=np.int64),
+    )
+
+
+def corpus_ngram_incidence(token_offsets, token_ids, vocabulary, start=1, end=4):
+    """Counterpart of `create_ngram_incidence` for texts which are
+    already encoded with `encode_corpus`, so they don't have to be
+    cleaned and split again.
+
+    Returns:
+        - dict: The same dictionary as `create_ngram_incidence`.
+    """
+    ngram_orders = range(start, end + 1)
+    row_positions = [array("q") for _ in ngram_orders]
+    ngram_ids = [array("q") for _ in ngram_orders]
+
+    # Slicing a list gives Python ints, which are quicker to hash.
+    token_ids = np.asarray(token_ids).tolist()
+    token_offsets = np.asarray(token_offsets).tolist()
+    for position in range(len(token_offsets) - 1):
+        row_ngram_sets = vocabulary.encode_ngram_range(
+            token_ids[token_offsets[position] : token_offsets[position + 1]],
+            start,
+            end,
+        )
+        for offset, ngram_set in enumerate(row_ngram_sets):
+            ngram_ids[offset].extend(ngram_set)
+            row_positions[offset].extend(repeat(position, len(ngram_set)))
+
+    return {
+        f"{n}-gram": (
+            np.frombuffer(row_positions[offset], dtype=np.int64),
+            np.frombuffer(ngram_ids[offset], dtype=np.int64),
+        )
+        for offset, n in enumerate(ngram_orders)
+    }
+
+
+def apriori_ngram_incidence(input_data_cleaned_df, vocabulary, pruning, start=1, end=4):
+    """Counterpart of `create_ngram_incidence` which doesn't create the
+    n-grams whose (n-1)-gram prefix is found in fewer than the
+    `min_occurrences` of the `pruning` (NgramPruning) rows.
+
+    The orders are created one after the other, each n-gram extended
+    from the (n-1)-gram starting at the same token, and only the
+    frequent (n-1)-grams are extended. So the work on the longer orders
+    shrinks with the rare prefixes, instead of creating every n-gram and
+    dropping them later.
+
+    Returns:
+        - dict: The same dictionary as `create_ngram_incidence`, with the
+            row positions sorted.
+    """
+    token_offsets, token_ids = encode_corpus(
+        input_data_cleaned_df["cleaned_text"], vocabulary
+    )
+    token_rows = np.repeat(np.arange(len(token_offsets) - 1), np.diff(token_offsets))
+    row_ends = token_offsets[1:][token_rows]
+    # The ID of the (n-1)-gram starting at each token, -1 for none.
+    prefix_ids = np.full(len(token_ids), -1, dtype=np.int64)
+    positions = np.arange(len(token_ids))
+
+    ngram_incidences = {}
+    for n in range(1, end + 1):
+        positions = positions[positions + n <= row_ends[positions]]
+        ngram_ids = np.fromiter(
+            map(
+                vocabulary.ngram_id,
+                prefix_ids[positions].tolist(),
+                token_ids[positions + n - 1].tolist(),
+            ),
+            dtype=np.int64,
+            count=len(positions),
+        )
+        prefix_ids[positions] = ngram_ids
+
+        # Each n-gram once per row.
+        ngram_count = len(vocabulary)
+        row_ngrams = np.unique(token_rows[positions] * ngram_count + ngram_ids)
+        row_positions, unique_ngram_ids = np.divmod(row_ngrams, ngram_count)
+        if n >= start:
+            ngram_incidences[f"{n}-gram"] = (row_positions, unique_ngram_ids)
+        if n < end:
+            positions = positions[
+                np.isin(
+                    ngram_ids,
+                    pruning.frequent_ngram_ids(
+                        input_data_cleaned_df, row_positions, unique_ngram_ids
+                    ),
+                )
+            ]
+
+    return ngram_incidences
+
+
 ###########################
 # CALCULATING PERFORMANCE #
 ###########################
 
 
-def calculate_ngram_performance(input_data_with_ngrams_df):
-    """Helper function which aggregates the unique n-grams and apply's
-    two different types of aggregation depending if the performance
-    data is text or numerical based.
+AGGREGATION_ENGINES = ("vectorized", "apply", "sharded")
+
+
+def ngram_incidence(ngram_series):
+    """Helper function which flattens a column of per-row n-gram sets
+    into the long (row, n-gram) incidence.
+
+    Works on flat arrays only, so memory scales with the total number
+    of n-grams instead of rows × the most n-grams found in a single row.
+
+    Examples:
+        >>> from ngram_analysis import ngram_incidence
+        >>> ngram_incidence(pd.Series([{"jack", "jill"}, set(), {"bart"}]))
+        (array([0, 0, 2]), ["jack", "jill", "bart"])
 
     Args:
-        - input_data_with_ngrams_df (DataFrame): DataFrame containing
-            the text, performance columns, cleaned text and ngram
-            columns.
+        - ngram_series (Series): Series holding a set of n-grams per row.
 
     Returns:
-        - dict: A dictionary containing key value pairs of the ngram
-            and ngram's performance DataFrame.
+        - tuple: The positional row number of each n-gram occurrence
+            (ndarray) and the n-grams themselves (list), both of the
+            same length.
+    """
+    ngram_counts = ngram_series.map(len).to_numpy(dtype=np.int64)
+    row_positions = np.repeat(np.arange(len(ngram_series)), ngram_counts)
+    ngrams = list(chain.from_iterable(ngram_series))
 
-            {
-                "1-gram": DataFrame({
-                    "1-gram": ["jack", "and", "jill"],
-                    "link_clicks": [1000, 3000, 2000],
-                    "in_ads": ["ad_1", "ad_1, ad_2", "ad_2"]
-                }),
+    return row_positions, ngrams
+
+
+def is_text_column(series):
+    """Helper function telling whether a performance column is aggregated
+    as text (unique values joined by ", ") or numerically (summed).
+    """
+    return series.dtype == "O" or isinstance(
+        series.dtype, (pd.CategoricalDtype, pd.StringDtype)
+    )
+
+
+def upcast_for_sum(values):
+    """Helper function which casts downcast numeric columns (see
+    `downcast_numeric_columns`) back to 64 bits, so summing them can't
+    overflow or lose precision.
+    """
+    if pd.api.types.is_signed_integer_dtype(values.dtype):
+        return values.astype(np.int64)
+    if pd.api.types.is_unsigned_integer_dtype(values.dtype):
+        return values.astype(np.uint64)
+    if pd.api.types.is_float_dtype(values.dtype):
+        return values.astype(np.float64)
+
+    return values
+
+
+def split_ngram_columns(input_data_with_ngrams_df):
+    """Helper function which returns the list of n-gram columns and the
+    list of performance columns (everything apart from the first text
+    column, `cleaned_text` and the n-gram columns).
+    """
+    input_df_columns = input_data_with_ngrams_df.columns.tolist()
+    ngram_columns = [col for col in input_df_columns if "-gram" in col]
+    performance_columns = [
+        col
+        for col in input_df_columns[1:]
+        if (col not in ngram_columns) and (col != "cleaned_text")
+    ]
+
+    return ngram_columns, performance_columns
+
+
+class NgramPruning:
+    """Drops the n-grams nobody reads - the ones found in fewer than
+    `min_occurrences` rows, or outside of the `top_k` by `rank_by` -
+    already from the (row, n-gram) incidence, so they are never merged,
+    grouped, joined or written.
+
+    The support of an n-gram is the sum of its "Unique Occurences". An
+    n-gram can't be found in more rows than its (n-1)-gram prefix, so
+    when the n-grams are encoded with a `NgramVocabulary`, the n-grams
+    whose prefix is already below `min_occurrences` are dropped before
+    even counting them (apriori pruning). The frequent n-grams of each
+    order are remembered for that, so use a new NgramPruning for every
+    analysis.
+
+    Examples:
+        >>> from ngram_analysis import NgramPruning
+        >>> pruning = NgramPruning(min_occurrences=2)
+        >>> calculate_ngram_performance(df, vocabulary=vocabulary, pruning=pruning)
+
+    Raises:
+        - ValueError: When `rank_by` isn't a numeric performance column.
+    """
+
+    SUPPORT_COLUMN = "Unique Occurences"
+
+    def __init__(self, min_occurrences=None, top_k=None, rank_by="Unique Occurences"):
+        self.min_occurrences = min_occurrences
+        self.top_k = top_k
+        self.rank_by = rank_by
+        # For each n - the IDs of the n-grams with enough support.
+        self.frequent_ngrams = {}
+
+    def column_sums(self, input_df, column, row_positions, codes, ngram_count):
+        if column not in input_df.columns or is_text_column(input_df[column]):
+            raise ValueError(f"Can't rank the n-grams by column {column!r}.")
+        weights = input_df[column].to_numpy(dtype=np.float64)[row_positions]
+
+        # Without any codes the sums come back as integers.
+        return np.bincount(
+            codes, weights=np.nan_to_num(weights), minlength=ngram_count
+        ).astype(np.float64)
+
+    def frequent_ngram_ids(self, input_df, row_positions, ngrams):
+        """Returns the unique `ngrams` of the incidence which are found in
+        at least `min_occurrences` rows.
+        """
+        codes, unique_ngrams = pd.factorize(ngrams)
+        support = self.column_sums(
+            input_df, self.SUPPORT_COLUMN, row_positions, codes, len(unique_ngrams)
+        )
+
+        return unique_ngrams[support >= self.min_occurrences]
+
+    def prune_incidence(self, input_df, ngram, row_positions, ngrams, vocabulary=None):
+        """Returns the row positions and n-grams (as returned by
+        `ngram_incidence`) of the `ngram` column without the pruned
+        n-grams.
+        """
+        n = int(ngram.split("-")[0])
+        ngrams = np.asarray(ngrams)
+
+        frequent_prefixes = self.frequent_ngrams.get(n - 1)
+        if vocabulary is not None and frequent_prefixes is not None:
+            prefixes = np.asarray(vocabulary.prefixes, dtype=np.int64)[ngrams]
+            has_frequent_prefix = np.isin(prefixes, frequent_prefixes)
+            row_positions = row_positions[has_frequent_prefix]
+            ngrams = ngrams[has_frequent_prefix]
+
+        codes, unique_ngrams = pd.factorize(ngrams)
+        keep = np.ones(len(unique_ngrams), dtype=bool)
+
+        if self.min_occurrences:
+            support = self.column_sums(
+                input_df, self.SUPPORT_COLUMN, row_positions, codes, len(unique_ngrams)
+            )
+            keep &= support >= self.min_occurrences
+            if vocabulary is not None:
+                self.frequent_ngrams[n] = unique_ngrams[keep]
+
+        if self.top_k is not None:
+            metric = self.column_sums(
+                input_df, self.rank_by, row_positions, codes, len(unique_ngrams)
+            )
+            metric[~keep] = -np.inf
+            top_codes = np.argsort(-metric, kind="stable")[: self.top_k]
+            keep &= np.isin(np.arange(len(unique_ngrams)), top_codes)
+
+        is_kept = keep[codes]
+
+        return row_positions[is_kept], ngrams[is_kept]
+
+    def prune_partial(self, partial_df):
+        """Returns the partial aggregates (see `aggregate_partial`)
+        without the pruned n-grams.
+        """
+        if self.min_occurrences:
+            partial_df = partial_df[
+                partial_df[self.SUPPORT_COLUMN] >= self.min_occurrences
+            ]
+
+        if self.top_k is not None:
+            if self.rank_by not in partial_df.columns or is_text_column(
+                partial_df[self.rank_by]
+            ):
+                raise ValueError(f"Can't rank the n-grams by column {self.rank_by!r}.")
+            top_ngrams = partial_df[self.rank_by].nlargest(self.top_k).index
+            partial_df = partial_df[partial_df.index.isin(top_ngrams)]
+
+        return partial_df
+
+
+def make_pruning(min_occurrences=None, top_k=None, rank_by="Unique Occurences"):
+    """Helper function which returns the NgramPruning for the given
+    settings, or None when nothing is pruned.
+    """
+    if not min_occurrences and top_k is None:
+        return None
+
+    return NgramPruning(min_occurrences=min_occurrences, top_k=top_k, rank_by=rank_by)
+
+
+def ngram_column_incidence(
+    input_data_with_ngrams_df, ngram, vocabulary=None, pruning=None
+):
+    """Helper function which returns the `ngram_incidence` of the
+    `ngram` column, with the n-gram IDs as an int64 ndarray when the
+    column was encoded with the `vocabulary`.
+
+    If `pruning` (NgramPruning) is passed, the pruned n-grams are left
+    out.
+    """
+    row_positions, ngrams = ngram_incidence(input_data_with_ngrams_df[ngram])
+    if vocabulary is not None:
+        ngrams = np.array(ngrams, dtype=np.int64)
+    if pruning is not None:
+        row_positions, ngrams = pruning.prune_incidence(
+            input_data_with_ngrams_df, ngram, row_positions, ngrams, vocabulary
+        )
+
+    return row_positions, ngrams
+
+
+def explode_ngram_performance(
+    input_data_with_ngrams_df,
+    ngram,
+    performance_columns,
+    vocabulary=None,
+    pruning=None,
+):
+    """Helper function which returns the long DataFrame that has the
+    n-gram in the first column and the performance of the row it came
+    from in the rest.
+
+    If `pruning` (NgramPruning) is passed, the pruned n-grams are left
+    out.
+    """
+    row_positions, ngrams = ngram_column_incidence(
+        input_data_with_ngrams_df, ngram, vocabulary, pruning
+    )
+    ngram_performance_df = input_data_with_ngrams_df[performance_columns].take(
+        row_positions
+    )
+    ngram_performance_df.insert(0, ngram, ngrams)
+
+    return ngram_performance_df
+
+
+def decode_ngram_performance(ngram_performance_df, ngram, vocabulary):
+    """Helper function which decodes the n-gram IDs of an aggregated
+    DataFrame into strings and sorts it by them.
+    """
+    ngram_performance_df[ngram] = np.array(
+        vocabulary.decode(ngram_performance_df[ngram]), dtype=object
+    )
+
+    return ngram_performance_df.sort_values(ngram, ignore_index=True)
+
+
+def decode_ngram_sets(ngram_series, vocabulary):
+    """Helper function which decodes a Series of per-row n-gram ID sets
+    into sets of strings, decoding each unique ID only once.
+    """
+    ngram_ids = list(set().union(*ngram_series))
+    decoded = dict(zip(ngram_ids, vocabulary.decode(ngram_ids)))
+
+    return ngram_series.apply(
+        lambda row_ngram_ids: {decoded[ngram_id] for ngram_id in row_ngram_ids}
+    )
+
+
+def aggregate_by_dtype(x):
+    """Helper function for the groupby aggregation used by the "apply"
+    engine. Called once per unique n-gram.
+
+    Note:
+        - The aggregated returned text has only unique elements
+            seperated by a ",".
+    """
+    d = {}
+    for column in x.columns[1:]:
+        if is_text_column(x[column]):
+            d[column] = ", ".join(set(x[column]))
+        else:
+            d[column] = upcast_for_sum(x[column]).sum()
+    return pd.Series(d)
+
+
+# How a performance column can be aggregated, see `ColumnAggregation`.
+COLUMN_AGGREGATIONS = ("sum", "mean", "max", "min", "count", "nunique", "join", "first")
+NUMERIC_AGGREGATIONS = ("sum", "mean", "max", "min")
+TEXT_AGGREGATIONS = ("join", "first")
+
+# How the aggregation of a column is given by default (see `column_aggregation`)
+# and on the command line, e.g. "ad_id=nunique" or "ad_name=first:3".
+ColumnAggregation = namedtuple("ColumnAggregation", ["how", "limit"], defaults=(None,))
+
+
+def parse_column_aggregation(spec):
+    """Parses the aggregation of a column given as "COLUMN=HOW", where
+    HOW is one of `COLUMN_AGGREGATIONS` and "first" takes the number of
+    values to keep, e.g. "ad_name=first:3".
+
+    Returns:
+        - tuple: The column name and its ColumnAggregation.
+
+    Raises:
+        - ValueError: When `spec` isn't in the format above.
+    """
+    column, equals_sign, how = spec.rpartition("=")
+    how, colon, limit = how.strip().partition(":")
+    column = column.strip()
+    if not (equals_sign and column) or how not in COLUMN_AGGREGATIONS:
+        raise ValueError(
+            f"Invalid column aggregation {spec!r}, expected COLUMN=HOW with HOW "
+            f"one of {COLUMN_AGGREGATIONS}, e.g. 'ad_id=nunique' or 'ad_name=first:3'."
+        )
+    if how != "first":
+        if colon:
+            raise ValueError(f"Only 'first' takes a limit, got {spec!r}.")
+        return column, ColumnAggregation(how)
+    if not limit.isdigit() or int(limit) < 1:
+        raise ValueError(f"'first' takes a positive number of values, got {spec!r}.")
+
+    return column, ColumnAggregation(how, int(limit))
+
+
+def column_aggregation(column, values, aggregations=None):
+    """Helper function which returns the ColumnAggregation of the
+    `column` - the one given in the `aggregations` dict, or by default
+    the sum of a numeric column and the joined unique values of a text
+    column.
+
+    Raises:
+        - ValueError: When the aggregation doesn't fit the dtype of the
+            column, e.g. the sum of a text column.
+    """
+    aggregation = (aggregations or {}).get(column)
+    if aggregation is None:
+        return ColumnAggregation("join" if is_text_column(values) else "sum")
+
+    if aggregation.how in NUMERIC_AGGREGATIONS and is_text_column(values):
+        raise ValueError(f"Can't {aggregation.how} the text column {column!r}.")
+    if aggregation.how in TEXT_AGGREGATIONS and not is_text_column(values):
+        raise ValueError(f"Can't {aggregation.how} the numeric column {column!r}.")
+
+    return aggregation
+
+
+def mean_count_column(column):
+    """Helper function which returns the name of the column of the
+    partial aggregates holding the number of values of a "mean" column,
+    which itself holds their sum until `finalize_partial`.
+    """
+    return f"{column} (count)"
+
+
+def tuples_by_code(values, codes, n_groups):
+    """Helper function which returns an object array with the tuple of
+    `values` of each code (0..`n_groups` - 1), in the order they appear.
+    It's much quicker than a groupby calling `tuple` per group.
+    """
+    order = np.argsort(codes, kind="stable")
+    values = iter(np.asarray(values, dtype=object)[order].tolist())
+
+    tuples = np.empty(n_groups, dtype=object)
+    for code, count in enumerate(np.bincount(codes, minlength=n_groups).tolist()):
+        tuples[code] = tuple(islice(values, count))
+
+    return tuples
+
+
+def aggregate_column(column, values, codes, n_groups, aggregation, partial=False):
+    """Helper function which aggregates the `values` of a performance
+    column by the `codes` (0..`n_groups` - 1) of their n-grams.
+
+    "join" and "first" keep the unique values in the order they first
+    appeared and join them with ", ", "nunique" counts them, while
+    "count" counts all of the values. Missing values aren't counted.
+
+    If `partial` is set, the partial aggregates are returned instead,
+    which are merged with `merge_partials`. The unique values are kept
+    as a tuple for "join", "first" and "nunique", and "mean" is kept as
+    the sum along with the number of values in the `mean_count_column`.
+
+    Returns:
+        - dict: The name and the aggregated values (ndarray) of the
+            column, ordered by the code.
+    """
+    how = aggregation.how
+    if how in NUMERIC_AGGREGATIONS:
+        grouped_values = upcast_for_sum(values).groupby(codes)
+        if how == "mean" and partial:
+            return {
+                column: grouped_values.sum().to_numpy(),
+                mean_count_column(column): grouped_values.count().to_numpy(),
+            }
+        return {column: getattr(grouped_values, how)().to_numpy()}
+
+    if how == "count":
+        return {column: values.groupby(codes).count().to_numpy()}
+
+    # Deduplicating integer codes instead of the values is quicker,
+    # especially for categorical and Arrow strings.
+    value_codes, unique_values = pd.factorize(values, use_na_sentinel=how == "nunique")
+    pairs_df = pd.DataFrame({"code": codes, "value": value_codes}).drop_duplicates()
+    if how == "nunique":
+        pairs_df = pairs_df[pairs_df["value"] >= 0]
+        if not partial:
+            return {
+                column: np.bincount(pairs_df["code"].to_numpy(), minlength=n_groups)
+            }
+    elif how == "first":
+        pairs_df = pairs_df.groupby("code").head(aggregation.limit)
+
+    unique_values = np.asarray(unique_values, dtype=object)
+    # Only n-grams without any value (for "nunique") get an empty one.
+    aggregated_array = tuples_by_code(
+        unique_values[pairs_df["value"].to_numpy()],
+        pairs_df["code"].to_numpy(),
+        n_groups,
+    )
+    if not partial:
+        aggregated_array = np.array(
+            [", ".join(values) for values in aggregated_array], dtype=object
+        )
+
+    return {column: aggregated_array}
+
+
+def aggregate_incidence(
+    input_data_with_ngrams_df,
+    ngram,
+    performance_columns,
+    row_positions,
+    ngrams,
+    aggregations=None,
+    partial=False,
+):
+    """Helper function which aggregates the performance of the n-grams
+    straight from their incidence (see `ngram_incidence`), one column
+    at a time.
+
+    Unlike aggregating the long DataFrame of `explode_ngram_performance`,
+    only one performance column is ever gathered per n-gram occurrence,
+    so the peak memory doesn't grow with the number of columns.
+
+    Each column is aggregated by `aggregate_column`. By default numeric
+    columns are summed, while the unique values of each text column are
+    joined by ", " in the order they first appeared, which matches
+    `aggregate_by_dtype`.
+
+    Args:
+        - input_data_with_ngrams_df (DataFrame): DataFrame (or dict of
+            Series) containing the performance columns.
+        - ngram (str): Name of the n-gram column, e.g. "2-gram".
+        - performance_columns (list): The columns to aggregate.
+        - row_positions (ndarray): Positional row of every occurrence.
+        - ngrams (list or ndarray): The n-gram of every occurrence.
+        - aggregations (dict, optional): The ColumnAggregation of the
+            columns which aren't aggregated by default.
+            Defaults to None.
+        - partial (bool, optional): If set, the partial aggregates are
+            returned instead, see `aggregate_column`. Defaults to False.
+
+    Returns:
+        - DataFrame: The aggregated performance columns indexed by the
+            n-gram, sorted by it.
+
+    Raises:
+        - ValueError: When `aggregations` has a column that isn't one of
+            the `performance_columns` or doesn't fit its dtype.
+    """
+    unknown_columns = set(aggregations or {}).difference(performance_columns)
+    if unknown_columns:
+        raise ValueError(
+            f"Can't aggregate {sorted(unknown_columns)}, they're not performance "
+            f"columns of the input data."
+        )
+
+    codes, unique_ngrams = pd.factorize(ngrams, sort=True)
+    aggregated_df = pd.DataFrame(index=pd.Index(unique_ngrams, name=ngram))
+
+    for column in performance_columns:
+        values = pd.Series(input_data_with_ngrams_df[column].array.take(row_positions))
+        aggregated_columns = aggregate_column(
+            column,
+            values,
+            codes,
+            len(unique_ngrams),
+            column_aggregation(column, values, aggregations),
+            partial,
+        )
+        # Every n-gram has at least one occurrence, so the groups are
+        # exactly the codes 0..len(unique_ngrams) - 1.
+        for name, aggregated_values in aggregated_columns.items():
+            aggregated_df[name] = aggregated_values
+
+    return aggregated_df
+
+
+def calculate_ngram_performance(
+    input_data_with_ngrams_df,
+    engine="vectorized",
+    vocabulary=None,
+    pruning=None,
+    stats=None,
+    include_processed_data=True,
+    shards=None,
+    aggregations=None,
+):
+    """Helper function which aggregates the unique n-grams and apply's
+    two different types of aggregation depending if the performance
+    data is text or numerical based.
+
+    Args:
+        - input_data_with_ngrams_df (DataFrame): DataFrame containing
+            the text, performance columns, cleaned text and ngram
+            columns.
+        - engine (str, optional): The aggregation engine, one of
+            `AGGREGATION_ENGINES`. "vectorized" aggregates every n-gram
+            column by column with `aggregate_incidence`, "apply" calls
+            `aggregate_by_dtype` per unique n-gram and is kept for
+            benchmarking. "sharded" splits the work of "vectorized"
+            across processes, see `ShardedAggregator`.
+            Defaults to "vectorized".
+        - vocabulary (NgramVocabulary, optional): The vocabulary the
+            n-gram columns were encoded with by `create_ngrams`. The
+            n-grams are then grouped as integers and only decoded into
+            the returned DataFrames. Defaults to None.
+        - pruning (NgramPruning, optional): If passed, the rare n-grams
+            are dropped before they are aggregated. Defaults to None.
+        - stats (AnalysisStats, optional): Collects an "aggregate" stage
+            per n-gram column. Defaults to None.
+        - include_processed_data (bool, optional): If set, the processed
+            rows are returned as the "Original Processed Data".
+            Defaults to True.
+        - shards (int, optional): The number of worker processes of the
+            "sharded" engine. Defaults to the number of CPUs.
+        - aggregations (dict, optional): The ColumnAggregation's of the
+            columns which aren't summed or joined by default, see
+            `aggregate_column`. Not supported by the "apply" engine.
+            Defaults to None.
+
+    Returns:
+        - dict: A dictionary containing key value pairs of the ngram
+            and ngram's performance DataFrame.
+
+            {
+                "1-gram": DataFrame({
+                    "1-gram": ["jack", "and", "jill"],
+                    "link_clicks": [1000, 3000, 2000],
+                    "in_ads": ["ad_1", "ad_1, ad_2", "ad_2"]
+                }),
                 "2-gram": DataFrame({
                     "2-gram": ["jack and", "and jill"],
                     "link_clicks": [1000, 2000],
                     "in_ads": ["ad_1", "ad_2"]
                 })
             }
+
+    Raises:
+        - ValueError: When `engine` isn't one of `AGGREGATION_ENGINES`.
+    """
+    if engine not in AGGREGATION_ENGINES:
+        raise ValueError(
+            f"Unknown aggregation engine {engine!r}, "
+            f"expected one of {AGGREGATION_ENGINES}."
+        )
+    if engine == "apply" and aggregations:
+        raise ValueError("The 'apply' engine only sums and joins the columns.")
+
+    ngram_columns, performance_columns = split_ngram_columns(input_data_with_ngrams_df)
+
+    ngram_performance_dict = {}
+
+    with sharded_aggregator(
+        engine, input_data_with_ngrams_df, performance_columns, shards, aggregations
+    ) as aggregator:
+        for ngram in ngram_columns:
+            with measure_stage(
+                stats, f"aggregate {ngram}", rows_in=len(input_data_with_ngrams_df)
+            ) as record:
+                if engine == "apply":
+                    exploded_df = explode_ngram_performance(
+                        input_data_with_ngrams_df,
+                        ngram,
+                        performance_columns,
+                        vocabulary,
+                        pruning,
+                    )
+                    # With every n-gram pruned the apply keeps the n-gram column.
+                    ngram_performance_df = (
+                        exploded_df.groupby(ngram, group_keys=False)
+                        .apply(aggregate_by_dtype)
+                        .reset_index(drop=exploded_df.empty)
+                    )
+                else:
+                    row_positions, ngrams = ngram_column_incidence(
+                        input_data_with_ngrams_df, ngram, vocabulary, pruning
+                    )
+                    ngram_performance_df = aggregator.aggregate(
+                        ngram, row_positions, ngrams
+                    ).reset_index()
+
+                if vocabulary is not None:
+                    ngram_performance_df = decode_ngram_performance(
+                        ngram_performance_df, ngram, vocabulary
+                    )
+                ngram_performance_dict[ngram] = ngram_performance_df
+                record["rows_out"] = record["unique_ngrams"] = len(ngram_performance_df)
+
+            print(f"Calculation of {ngram} done in {record['seconds']:.2f}s.")
+
+    if include_processed_data:
+        ngram_performance_dict["Original Processed Data"] = processed_data(
+            input_data_with_ngrams_df, vocabulary
+        )
+
+    return ngram_performance_dict
+
+
+def calculate_incidence_performance(
+    input_data_cleaned_df,
+    ngram_incidences,
+    vocabulary,
+    pruning=None,
+    stats=None,
+    engine="vectorized",
+    shards=None,
+    aggregations=None,
+):
+    """Counterpart of `calculate_ngram_performance` for the n-grams
+    returned by `create_ngram_incidence`. `engine` is either "vectorized"
+    or "sharded".
+
+    Returns:
+        - dict: The same dictionary as `calculate_ngram_performance`,
+            without the "Original Processed Data".
+    """
+    _, performance_columns = split_ngram_columns(input_data_cleaned_df)
+
+    ngram_performance_dict = {}
+    with sharded_aggregator(
+        engine, input_data_cleaned_df, performance_columns, shards, aggregations
+    ) as aggregator:
+        for ngram, (row_positions, ngrams) in ngram_incidences.items():
+            with measure_stage(
+                stats, f"aggregate {ngram}", rows_in=len(input_data_cleaned_df)
+            ) as record:
+                if pruning is not None:
+                    row_positions, ngrams = pruning.prune_incidence(
+                        input_data_cleaned_df, ngram, row_positions, ngrams, vocabulary
+                    )
+                ngram_performance_df = aggregator.aggregate(
+                    ngram, row_positions, ngrams
+                ).reset_index()
+                ngram_performance_dict[ngram] = decode_ngram_performance(
+                    ngram_performance_df, ngram, vocabulary
+                )
+                record["rows_out"] = record["unique_ngrams"] = len(ngram_performance_df)
+
+            print(f"Calculation of {ngram} done in {record['seconds']:.2f}s.")
+
+    return ngram_performance_dict
+
+
+def calculate_segment_performance(
+    input_data_cleaned_df,
+    ngram_incidences,
+    vocabulary,
+    group_by,
+    pruning=None,
+    stats=None,
+    engine="vectorized",
+    shards=None,
+    aggregations=None,
+):
+    """Counterpart of `calculate_incidence_performance` which aggregates
+    the n-grams per segment of the `group_by` column, e.g. per campaign.
+
+    The n-grams are created only once for all of the segments. Each
+    (segment, n-gram) pair is encoded as a single integer key, so every
+    n-gram column is still aggregated in a single pass, and the result
+    is only split into the segments at the end. Rows without a segment
+    are left out, and the `pruning` is applied to each segment on its
+    own, after the aggregation.
+
+    Returns:
+        - dict: The segments (sorted) and their n-gram performance
+            dictionaries, as returned by `calculate_incidence_performance`.
+
+    Raises:
+        - ValueError: When `group_by` isn't a column of the input data.
+    """
+    _, performance_columns = split_ngram_columns(input_data_cleaned_df)
+    if group_by not in performance_columns:
+        raise ValueError(f"Can't group by {group_by!r}, it's not in the input data.")
+    performance_columns.remove(group_by)
+
+    row_segments, segments = pd.factorize(input_data_cleaned_df[group_by], sort=True)
+    segment_performance_dict = {segment: {} for segment in segments}
+    ngram_count = len(vocabulary)
+
+    with sharded_aggregator(
+        engine, input_data_cleaned_df, performance_columns, shards, aggregations
+    ) as aggregator:
+        for ngram, (row_positions, ngrams) in ngram_incidences.items():
+            with measure_stage(
+                stats, f"aggregate {ngram}", rows_in=len(input_data_cleaned_df)
+            ) as record:
+                ngram_segments = row_segments[row_positions]
+                has_segment = ngram_segments >= 0
+                row_positions = np.asarray(row_positions)[has_segment]
+                segment_ngrams = (
+                    ngram_segments[has_segment] * ngram_count
+                    + np.asarray(ngrams, dtype=np.int64)[has_segment]
+                )
+
+                ngram_performance_df = aggregator.aggregate(
+                    ngram, row_positions, segment_ngrams
+                ).reset_index()
+                keys = ngram_performance_df[ngram].to_numpy()
+                ngram_performance_df[ngram] = np.array(
+                    vocabulary.decode(keys % ngram_count), dtype=object
+                )
+                # The keys are sorted by the segment first.
+                bounds = np.searchsorted(keys // ngram_count, range(len(segments) + 1))
+                for code, segment in enumerate(segments):
+                    segment_df = ngram_performance_df.iloc[
+                        bounds[code] : bounds[code + 1]
+                    ]
+                    if pruning is not None:
+                        segment_df = pruning.prune_partial(segment_df)
+                    segment_performance_dict[segment][ngram] = segment_df.sort_values(
+                        ngram, ignore_index=True
+                    )
+
+                record["rows_out"] = len(ngram_performance_df)
+                record["unique_ngrams"] = len(np.unique(keys % ngram_count))
+
+            print(f"Calculation of {ngram} done in {record['seconds']:.2f}s.")
+
+    return segment_performance_dict
+
+
+def processed_data(input_data_with_ngrams_df, vocabulary=None):
+    """Helper function which returns the "Original Processed Data" part
+    of the output - the processed rows with their n-grams as strings.
+    """
+    ngram_columns, _ = split_ngram_columns(input_data_with_ngrams_df)
+
+    # A shallow copy, only the decoded n-gram columns are new.
+    processed_data_df = input_data_with_ngrams_df.copy(deep=False)
+    processed_data_df.index = pd.RangeIndex(len(processed_data_df))
+    if vocabulary is not None:
+        for ngram in ngram_columns:
+            processed_data_df[ngram] = decode_ngram_sets(
+                processed_data_df[ngram], vocabulary
+            )
+
+    return processed_data_df
+
+
+#######################
+# SHARDED AGGREGATION #
+#######################
+
+
+# The performance columns of the `ShardedAggregator` in a worker process
+# and the shared memory backing them, see `init_shard_worker`.
+_shard_worker_columns = None
+_shard_worker_blocks = None
+
+
+def share_arrays(arrays):
+    """Helper function which copies each ndarray of the `arrays` dict
+    into its own block of shared memory.
+
+    Returns:
+        - tuple: The list of SharedMemory blocks, which have to be
+            released with `release_shared_memory`, and the dict of
+            specs the workers attach to them with `attach_arrays`.
+    """
+    blocks = []
+    specs = {}
+    try:
+        for name, values in arrays.items():
+            # Zero sized blocks aren't allowed.
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(values.shape, values.dtype, buffer=block.buf)[:] = values
+            specs[name] = (block.name, values.dtype.str, values.shape)
+    except BaseException:
+        release_shared_memory(blocks)
+        raise
+
+    return blocks, specs
+
+
+def attach_arrays(specs):
+    """Helper function which returns the SharedMemory blocks of the
+    `specs` of `share_arrays` and the dict of ndarrays backed by them.
+    """
+    blocks = []
+    arrays = {}
+    for name, (block_name, dtype, shape) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+
+    return blocks, arrays
+
+
+def release_shared_memory(blocks):
+    """Helper function which closes and frees the SharedMemory blocks
+    created by `share_arrays`.
+    """
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def init_shard_worker(column_specs, text_categories):
+    """Initializer of the `ShardedAggregator` worker processes, which
+    attaches to the shared performance columns. Text columns are shared
+    as integer codes and turned back into categoricals of their values.
+    """
+    global _shard_worker_columns, _shard_worker_blocks
+
+    # The blocks have to stay attached for the lifetime of the worker,
+    # the columns are unmapped together with them.
+    _shard_worker_blocks, arrays = attach_arrays(column_specs)
+    _shard_worker_columns = {
+        column: pd.Series(
+            pd.Categorical.from_codes(values, text_categories[column])
+            if column in text_categories
+            else values,
+            copy=False,
+        )
+        for column, values in arrays.items()
+    }
+
+
+def aggregate_shard(
+    ngram, performance_columns, aggregations, incidence_specs, start, stop
+):
+    """Runs `aggregate_incidence` on the occurrences between `start` and
+    `stop` of the shared incidence, in a `ShardedAggregator` worker.
+    """
+    blocks, arrays = attach_arrays(incidence_specs)
+    aggregated_df = aggregate_incidence(
+        _shard_worker_columns,
+        ngram,
+        performance_columns,
+        arrays["row_positions"][start:stop],
+        arrays["ngram_ids"][start:stop],
+        aggregations,
+    )
+
+    # The views have to be gone before the blocks can be closed.
+    del arrays
+    for block in blocks:
+        block.close()
+
+    return aggregated_df
+
+
+class ShardedAggregator:
+    """Aggregates n-gram incidences like `aggregate_incidence`, with the
+    n-grams hash partitioned across `shards` worker processes.
+
+    The performance columns are copied into shared memory once and the
+    incidence of every n-gram column is too, so no DataFrame is ever
+    pickled to the workers - only the aggregated shards come back. Each
+    n-gram falls into exactly one shard, with its occurrences kept in
+    order, so concatenating the shards gives the same output as
+    `aggregate_incidence`.
+
+    Examples:
+        >>> with ShardedAggregator(df, ["link_clicks"], shards=4) as aggregator:
+        ...     aggregator.aggregate("1-gram", row_positions, ngrams)
+    """
+
+    def __init__(
+        self, input_data_df, performance_columns, shards=None, aggregations=None
+    ):
+        self.input_data_df = input_data_df
+        self.performance_columns = performance_columns
+        self.shards = shards or os.cpu_count() or 1
+        self.aggregations = aggregations
+
+        arrays = {}
+        text_categories = {}
+        for column in performance_columns:
+            series = input_data_df[column]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                arrays[column] = series.cat.codes.to_numpy()
+                text_categories[column] = series.cat.categories
+            elif is_text_column(series):
+                arrays[column], text_categories[column] = pd.factorize(series)
+            else:
+                arrays[column] = series.to_numpy()
+
+        self._blocks, column_specs = share_arrays(arrays)
+        try:
+            self._pool = Pool(
+                self.shards,
+                initializer=init_shard_worker,
+                initargs=(column_specs, text_categories),
+            )
+        except BaseException:
+            release_shared_memory(self._blocks)
+            raise
+
+    def aggregate(self, ngram, row_positions, ngrams):
+        """Returns the same DataFrame as `aggregate_incidence` for the
+        incidence of the `ngram` column.
+        """
+        if len(row_positions) == 0:
+            return aggregate_incidence(
+                self.input_data_df,
+                ngram,
+                self.performance_columns,
+                row_positions,
+                ngrams,
+                self.aggregations,
+            )
+
+        # The workers take integer IDs, strings are factorized in their
+        # sort order first.
+        unique_ngrams = None
+        if isinstance(ngrams, np.ndarray) and np.issubdtype(ngrams.dtype, np.integer):
+            ngram_ids = ngrams
+        else:
+            ngram_ids, unique_ngrams = pd.factorize(
+                np.asarray(ngrams, dtype=object), sort=True
+            )
+
+        # The IDs are given out in the order the n-grams are first seen,
+        # so their remainder spreads the n-grams evenly. A stable sort
+        # keeps the occurrences of each n-gram in order.
+        shard_keys = (ngram_ids % self.shards).astype(np.uint16)
+        order = np.argsort(shard_keys, kind="stable")
+        bounds = np.cumsum(np.bincount(shard_keys, minlength=self.shards))
+        blocks, incidence_specs = share_arrays(
+            {
+                "row_positions": np.asarray(row_positions)[order],
+                "ngram_ids": ngram_ids[order],
+            }
+        )
+        try:
+            shard_dfs = self._pool.starmap(
+                aggregate_shard,
+                [
+                    (
+                        ngram,
+                        self.performance_columns,
+                        self.aggregations,
+                        incidence_specs,
+                        start,
+                        stop,
+                    )
+                    for start, stop in zip(chain([0], bounds[:-1]), bounds)
+                    if stop > start
+                ],
+            )
+        finally:
+            release_shared_memory(blocks)
+
+        aggregated_df = pd.concat(shard_dfs).sort_index()
+        if unique_ngrams is not None:
+            aggregated_df.index = pd.Index(
+                unique_ngrams[aggregated_df.index.to_numpy()], name=ngram
+            )
+
+        return aggregated_df
+
+    def close(self):
+        """Stops the worker processes and frees the shared memory."""
+        self._pool.close()
+        self._pool.join()
+        release_shared_memory(self._blocks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class InProcessAggregator:
+    """The `ShardedAggregator` interface for the "vectorized" engine,
+    which calls `aggregate_incidence` directly.
+    """
+
+    def __init__(self, input_data_df, performance_columns, aggregations=None):
+        self.input_data_df = input_data_df
+        self.performance_columns = performance_columns
+        self.aggregations = aggregations
+
+    def aggregate(self, ngram, row_positions, ngrams):
+        return aggregate_incidence(
+            self.input_data_df,
+            ngram,
+            self.performance_columns,
+            row_positions,
+            ngrams,
+            self.aggregations,
+        )
+
+
+def sharded_aggregator(
+    engine, input_data_df, performance_columns, shards=None, aggregations=None
+):
+    """Helper function which returns the context manager of the
+    aggregator for the `engine` - a ShardedAggregator for "sharded",
+    otherwise an InProcessAggregator.
+    """
+    if engine == "sharded":
+        return ShardedAggregator(
+            input_data_df, performance_columns, shards, aggregations
+        )
+
+    return nullcontext(
+        InProcessAggregator(input_data_df, performance_columns, aggregations)
+    )
+
+
+#############################
+# PARTIAL N-GRAM AGGREGATES #
+#############################
+
+
+def aggregate_partial(ngram_performance_df, ngram, aggregations=None):
+    """Helper function which aggregates the long n-gram performance
+    DataFrame into partial aggregates that can be merged later on.
+
+    Numeric columns hold the sums (or maxima, counts, ...), while text
+    columns hold a tuple of the unique values in the order they first
+    appeared, so merging the partials of consecutive chunks gives the
+    same output as aggregating all of the rows at once. See
+    `aggregate_column` for the partial of every aggregation.
+
+    Returns:
+        - DataFrame: Partial aggregates indexed by the n-gram.
+    """
+    performance_columns = [col for col in ngram_performance_df.columns if col != ngram]
+
+    return aggregate_incidence(
+        ngram_performance_df,
+        ngram,
+        performance_columns,
+        np.arange(len(ngram_performance_df)),
+        ngram_performance_df[ngram].to_numpy(),
+        aggregations,
+        partial=True,
+    )
+
+
+def merge_partials(partial_dfs, aggregations=None):
+    """Helper function which merges partial aggregates (as returned by
+    `aggregate_partial`) of the same n-gram order. Sums and counts are
+    added up, maxima and minima are taken again and the unique values
+    are merged.
+    """
+    combined_df = pd.concat(partial_dfs)
+    ngram = combined_df.index.name
+    grouped_df = combined_df.groupby(level=0)
+
+    merged_df = pd.DataFrame(index=grouped_df.size().index)
+    for column in combined_df.columns:
+        aggregation = column_aggregation(column, combined_df[column], aggregations)
+        if aggregation.how in ("max", "min"):
+            merged_df[column] = getattr(grouped_df[column], aggregation.how)()
+        elif aggregation.how in ("join", "first", "nunique"):
+            unique_values_df = (
+                combined_df[column].explode().reset_index().drop_duplicates().dropna()
+            )
+            if aggregation.how == "first":
+                unique_values_df = unique_values_df.groupby(ngram).head(
+                    aggregation.limit
+                )
+            # Only n-grams without any value (for "nunique") get an empty one.
+            merged_df[column] = tuples_by_code(
+                unique_values_df[column].to_numpy(),
+                merged_df.index.get_indexer(unique_values_df[ngram]),
+                len(merged_df),
+            )
+        else:
+            merged_df[column] = grouped_df[column].sum()
+
+    return merged_df
+
+
+def finalize_partial(partial_df, vocabulary=None, pruning=None, aggregations=None):
+    """Helper function which turns partial aggregates into the n-gram
+    performance DataFrame returned by `calculate_ngram_performance`.
+
+    If `pruning` (NgramPruning) is passed, the pruned n-grams are
+    dropped before joining their text values.
+    """
+    ngram = partial_df.index.name
+    if pruning is not None:
+        partial_df = pruning.prune_partial(partial_df)
+    ngram_performance_df = partial_df.reset_index()
+
+    mean_count_columns = []
+    for column, aggregation in (aggregations or {}).items():
+        if aggregation.how == "mean":
+            count_column = mean_count_column(column)
+            ngram_performance_df[column] = np.divide(
+                partial_df[column].to_numpy(dtype=np.float64),
+                partial_df[count_column].to_numpy(dtype=np.float64),
+                out=np.full(len(partial_df), np.nan),
+                where=partial_df[count_column].to_numpy() != 0,
+            )
+            mean_count_columns.append(count_column)
+        elif aggregation.how == "nunique":
+            ngram_performance_df[column] = partial_df[column].map(len).values
+
+    for column in partial_df.columns:
+        aggregation = column_aggregation(column, partial_df[column], aggregations)
+        if aggregation.how in TEXT_AGGREGATIONS:
+            ngram_performance_df[column] = partial_df[column].map(", ".join).values
+
+    ngram_performance_df = ngram_performance_df.drop(columns=mean_count_columns)
+    if vocabulary is not None:
+        return decode_ngram_performance(ngram_performance_df, ngram, vocabulary)
+
+    return ngram_performance_df
+
+
+def finalize_partials(
+    partials, vocabulary=None, pruning=None, stats=None, aggregations=None
+):
+    """Helper function which returns the dict of n-gram column name and
+    n-gram performance DataFrame of the `partials` dict, collecting an
+    "aggregate" stage per n-gram column into the `stats`, if any.
+    """
+    ngram_performance_dict = {}
+    for ngram, partial_df in partials.items():
+        with measure_stage(
+            stats, f"aggregate {ngram}", rows_in=len(partial_df)
+        ) as record:
+            ngram_performance_dict[ngram] = finalize_partial(
+                partial_df, vocabulary, pruning, aggregations
+            )
+            record["rows_out"] = record["unique_ngrams"] = len(
+                ngram_performance_dict[ngram]
+            )
+
+        print(f"Calculation of {ngram} done in {record['seconds']:.2f}s.")
+
+    return ngram_performance_dict
+
+
+def calculate_ngram_partials(
+    input_data_with_ngrams_df,
+    vocabulary=None,
+    collapsed=False,
+    pruning=None,
+    stats=None,
+    aggregations=None,
+):
+    """Helper function which returns a dict of n-gram column name and
+    its partial aggregates for the given DataFrame with n-grams.
+
+    If `collapsed` is set, the rows are already partial aggregates (see
+    `collapse_duplicate_texts`) and are merged instead of aggregated.
+    If `pruning` (NgramPruning) is passed, the pruned n-grams are left
+    out, so only pass it when the DataFrame holds all of the rows.
+    If `stats` (AnalysisStats) are passed, they collect a "partials"
+    stage per n-gram column. `aggregations` are the ColumnAggregation's
+    of `aggregate_incidence`.
+    """
+    ngram_columns, performance_columns = split_ngram_columns(input_data_with_ngrams_df)
+
+    partials = {}
+    for ngram in ngram_columns:
+        with measure_stage(
+            stats, f"partials {ngram}", rows_in=len(input_data_with_ngrams_df)
+        ) as record:
+            if collapsed:
+                ngram_performance_df = explode_ngram_performance(
+                    input_data_with_ngrams_df,
+                    ngram,
+                    performance_columns,
+                    vocabulary,
+                    pruning,
+                )
+                partials[ngram] = merge_partials(
+                    [ngram_performance_df.set_index(ngram)], aggregations
+                )
+            else:
+                row_positions, ngrams = ngram_column_incidence(
+                    input_data_with_ngrams_df, ngram, vocabulary, pruning
+                )
+                partials[ngram] = aggregate_incidence(
+                    input_data_with_ngrams_df,
+                    ngram,
+                    performance_columns,
+                    row_positions,
+                    ngrams,
+                    aggregations,
+                    partial=True,
+                )
+            record["rows_out"] = record["unique_ngrams"] = len(partials[ngram])
+
+    return partials
+
+
+def collapse_duplicate_texts(input_data_cleaned_df, aggregations=None):
+    """Helper function which collapses the rows with identical
+    `cleaned_text` into one, carrying the partial aggregates of their
+    performance - summed numeric columns and the unique text values.
+
+    Returns:
+        - DataFrame: `cleaned_text` followed by the performance columns,
+            one row per unique `cleaned_text`.
+    """
+    _, performance_columns = split_ngram_columns(input_data_cleaned_df)
+
+    return aggregate_partial(
+        input_data_cleaned_df[["cleaned_text"] + performance_columns],
+        "cleaned_text",
+        aggregations,
+    ).reset_index()
+
+
+def create_ngrams_deduplicated(
+    input_data_cleaned_df,
+    start=1,
+    end=4,
+    vocabulary=None,
+    stats=None,
+    aggregations=None,
+    pruning=None,
+):
+    """Counterpart of `create_ngrams` which creates the n-grams only
+    once per unique `cleaned_text`. A `pruning` is used like in
+    `create_ngrams`.
+
+    Returns:
+        - tuple: The collapsed DataFrame with n-grams (see
+            `collapse_duplicate_texts`), to be aggregated with
+            `calculate_ngram_partials(..., collapsed=True)`, and
+            `input_data_cleaned_df` with the same n-gram sets added to
+            each of its rows.
+    """
+    collapsed_df = create_ngrams(
+        collapse_duplicate_texts(input_data_cleaned_df, aggregations),
+        start=start,
+        end=end,
+        vocabulary=vocabulary,
+        stats=stats,
+        pruning=pruning,
+    )
+
+    ngram_sets_df = collapsed_df.set_index("cleaned_text")
+    for n in range(start, end + 1):
+        n_gram = f"{n}-gram"
+        input_data_cleaned_df[n_gram] = input_data_cleaned_df["cleaned_text"].map(
+            ngram_sets_df[n_gram]
+        )
+
+    return collapsed_df, input_data_cleaned_df
+
+
+def calculate_ngram_performance_deduplicated(
+    input_data_cleaned_df,
+    start=1,
+    end=4,
+    vocabulary=None,
+    pruning=None,
+    stats=None,
+    include_processed_data=True,
+    aggregations=None,
+):
+    """Counterpart of `create_ngrams` and `calculate_ngram_performance`
+    for inputs where the same text repeats many times (e.g. the same
+    search term across campaigns or dates).
+
+    Rows with identical `cleaned_text` are collapsed first, so the
+    n-grams are created and exploded only once per unique text. The
+    aggregated numbers and the unique text values are the same as
+    without the deduplication, although the joined text values may be
+    listed in a different order.
+
+    Args:
+        - input_data_cleaned_df (DataFrame): The output of
+            `clean_input_data`.
+        - start (int, optional): Smallest n of the n-grams. Defaults to 1.
+        - end (int, optional): Largest n of the n-grams. Defaults to 4.
+        - vocabulary (NgramVocabulary, optional): Passed to
+            `create_ngrams`. Defaults to None.
+        - pruning (NgramPruning, optional): If passed, the rare n-grams
+            are dropped before they are aggregated. Defaults to None.
+        - stats (AnalysisStats, optional): Collects the stages.
+            Defaults to None.
+        - include_processed_data (bool, optional): If set, the processed
+            rows are returned as the "Original Processed Data".
+            Defaults to True.
+        - aggregations (dict, optional): The ColumnAggregation's of the
+            columns which aren't aggregated by default, see
+            `aggregate_column`. Defaults to None.
+
+    Returns:
+        - dict: The same dictionary as `calculate_ngram_performance`.
+    """
+    collapsed_df, input_data_with_ngrams_df = create_ngrams_deduplicated(
+        input_data_cleaned_df,
+        start=start,
+        end=end,
+        vocabulary=vocabulary,
+        stats=stats,
+        aggregations=aggregations,
+        pruning=pruning,
+    )
+    print(
+        f"Collapsed {len(input_data_with_ngrams_df)} rows "
+        f"into {len(collapsed_df)} unique texts."
+    )
+
+    ngram_performance_dict = finalize_partials(
+        calculate_ngram_partials(
+            collapsed_df,
+            vocabulary,
+            collapsed=True,
+            pruning=pruning,
+            stats=stats,
+            aggregations=aggregations,
+        ),
+        vocabulary,
+        stats=stats,
+        aggregations=aggregations,
+    )
+
+    if include_processed_data:
+        ngram_performance_dict["Original Processed Data"] = processed_data(
+            input_data_with_ngrams_df, vocabulary
+        )
+
+    return ngram_performance_dict
+
+
+def merge_partials_into(partials, new_partials, aggregations=None):
+    """Helper function which merges the `new_partials` dict of n-gram
+    column name and partial aggregates into the `partials` dict.
+    """
+    for ngram, partial_df in new_partials.items():
+        if ngram in partials:
+            partial_df = merge_partials([partials[ngram], partial_df], aggregations)
+        partials[ngram] = partial_df
+
+
+def calculate_raw_data_partials(
+    input_data_df,
+    vocabulary,
+    lemmatize=False,
+    lemmatizer=None,
+    start=1,
+    end=4,
+    deduplicate=False,
+    stats=None,
+    aggregations=None,
+):
+    """Helper function which cleans the raw input data, creates its
+    n-grams and aggregates them into partial aggregates.
+
+    Returns:
+        - tuple: The dict of n-gram column name and partial aggregates,
+            and the cleaned input data with the n-gram columns.
+    """
+    input_data_cleaned_df = clean_input_data(
+        input_data_df, lemmatize=lemmatize, lemmatizer=lemmatizer, stats=stats
+    )
+    if deduplicate:
+        collapsed_df, input_data_with_ngrams_df = create_ngrams_deduplicated(
+            input_data_cleaned_df,
+            start=start,
+            end=end,
+            vocabulary=vocabulary,
+            stats=stats,
+            aggregations=aggregations,
+        )
+        partials = calculate_ngram_partials(
+            collapsed_df,
+            vocabulary,
+            collapsed=True,
+            stats=stats,
+            aggregations=aggregations,
+        )
+    else:
+        input_data_with_ngrams_df = create_ngrams(
+            input_data_cleaned_df,
+            start=start,
+            end=end,
+            vocabulary=vocabulary,
+            stats=stats,
+        )
+        partials = calculate_ngram_partials(
+            input_data_with_ngrams_df,
+            vocabulary,
+            stats=stats,
+            aggregations=aggregations,
+        )
+
+    return partials, input_data_with_ngrams_df
+
+
+def calculate_ngram_performance_in_chunks(
+    input_data_chunks,
+    lemmatize=False,
+    start=1,
+    end=4,
+    lemmatizer=None,
+    deduplicate=False,
+    pruning=None,
+    stats=None,
+    aggregations=None,
+):
+    """Chunked counterpart of cleaning, creating n-grams and
+    `calculate_ngram_performance` for inputs larger than the memory.
+
+    Every chunk is processed separately into partial aggregates which
+    are merged into the running total, so only the partial aggregates
+    and a single chunk's n-grams are held at once. The output is the
+    same as running the pipeline on all of the rows at once, except
+    that the "Original Processed Data" isn't kept.
+
+    Args:
+        - input_data_chunks (iterable): Iterable of raw input DataFrames,
+            e.g. `pd.read_csv(input_file, chunksize=100000)`.
+        - lemmatize (bool, optional): Passed to `clean_input_data`.
+            Defaults to False.
+        - start (int, optional): Smallest n of the n-grams. Defaults to 1.
+        - end (int, optional): Largest n of the n-grams. Defaults to 4.
+        - lemmatizer (Lemmatizer, optional): Passed to
+            `clean_input_data`. Should be passed when lemmatizing, so
+            one worker pool serves all of the chunks. Defaults to None.
+        - deduplicate (bool, optional): If set, rows with identical
+            `cleaned_text` are collapsed within each chunk before
+            creating the n-grams, like in
+            `calculate_ngram_performance_deduplicated`.
+            Defaults to False.
+        - pruning (NgramPruning, optional): If passed, the rare n-grams
+            are dropped from the merged partial aggregates, since the
+            support of an n-gram is only known after the last chunk.
+            Defaults to None.
+        - stats (AnalysisStats, optional): Collects the stages of every
+            chunk. Defaults to None.
+        - aggregations (dict, optional): The ColumnAggregation's of the
+            columns which aren't aggregated by default, see
+            `aggregate_column`. Defaults to None.
+
+    Returns:
+        - dict: The same dictionary as `calculate_ngram_performance`,
+            without the "Original Processed Data".
+    """
+    vocabulary = NgramVocabulary()
+    partials = {}
+
+    for chunk_number, input_data_df in enumerate(input_data_chunks, 1):
+        chunk_partials, _ = calculate_raw_data_partials(
+            input_data_df,
+            vocabulary,
+            lemmatize=lemmatize,
+            lemmatizer=lemmatizer,
+            start=start,
+            end=end,
+            deduplicate=deduplicate,
+            stats=stats,
+            aggregations=aggregations,
+        )
+        merge_partials_into(partials, chunk_partials, aggregations)
+        print(f"Chunk {chunk_number} done.")
+
+    return finalize_partials(partials, vocabulary, pruning, stats, aggregations)
+
+
+########################
+# INCREMENTAL ANALYSIS #
+########################
+
+# Bumped whenever the layout of the incremental state changes.
+INCREMENTAL_STATE_VERSION = 1
+
+
+def row_fingerprints(input_data_df):
+    """Helper function which fingerprints every row of the raw input
+    data. Identical rows get the same fingerprint, so the fingerprint is
+    paired with the row's occurrence number to tell the copies apart.
+
+    Returns:
+        - tuple: The fingerprint (uint64 ndarray) and the occurrence
+            number (int64 ndarray) of each row.
+    """
+    # The dtypes of `read_input_data` depend on the values, so the same
+    # row has to get the same fingerprint however it was read.
+    normalized_df = input_data_df.apply(
+        lambda column: column.astype(object)
+        if is_text_column(column)
+        else upcast_for_sum(column)
+    )
+    fingerprints = pd.util.hash_pandas_object(normalized_df, index=False).to_numpy()
+    occurrences = pd.Series(fingerprints).groupby(fingerprints).cumcount().to_numpy()
+
+    return fingerprints, occurrences
+
+
+def load_incremental_state(state_file, settings):
+    """Helper function which loads the incremental state, or returns
+    None when there's none or it was created with other `settings`.
+    """
+    if not os.path.exists(state_file):
+        return None
+
+    state = pd.read_pickle(state_file)
+    if (
+        state.get("version") != INCREMENTAL_STATE_VERSION
+        or state.get("settings") != settings
+    ):
+        print(f"{state_file} was created with other settings, starting over.")
+        return None
+
+    return state
+
+
+def save_incremental_state(state, state_file):
+    temporary_path = f"{state_file}.{os.getpid()}.tmp"
+    pd.to_pickle(state, temporary_path)
+    os.replace(temporary_path, state_file)
+
+
+def calculate_ngram_performance_incremental(
+    input_data_df,
+    state_file,
+    lemmatize=False,
+    lemmatizer=None,
+    start=1,
+    end=4,
+    deduplicate=False,
+    pruning=None,
+    stats=None,
+    aggregations=None,
+):
+    """Incremental counterpart of cleaning, creating n-grams and
+    `calculate_ngram_performance` for an export that grows between runs.
+
+    The partial aggregates of the previous run (numeric sums and unique
+    text values of every n-gram) are stored in the local `state_file`,
+    along with the fingerprints of the rows they were built from. A
+    rerun only processes the rows that aren't in the state yet and
+    merges them in, so it takes time proportional to the new rows.
+
+    If any of the previously seen rows is gone or was modified, the
+    state can't be updated and everything is calculated from scratch.
+
+    Args:
+        - input_data_df (DataFrame): The whole raw input data.
+        - state_file (str): The relative path to the state file. It is
+            created if it doesn't exist. It's a pickle, so only use
+            state files you've created yourself.
+        - lemmatize (bool, optional): Passed to `clean_input_data`.
+            Defaults to False.
+        - lemmatizer (Lemmatizer, optional): Passed to
+            `clean_input_data`. Defaults to None.
+        - start (int, optional): Smallest n of the n-grams. Defaults to 1.
+        - end (int, optional): Largest n of the n-grams. Defaults to 4.
+        - deduplicate (bool, optional): Passed to
+            `calculate_raw_data_partials`. Defaults to False.
+        - pruning (NgramPruning, optional): If passed, the rare n-grams
+            are dropped from the output. The state keeps all of them,
+            since they may become frequent later on. Defaults to None.
+        - stats (AnalysisStats, optional): Collects the stages.
+            Defaults to None.
+        - aggregations (dict, optional): The ColumnAggregation's of the
+            columns which aren't aggregated by default, see
+            `aggregate_column`. Defaults to None.
+
+    Returns:
+        - dict: The same dictionary as `calculate_ngram_performance`,
+            without the "Original Processed Data".
+    """
+    settings = {
+        "columns": input_data_df.columns.tolist(),
+        "lemmatize": lemmatize,
+        "start": start,
+        "end": end,
+        "aggregations": dict(aggregations or {}),
+    }
+    fingerprints, occurrences = row_fingerprints(input_data_df)
+    fingerprint_counts = pd.Series(fingerprints).value_counts()
+
+    state = load_incremental_state(state_file, settings)
+    if state is not None:
+        seen_counts = state["fingerprint_counts"]
+        missing_counts = seen_counts.sub(
+            fingerprint_counts.reindex(seen_counts.index, fill_value=0)
+        )
+        if (missing_counts > 0).any():
+            print(
+                f"Some rows of {state_file} are missing from the input, "
+                "starting over."
+            )
+            state = None
+
+    if state is None:
+        state = {
+            "version": INCREMENTAL_STATE_VERSION,
+            "settings": settings,
+            "vocabulary": NgramVocabulary(),
+            "partials": {},
+            "fingerprint_counts": pd.Series(dtype=np.int64),
+        }
+
+    seen_counts = pd.Series(fingerprints).map(state["fingerprint_counts"])
+    is_new_row = occurrences >= seen_counts.fillna(0).to_numpy()
+    new_rows_df = input_data_df[is_new_row]
+    print(f"Processing {len(new_rows_df)} new out of {len(input_data_df)} rows.")
+
+    if len(new_rows_df):
+        new_partials, _ = calculate_raw_data_partials(
+            new_rows_df,
+            state["vocabulary"],
+            lemmatize=lemmatize,
+            lemmatizer=lemmatizer,
+            start=start,
+            end=end,
+            deduplicate=deduplicate,
+            stats=stats,
+            aggregations=aggregations,
+        )
+        merge_partials_into(state["partials"], new_partials, aggregations)
+        state["fingerprint_counts"] = fingerprint_counts
+        save_incremental_state(state, state_file)
+
+    return finalize_partials(
+        state["partials"], state["vocabulary"], pruning, stats, aggregations
+    )
+
+
+################
+# N-GRAM STORE #
+################
+
+
+# Bumped whenever the layout of the n-gram store changes.
+NGRAM_STORE_VERSION = 1
+
+
+class NgramStore:
+    """On-disk columnar store of the tokenized corpus and the (row,
+    n-gram) incidence of every n-gram order of an input, so repeated
+    analyses of the same file (with other metrics, filters, pruning or
+    n-gram ranges) don't clean and tokenize it again.
+
+    Every array is a .npy file in the `directory`, loaded as a read-only
+    memory map, so the incidence is read zero-copy and only the pages
+    that are used get loaded:
+
+    * `token_offsets`, `token_ids` - the token IDs of each row, see
+        `encode_corpus`.
+    * `tokens.json`, `prefixes`, `last_tokens` - the NgramVocabulary.
+    * `{n}-gram.rows`, `{n}-gram.ids` - the positional rows (int32) and
+        the n-gram IDs (int32, or int64 for huge vocabularies) of the
+        incidence, see `create_ngram_incidence`.
+    * `text_hashes` - the hash of each raw text, to tell whether the
+        store was built from the same input.
+    * `metadata.json` - written last, so a store is only used once it
+        is complete.
+
+    Examples:
+        >>> store = NgramStore("ads_store")
+        >>> store.is_built_from(text_hashes, lemmatize=False)
+        True
+        >>> row_positions, ngram_ids = store.incidence(2)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.metadata = self.load_metadata()
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def load_metadata(self):
+        try:
+            with open(self.path("metadata.json"), encoding="utf-8") as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if metadata.get("version") != NGRAM_STORE_VERSION:
+            return None
+
+        return metadata
+
+    def save_metadata(self, metadata):
+        tmp_path = self.path("metadata.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, self.path("metadata.json"))
+        self.metadata = metadata
+
+    def load_array(self, name):
+        return np.load(self.path(f"{name}.npy"), mmap_mode="r")
+
+    def save_array(self, name, values):
+        # Replaced instead of overwritten, the arrays of an earlier run
+        # may still be mapped.
+        tmp_path = self.path(f"{name}.npy.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, values)
+        os.replace(tmp_path, self.path(f"{name}.npy"))
+
+    @property
+    def ngram_orders(self):
+        return set(self.metadata["ngram_orders"]) if self.metadata else set()
+
+    def is_built_from(self, text_hashes, lemmatize):
+        """Tells whether the store holds the corpus of the raw texts
+        with the `text_hashes`, cleaned with the same settings.
+        """
+        return (
+            self.metadata is not None
+            and self.metadata["lemmatize"] == lemmatize
+            and self.metadata["rows"] == len(text_hashes)
+            and np.array_equal(self.load_array("text_hashes"), text_hashes)
+        )
+
+    def incidence(self, n):
+        """Returns the memory-mapped row positions and n-gram IDs of the
+        n-grams of order `n`.
+        """
+        return self.load_array(f"{n}-gram.rows"), self.load_array(f"{n}-gram.ids")
+
+    def load_vocabulary(self):
+        with open(self.path("tokens.json"), encoding="utf-8") as f:
+            tokens = json.load(f)
+
+        return NgramVocabulary.from_arrays(
+            tokens, self.load_array("prefixes"), self.load_array("last_tokens")
+        )
+
+    def save(
+        self, vocabulary, ngram_incidences, corpus=None, text_hashes=None, **metadata
+    ):
+        """Saves the vocabulary and the incidence of the n-gram orders,
+        and the corpus and the text hashes of a new store, then updates
+        the metadata.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if self.metadata is not None and corpus is not None:
+            # A new store, the old one mustn't be used while it's half
+            # overwritten.
+            os.remove(self.path("metadata.json"))
+            self.metadata = None
+
+        if corpus is not None:
+            token_offsets, token_ids = corpus
+            self.save_array("token_offsets", token_offsets)
+            self.save_array("token_ids", token_ids.astype(np.int32))
+            self.save_array("text_hashes", text_hashes)
+
+        with open(self.path("tokens.json"), "w", encoding="utf-8") as f:
+            json.dump(vocabulary.tokens, f)
+        self.save_array("prefixes", np.asarray(vocabulary.prefixes, dtype=np.int64))
+        self.save_array(
+            "last_tokens", np.asarray(vocabulary.last_tokens, dtype=np.int32)
+        )
+
+        ngram_dtype = np.int32 if len(vocabulary) < 2**31 else np.int64
+        for ngram, (row_positions, ngram_ids) in ngram_incidences.items():
+            self.save_array(f"{ngram}.rows", row_positions.astype(np.int32))
+            self.save_array(f"{ngram}.ids", ngram_ids.astype(ngram_dtype))
+
+        ngram_orders = self.ngram_orders.union(
+            int(ngram.split("-")[0]) for ngram in ngram_incidences
+        )
+        self.save_metadata(
+            {
+                **(self.metadata or {}),
+                **metadata,
+                "version": NGRAM_STORE_VERSION,
+                "ngram_orders": sorted(ngram_orders),
+            }
+        )
+
+
+def load_ngram_store(
+    input_data_df,
+    store_directory,
+    lemmatize=False,
+    lemmatizer=None,
+    start=1,
+    end=4,
+    stats=None,
+):
+    """Returns the incidence of the n-grams of the raw `input_data_df`
+    from the NgramStore in `store_directory`, building it first if it
+    was built from other texts (or doesn't exist yet). Missing n-gram
+    orders are added from the stored tokens, without cleaning again.
+
+    Returns:
+        - tuple: The input data (see `prepare_input_data`), the
+            NgramVocabulary and the dict of n-gram column name and its
+            incidence, as returned by `create_ngram_incidence`.
+    """
+    text_hashes = pd.util.hash_pandas_object(
+        input_data_df.iloc[:, 0], index=False
+    ).to_numpy()
+    store = NgramStore(store_directory)
+    ngram_orders = range(start, end + 1)
+
+    if store.is_built_from(text_hashes, lemmatize):
+        print(f"Reusing the n-gram store {store_directory}.")
+        input_data_prepared_df = prepare_input_data(input_data_df)
+        with measure_stage(stats, "load store") as record:
+            vocabulary = store.load_vocabulary()
+            record["unique_ngrams"] = len(vocabulary)
+
+        missing_orders = [n for n in ngram_orders if n not in store.ngram_orders]
+        if missing_orders:
+            print(f"Adding the {missing_orders} n-grams to the store.")
+            with measure_stage(
+                stats, "create_ngrams", rows_in=len(input_data_prepared_df)
+            ) as record:
+                new_incidences = corpus_ngram_incidence(
+                    store.load_array("token_offsets"),
+                    store.load_array("token_ids"),
+                    vocabulary,
+                    min(missing_orders),
+                    max(missing_orders),
+                )
+                store.save(
+                    vocabulary,
+                    {f"{n}-gram": new_incidences[f"{n}-gram"] for n in missing_orders},
+                )
+                record["unique_ngrams"] = len(vocabulary)
+    else:
+        print(f"Building the n-gram store {store_directory}...")
+        input_data_prepared_df = clean_input_data(
+            input_data_df, lemmatize=lemmatize, lemmatizer=lemmatizer, stats=stats
+        )
+        vocabulary = NgramVocabulary()
+        with measure_stage(
+            stats, "create_ngrams", rows_in=len(input_data_prepared_df)
+        ) as record:
+            corpus = encode_corpus(input_data_prepared_df["cleaned_text"], vocabulary)
+            store.save(
+                vocabulary,
+                corpus_ngram_incidence(*corpus, vocabulary, start, end),
+                corpus=corpus,
+                text_hashes=text_hashes,
+                rows=len(text_hashes),
+                lemmatize=lemmatize,
+            )
+            record["unique_ngrams"] = len(vocabulary)
+
+    ngram_incidences = {f"{n}-gram": store.incidence(n) for n in ngram_orders}
+
+    return input_data_prepared_df, vocabulary, ngram_incidences
+
+
+########################
+# APPROXIMATE ANALYSIS #
+########################
+
+
+# How many rows are read at once by the approximate analysis of a file.
+SKETCH_CHUNKSIZE = 100000
+
+# The candidates of the heavy hitters tracked per n-gram order, per n-gram
+# of the top K.
+SKETCH_CANDIDATES_PER_TOP_K = 10
+
+# Multiplier of the polynomial hash of the token IDs of an n-gram, and the
+# constants of the splitmix64 finalizer mixing its bits.
+NGRAM_HASH_MULTIPLIER = np.uint64(0x100000001B3)
+SPLITMIX_MULTIPLIERS = (np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB))
+
+
+def ngram_hashes(token_offsets, token_ids, n):
+    """Helper function which hashes the n-grams of order `n` of texts
+    encoded with `encode_corpus` into 64-bit integers, without adding
+    them to a vocabulary.
+
+    Returns:
+        - tuple: The positional rows, the hashes (uint64) and the
+            positions of the first token of the unique n-grams of each
+            row.
+    """
+    token_offsets = np.asarray(token_offsets)
+    token_ids = np.asarray(token_ids).astype(np.uint64)
+    token_counts = np.diff(token_offsets)
+    token_rows = np.repeat(np.arange(len(token_counts)), token_counts)
+    # Only the n-grams which end in the same row start at these tokens.
+    ngram_starts = np.flatnonzero(
+        np.arange(len(token_ids)) + n <= token_offsets[1:][token_rows]
+    )
+
+    hashes = np.zeros(len(ngram_starts), dtype=np.uint64)
+    for offset in range(n):
+        hashes = hashes * NGRAM_HASH_MULTIPLIER + token_ids[ngram_starts + offset] + 1
+    for shift, multiplier in zip((30, 27), SPLITMIX_MULTIPLIERS):
+        hashes = (hashes ^ (hashes >> np.uint64(shift))) * multiplier
+    hashes ^= hashes >> np.uint64(31)
+
+    # Keep each n-gram once per row, like `NgramVocabulary.encode_ngram_range`.
+    rows = token_rows[ngram_starts]
+    order = np.lexsort((hashes, rows))
+    rows, hashes, ngram_starts = rows[order], hashes[order], ngram_starts[order]
+    is_first = np.ones(len(rows), dtype=bool)
+    is_first[1:] = (rows[1:] != rows[:-1]) | (hashes[1:] != hashes[:-1])
+
+    return rows[is_first], hashes[is_first], ngram_starts[is_first]
+
+
+class CountMinSketch:
+    """Fixed-size table of approximate sums of a non-negative metric per
+    hashed key, taking `depth` x `width` floats however many keys there
+    are.
+
+    Every key is added to one cell of each of the `depth` rows, and its
+    estimate is the smallest of its cells. An estimate is never below
+    the true sum, and with a probability of at least `confidence` it's
+    above it by at most `error_bound` (e / `width` of the total).
+
+    Examples:
+        >>> sketch = CountMinSketch(width=2 ** 18, depth=4)
+        >>> sketch.add(hashes, weights)
+        >>> sketch.estimate(hashes)
+    """
+
+    def __init__(self, width=2**18, depth=4, seed=0):
+        self.table = np.zeros((depth, width), dtype=np.float64)
+        # Odd multipliers of the multiply-shift hash of each row.
+        self.multipliers = np.random.default_rng(seed).integers(
+            0, 2**64, size=depth, dtype=np.uint64, endpoint=False
+        ) | np.uint64(1)
+        self.total = 0.0
+
+    @property
+    def width(self):
+        return self.table.shape[1]
+
+    @property
+    def depth(self):
+        return self.table.shape[0]
+
+    @property
+    def error_bound(self):
+        return np.e / self.width * self.total
+
+    @property
+    def confidence(self):
+        return 1 - np.exp(-self.depth)
+
+    def buckets(self, hashes, row):
+        buckets = ((hashes * self.multipliers[row]) >> np.uint64(32)) % np.uint64(
+            self.width
+        )
+
+        return buckets.astype(np.int64)
+
+    def add(self, hashes, weights):
+        for row in range(self.depth):
+            self.table[row] += np.bincount(
+                self.buckets(hashes, row), weights=weights, minlength=self.width
+            )
+        self.total += float(np.sum(weights))
+
+    def estimate(self, hashes):
+        estimates = np.full(len(hashes), np.inf)
+        for row in range(self.depth):
+            np.minimum(
+                estimates, self.table[row][self.buckets(hashes, row)], out=estimates
+            )
+
+        return estimates
+
+
+def rank_weights(input_data_prepared_df, rank_by):
+    """Helper function which returns the `rank_by` metric of every row
+    as the float64 weights of a CountMinSketch.
+
+    Raises:
+        - ValueError: When `rank_by` isn't a numeric performance column
+            or has negative values.
+    """
+    if rank_by not in input_data_prepared_df.columns or is_text_column(
+        input_data_prepared_df[rank_by]
+    ):
+        raise ValueError(f"Can't rank the n-grams by column {rank_by!r}.")
+
+    weights = np.nan_to_num(input_data_prepared_df[rank_by].to_numpy(dtype=np.float64))
+    if (weights < 0).any():
+        raise ValueError(
+            f"Can't rank the n-grams by column {rank_by!r} approximately, "
+            f"it has negative values."
+        )
+
+    return weights
+
+
+def calculate_ngram_performance_approximate(
+    read_input_chunks,
+    top_k,
+    rank_by="Unique Occurences",
+    start=1,
+    end=4,
+    width=2**18,
+    depth=4,
+    lemmatize=False,
+    lemmatizer=None,
+    stats=None,
+    aggregations=None,
+):
+    """Counterpart of `calculate_ngram_performance_in_chunks` which
+    returns only the `top_k` n-grams by `rank_by` of each n, with a
+    memory ceiling that doesn't grow with the number of unique n-grams.
+
+    The input is read twice. The first pass adds the `rank_by` metric of
+    the hashed n-grams (see `ngram_hashes`) into a CountMinSketch per n,
+    and keeps the `SKETCH_CANDIDATES_PER_TOP_K` x `top_k` n-grams with
+    the highest estimates as the candidates of the heavy hitters. The
+    second pass aggregates only the candidates, exactly, and the top K
+    of them are returned. Only the tokens are kept in a vocabulary, so
+    it's the number of unique words that still takes memory.
+
+    Args:
+        - read_input_chunks (callable): Returns an iterable of raw input
+            DataFrames, called once for each pass, e.g.
+            `lambda: read_input_data(input_file, chunksize=100000)`.
+        - top_k (int): How many n-grams of each n are returned.
+        - rank_by (str, optional): The numeric, non-negative metric the
+            n-grams are ranked by. Defaults to "Unique Occurences".
+        - start (int, optional): Smallest n of the n-grams. Defaults to 1.
+        - end (int, optional): Largest n of the n-grams. Defaults to 4.
+        - width (int, optional): The width of the sketches, the error
+            bound shrinks with it. Defaults to 2 ** 18.
+        - depth (int, optional): The depth of the sketches, the
+            confidence grows with it. Defaults to 4.
+        - lemmatize (bool, optional): Passed to `clean_input_data`.
+            Defaults to False.
+        - lemmatizer (Lemmatizer, optional): Passed to
+            `clean_input_data`. Defaults to None.
+        - stats (AnalysisStats, optional): Collects the stages of both
+            passes. Defaults to None.
+        - aggregations (dict, optional): The ColumnAggregation's of the
+            columns which aren't aggregated by default, see
+            `aggregate_column`. Defaults to None.
+
+    Returns:
+        - dict: The same dictionary as `calculate_ngram_performance`
+            with only the top K n-grams, without the "Original Processed
+            Data". The aggregates are exact, the `attrs` of each
+            DataFrame hold the "error_bound" and the "confidence" of the
+            sketch estimates which the candidates were picked by.
+
+    Raises:
+        - ValueError: When there's no `top_k`, or `rank_by` isn't a
+            numeric non-negative performance column.
+    """
+    if not top_k:
+        raise ValueError("The approximate analysis requires the top_k.")
+
+    ngram_orders = range(start, end + 1)
+    candidate_count = SKETCH_CANDIDATES_PER_TOP_K * top_k
+    sketches = {n: CountMinSketch(width, depth, seed=n) for n in ngram_orders}
+    candidates = {n: np.empty(0, dtype=np.uint64) for n in ngram_orders}
+    vocabulary = NgramVocabulary()
+
+    for chunk_number, input_data_df in enumerate(read_input_chunks(), 1):
+        input_data_cleaned_df = clean_input_data(
+            input_data_df, lemmatize=lemmatize, lemmatizer=lemmatizer, stats=stats
+        )
+        with measure_stage(
+            stats, "sketch", rows_in=len(input_data_cleaned_df)
+        ) as record:
+            weights = rank_weights(input_data_cleaned_df, rank_by)
+            corpus = encode_corpus(input_data_cleaned_df["cleaned_text"], vocabulary)
+            for n in ngram_orders:
+                rows, hashes, _ = ngram_hashes(*corpus, n)
+                sketches[n].add(hashes, weights[rows])
+                # The estimates only grow, so the candidates are picked
+                # again from the old ones and the n-grams of this chunk.
+                chunk_candidates = np.union1d(candidates[n], hashes)
+                estimates = sketches[n].estimate(chunk_candidates)
+                if len(chunk_candidates) > candidate_count:
+                    chunk_candidates = chunk_candidates[
+                        np.argpartition(-estimates, candidate_count)[:candidate_count]
+                    ]
+                candidates[n] = chunk_candidates
+            record["unique_ngrams"] = sum(map(len, candidates.values()))
+        print(f"Sketched chunk {chunk_number} in {record['seconds']:.2f}s.")
+
+    partials = {}
+    ngram_names = {n: {} for n in ngram_orders}
+    for chunk_number, input_data_df in enumerate(read_input_chunks(), 1):
+        input_data_cleaned_df = clean_input_data(
+            input_data_df, lemmatize=lemmatize, lemmatizer=lemmatizer, stats=stats
+        )
+        _, performance_columns = split_ngram_columns(input_data_cleaned_df)
+        with measure_stage(
+            stats, "partials", rows_in=len(input_data_cleaned_df)
+        ) as record:
+            token_offsets, token_ids = encode_corpus(
+                input_data_cleaned_df["cleaned_text"], vocabulary
+            )
+            for n in ngram_orders:
+                rows, hashes, ngram_starts = ngram_hashes(token_offsets, token_ids, n)
+                is_candidate = np.isin(hashes, candidates[n])
+                rows, hashes = rows[is_candidate], hashes[is_candidate]
+                # The same bits as int64, which pandas groups natively.
+                ngram_ids = hashes.view(np.int64)
+
+                names = ngram_names[n]
+                for ngram_id, ngram_start in zip(
+                    ngram_ids.tolist(), ngram_starts[is_candidate].tolist()
+                ):
+                    if ngram_id not in names:
+                        names[ngram_id] = " ".join(
+                            vocabulary.tokens[token_id]
+                            for token_id in token_ids[ngram_start : ngram_start + n]
+                        )
+
+                merge_partials_into(
+                    partials,
+                    {
+                        f"{n}-gram": aggregate_incidence(
+                            input_data_cleaned_df,
+                            f"{n}-gram",
+                            performance_columns,
+                            rows,
+                            ngram_ids,
+                            aggregations,
+                            partial=True,
+                        )
+                    },
+                    aggregations,
+                )
+            record["unique_ngrams"] = sum(map(len, partials.values()))
+        print(f"Aggregated the candidates of chunk {chunk_number}.")
+
+    ngram_performance_dict = finalize_partials(
+        partials,
+        pruning=NgramPruning(top_k=top_k, rank_by=rank_by),
+        stats=stats,
+        aggregations=aggregations,
+    )
+    for n in ngram_orders:
+        ngram = f"{n}-gram"
+        ngram_performance_df = ngram_performance_dict[ngram]
+        ngram_performance_df[ngram] = ngram_performance_df[ngram].map(ngram_names[n])
+        ngram_performance_df = ngram_performance_df.sort_values(
+            ngram, ignore_index=True
+        )
+        ngram_performance_df.attrs.update(
+            error_bound=sketches[n].error_bound, confidence=sketches[n].confidence
+        )
+        ngram_performance_dict[ngram] = ngram_performance_df
+        print(
+            f"The estimates the {ngram}s were picked by are off by at most "
+            f"{sketches[n].error_bound:.6g} {rank_by} with a "
+            f"{sketches[n].confidence:.1%} probability."
+        )
+
+    return ngram_performance_dict
+
+
+###################
+# DERIVED METRICS #
+###################
+
+
+DerivedMetric = namedtuple("DerivedMetric", ["name", "numerator", "denominator"])
+
+# Words in a column name which suggest it's already a ratio, and so its
+# sum over the n-grams means nothing.
+RATIO_COLUMN_WORDS = {
+    "ctr",
+    "cpc",
+    "cpa",
+    "cpm",
+    "cpv",
+    "roas",
+    "roi",
+    "rate",
+    "ratio",
+    "avg",
+    "average",
+    "per",
+    "percent",
+    "percentage",
+}
+
+
+def parse_derived_metric(spec):
+    """Parses a derived metric given as "NAME=NUMERATOR/DENOMINATOR",
+    e.g. "CTR=Clicks/Impressions", into a DerivedMetric. Column names may
+    contain spaces, but not a "/".
+
+    Raises:
+        - ValueError: When `spec` isn't in the format above.
+    """
+    name, equals_sign, ratio = spec.partition("=")
+    numerator, slash, denominator = ratio.partition("/")
+    name, numerator, denominator = name.strip(), numerator.strip(), denominator.strip()
+    if not (equals_sign and slash and name and numerator and denominator) or (
+        "/" in denominator
+    ):
+        raise ValueError(
+            f"Invalid derived metric {spec!r}, expected NAME=NUMERATOR/DENOMINATOR "
+            f"like 'CTR=Clicks/Impressions'."
+        )
+
+    return DerivedMetric(name, numerator, denominator)
+
+
+def warn_ratio_like_columns(input_data_df):
+    """Warns about the performance columns which look like they are
+    already a ratio (CTR, Cost per Conversion, ...), as they are summed
+    up like every other numeric column. They should be given as derived
+    metrics instead.
+    """
+    for column in input_data_df.columns[1:]:
+        if is_text_column(input_data_df[column]):
+            continue
+        words = set(re.split(r"[^a-z0-9%]+", str(column).lower()))
+        if "%" in str(column) or words & RATIO_COLUMN_WORDS:
+            warnings.warn(
+                f"The column {column!r} looks like a ratio, its sum over the "
+                f"n-grams is meaningless. Pass its raw metrics instead and "
+                f"compute it as a derived metric, e.g. "
+                f'--derived "CTR=Clicks/Impressions".',
+                stacklevel=4,
+            )
+
+
+def add_derived_metrics(ngram_performance_df, derived_metrics):
+    """Adds the derived metrics as columns of the aggregated
+    `ngram_performance_df`, each being the sum of its numerator divided
+    by the sum of its denominator. A zero denominator gives NaN (an
+    empty cell) instead of an error or infinity. An existing column of
+    the same name is replaced.
+
+    Raises:
+        - ValueError: When the numerator or denominator isn't a numeric
+            performance column.
+    """
+    for metric in derived_metrics:
+        for column in (metric.numerator, metric.denominator):
+            if column not in ngram_performance_df.columns:
+                raise ValueError(
+                    f"Column {column!r} of the derived metric {metric.name!r} "
+                    f"is not in the input data."
+                )
+            if is_text_column(ngram_performance_df[column]):
+                raise ValueError(
+                    f"Column {column!r} of the derived metric {metric.name!r} "
+                    f"is not numeric."
+                )
+
+        numerator = ngram_performance_df[metric.numerator].to_numpy(dtype=np.float64)
+        denominator = ngram_performance_df[metric.denominator].to_numpy(
+            dtype=np.float64
+        )
+        ngram_performance_df[metric.name] = np.divide(
+            numerator,
+            denominator,
+            out=np.full(len(numerator), np.nan),
+            where=denominator != 0,
+        )
+
+    return ngram_performance_df
+
+
+def add_derived_metrics_to_analysis(
+    ngram_performance_dict, derived_metrics, stats=None
+):
+    """Runs `add_derived_metrics` on each n-gram performance DataFrame
+    of the analysis, leaving out the "Original Processed Data".
+    """
+    if not derived_metrics:
+        return ngram_performance_dict
+
+    with measure_stage(stats, "derived metrics") as record:
+        for ngram, ngram_performance_df in ngram_performance_dict.items():
+            if ngram != "Original Processed Data":
+                add_derived_metrics(ngram_performance_df, derived_metrics)
+        record["rows_out"] = sum(map(len, ngram_performance_dict.values()))
+
+    return ngram_performance_dict
+
+
+#######################
+# SAVING THE ANALYSIS #
+#######################
+
+
+def sets_to_strings(performance_df):
+    """Helper function which joins set-valued cells (the n-gram columns
+    of the processed data) into ", " separated sorted strings.
+    """
+    return performance_df.apply(
+        lambda column: column.map(
+            lambda value: ", ".join(sorted(value)) if isinstance(value, set) else value
+        )
+        if column.dtype == "O"
+        else column
+    )
+
+
+def sets_to_lists(performance_df):
+    """Helper function which turns set-valued cells (the n-gram columns
+    of the processed data) into sorted lists, which columnar formats
+    store natively.
+    """
+    return performance_df.apply(
+        lambda column: column.map(
+            lambda value: sorted(value) if isinstance(value, set) else value
+        )
+        if column.dtype == "O"
+        else column
+    )
+
+
+def write_csv(performance_df, path):
+    sets_to_strings(performance_df).to_csv(path, index=False)
+
+
+def write_parquet(performance_df, path):
+    sets_to_lists(performance_df).to_parquet(path, index=False)
+
+
+def write_feather(performance_df, path):
+    sets_to_lists(performance_df).reset_index(drop=True).to_feather(path)
+
+
+# Rows of an Excel sheet, including the header.
+EXCEL_MAX_ROWS = 1048576
+
+
+def excel_cell_value(value):
+    """Helper function which turns a DataFrame value into a value
+    openpyxl can write: sets are joined like in `sets_to_strings` and
+    the missing values are left empty.
+    """
+    if isinstance(value, set):
+        return ", ".join(sorted(value))
+    if pd.isna(value):
+        return None
+
+    return value
+
+
+def write_xlsx(ngram_performance_dict, path):
+    """Writes the n-gram performance DataFrames into a single workbook
+    with openpyxl's write-only mode, which streams the rows to the file
+    instead of keeping every cell in memory until the workbook is
+    closed.
+
+    DataFrames longer than a sheet are split over several sheets, e.g.
+    "1-gram", "1-gram (2)", "1-gram (3)".
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    rows_per_sheet = EXCEL_MAX_ROWS - 1
+
+    for ngram, performance_df in ngram_performance_dict.items():
+        for part, sheet_start in enumerate(
+            range(0, max(len(performance_df), 1), rows_per_sheet), 1
+        ):
+            sheet_name = ngram if part == 1 else f"{ngram} ({part})"
+            worksheet = workbook.create_sheet(title=sheet_name)
+            worksheet.append(performance_df.columns.tolist())
+            for row in performance_df.iloc[
+                sheet_start : sheet_start + rows_per_sheet
+            ].itertuples(index=False, name=None):
+                # Converted row by row, so the DataFrame isn't copied.
+                worksheet.append([excel_cell_value(value) for value in row])
+
+    workbook.save(path)
+
+
+def rankable_columns(input_file, usecols=None, aggregations=None, sample_rows=10000):
+    """Returns the numeric columns the n-gram performance DataFrames of
+    the csv will have after the aggregation, which the n-grams can be
+    ranked by: the "Unique Occurences", the numeric performance columns
+    and the text columns aggregated with "count" or "nunique". The
+    dtypes are inferred from the first `sample_rows` rows.
+    """
+    sample_df = pd.read_csv(input_file, nrows=sample_rows, usecols=usecols)
+    aggregations = aggregations or {}
+
+    columns = ["Unique Occurences"]
+    for column in sample_df.columns[1:]:
+        aggregation = aggregations.get(column)
+        if aggregation is not None and aggregation.how in ("count", "nunique"):
+            columns.append(column)
+        elif not is_text_column(sample_df[column]) and (
+            aggregation is None or aggregation.how not in TEXT_AGGREGATIONS
+        ):
+            columns.append(column)
+
+    return columns
+
+
+def top_ngrams(performance_df, top_k, rank_by):
+    """Helper function which returns the `top_k` rows of the n-gram
+    performance DataFrame with the highest `rank_by` metric.
+
+    Raises:
+        - ValueError: When there's no `rank_by` column.
+    """
+    if rank_by not in performance_df.columns:
+        raise ValueError(f"Can't rank the n-grams by missing column {rank_by!r}.")
+
+    return performance_df.nlargest(top_k, rank_by).reset_index(drop=True)
+
+
+# Formats written as one file per n-gram performance DataFrame.
+OUTPUT_WRITERS = {
+    "csv": write_csv,
+    "parquet": write_parquet,
+    "feather": write_feather,
+}
+OUTPUT_FORMATS = tuple(OUTPUT_WRITERS) + ("xlsx",)
+
+
+def save_ngram_performance(
+    ngram_performance_dict,
+    output_folder,
+    output_name,
+    output_format="csv",
+    top_k=None,
+    rank_by="Unique Occurences",
+):
+    """Saves the n-gram performance DataFrames.
+
+    For "xlsx" a single workbook `output_name.xlsx` is written with
+    `write_xlsx`, with a sheet per DataFrame. For the other formats each
+    DataFrame is written to its own file inside of the `output_name`
+    folder, e.g. `output_name/2-gram.parquet`.
+
+    Args:
+        - ngram_performance_dict (dict): The dictionary returned by
+            `calculate_ngram_performance`.
+        - output_folder (str): The relative path of the output folder.
+        - output_name (str): Name of the workbook or of the folder with
+            the files.
+        - output_format (str, optional): One of `OUTPUT_FORMATS`.
+            Defaults to "csv".
+        - top_k (int, optional): If set, only the `top_k` n-grams with
+            the highest `rank_by` metric are saved for each n. The
+            processed data is always saved whole. Defaults to None.
+        - rank_by (str, optional): The metric the n-grams are ranked
+            by for `top_k`. Defaults to "Unique Occurences".
+
+    Returns:
+        - str: The path of the written workbook or folder.
+
+    Raises:
+        - ValueError: When `output_format` isn't one of `OUTPUT_FORMATS`,
+            or when there's no `rank_by` column.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unknown output format {output_format!r}, "
+            f"expected one of {OUTPUT_FORMATS}."
+        )
+
+    if top_k is not None:
+        ngram_performance_dict = {
+            ngram: (
+                performance_df
+                if ngram == "Original Processed Data"
+                else top_ngrams(performance_df, top_k, rank_by)
+            )
+            for ngram, performance_df in ngram_performance_dict.items()
+        }
+
+    if output_format == "xlsx":
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+        full_output_path = os.path.join(output_folder, f"{output_name}.xlsx")
+        write_xlsx(ngram_performance_dict, full_output_path)
+
+        return full_output_path
+
+    full_output_path = os.path.join(output_folder, output_name)
+    if not os.path.exists(full_output_path):
+        os.makedirs(full_output_path)
+    write = OUTPUT_WRITERS[output_format]
+    for ngram, performance_df in ngram_performance_dict.items():
+        output_path = os.path.join(full_output_path, f"{ngram}.{output_format}")
+        write(performance_df, output_path)
+
+    return full_output_path
+
+
+def save_segment_performance(
+    segment_performance_dict, output_folder, output_name, group_by, **save_kwargs
+):
+    """Saves the n-gram performance of every segment (see
+    `calculate_segment_performance`) with `save_ngram_performance`, as
+    `output_name/[group_by] [segment]`.
+
+    Returns:
+        - str: The path of the folder with the segments.
     """
+    full_output_path = os.path.join(output_folder, output_name)
+    for segment, ngram_performance_dict in segment_performance_dict.items():
+        # Segments may contain characters that aren't allowed in paths.
+        segment_name = re.sub(r'[\\/:*?"<>|]', "_", f"{group_by} {segment}")
+        save_ngram_performance(
+            ngram_performance_dict, full_output_path, segment_name, **save_kwargs
+        )
 
-    def aggregate_by_dtype(x):
-        """Inner helper function for the groupby aggregation
+    return full_output_path
 
-        Note:
-            - The aggregated returned text has only unique elements
-                seperated by a ",".
-        """
-        d = {}
-        for column in x.columns[1:]:
-            if x[column].dtype == "O":
-                d[column] = ", ".join(set(x[column]))
-            else:
-                d[column] = x[column].sum()
-        return pd.Series(d)
 
-    # -----------------------
-    # Parent's Function Logic
-    # -----------------------
+###################
+# MAIN EXECUTABLE #
+###################
 
-    input_df_columns = input_data_with_ngrams_df.columns.tolist()
-    ngram_columns = [col for col in input_df_columns if "-gram" in col]
-    performance_columns = [
-        col
-        for col in input_df_columns[1:]
-        if (col not in ngram_columns) and (col != "cleaned_text")
-    ]
 
-    input_data_with_ngrams_df.reset_index(level=0, inplace=True)  # Key for merging
+def analyze_dataframe(
+    input_data_df,
+    ngram_range=(1, 4),
+    lemmatize=False,
+    lemmatizer=None,
+    engine="vectorized",
+    deduplicate=False,
+    min_occurrences=None,
+    top_k=None,
+    rank_by="Unique Occurences",
+    include_processed_data=True,
+    stats=None,
+    shards=None,
+    derived_metrics=None,
+    aggregations=None,
+    store=None,
+    group_by=None,
+    approximate=False,
+    sketch_width=2**18,
+    sketch_depth=4,
+):
+    """The in-memory n-gram analysis of a raw input DataFrame. Nothing
+    is read from or written to the disk (apart from the `store`), and
+    `input_data_df` isn't modified, so it can be called from several
+    threads at once.
 
-    ngram_performance_dict = {}
+    Examples:
+        >>> from ngram_analysis import analyze_dataframe
+        >>> analyze_dataframe(
+        ...     pd.DataFrame({"description": ["jack and jill"], "link_clicks": [10]}),
+        ...     ngram_range=(1, 2),
+        ... )["2-gram"]
+             2-gram  Unique Occurences  link_clicks
+        0  and jill                  1           10
+        1  jack and                  1           10
 
-    for ngram in ngram_columns:
-        # This returns us a DataFrame which has n-gram keyword
-        # in one column, and the original index (key) in the other.
-        id_and_ngram_df = (
-            pd.DataFrame(input_data_with_ngrams_df[ngram].values.tolist())
-            .reset_index(level=0)
-            .melt(id_vars=["index"], value_name=ngram)
-            .dropna()
-            .drop(columns=["variable"])
-        )
+    Args:
+        - input_data_df (DataFrame): The raw input data, the first
+            column is the text and the rest is performance data.
+        - ngram_range (tuple, optional): The smallest and the largest n
+            of the n-grams (inclusive). Defaults to (1, 4).
+        - lemmatize (bool, optional): Passed to `clean_input_data`.
+            Defaults to False.
+        - lemmatizer (Lemmatizer, optional): Passed to
+            `clean_input_data`. Defaults to None.
+        - engine (str, optional): Passed to
+            `calculate_ngram_performance`. Defaults to "vectorized".
+        - deduplicate (bool, optional): If set, uses
+            `calculate_ngram_performance_deduplicated`, `engine` is not
+            used then. Defaults to False.
+        - min_occurrences (int, optional): If set, the n-grams found in
+            fewer rows are dropped, see `NgramPruning`. Defaults to None.
+        - top_k (int, optional): If set, only the `top_k` n-grams by
+            `rank_by` of each n are kept. Defaults to None.
+        - rank_by (str, optional): The metric of `top_k`.
+            Defaults to "Unique Occurences".
+        - include_processed_data (bool, optional): If set, the processed
+            rows are returned as the "Original Processed Data". Their
+            per-row sets of n-grams take several times the memory of the
+            input, unset it to keep the peak memory low.
+            Defaults to True.
+        - stats (AnalysisStats, optional): Collects the stages.
+            Defaults to None.
+        - shards (int, optional): The number of worker processes of the
+            "sharded" engine. Defaults to the number of CPUs.
+        - derived_metrics (list, optional): DerivedMetric's (see
+            `parse_derived_metric`) added to every n-gram DataFrame
+            after the aggregation. Defaults to None.
+        - aggregations (dict, optional): The column name and its
+            ColumnAggregation, for the columns that shouldn't be summed
+            or joined, e.g. `{"ad_id": ColumnAggregation("nunique")}`.
+            Defaults to None.
+        - store (str, optional): The folder of a `NgramStore` the
+            tokenized texts and their n-grams are kept in and reused
+            from, see `load_ngram_store`. There's no "Original Processed
+            Data" then and `deduplicate` is not used. Defaults to None.
+        - group_by (str, optional): If set, the n-grams are aggregated
+            per segment of this column (e.g. the campaign) in a single
+            pass, see `calculate_segment_performance`. There's no
+            "Original Processed Data" then and `deduplicate` is not
+            used. Defaults to None.
+        - approximate (bool, optional): If set, only the `top_k`
+            n-grams by `rank_by` are found with a fixed memory ceiling,
+            see `calculate_ngram_performance_approximate`. Only `top_k`,
+            `rank_by`, the lemmatizing and `aggregations` are used then.
+            Defaults to False.
+        - sketch_width (int, optional): The width of the sketches of
+            `approximate`. Defaults to 2 ** 18.
+        - sketch_depth (int, optional): The depth of the sketches of
+            `approximate`. Defaults to 4.
 
-        ngram_performance_df = id_and_ngram_df.merge(
-            input_data_with_ngrams_df[performance_columns],
-            left_on='index', right_index=True
-        ).drop(columns=["index"])
+    Returns:
+        - dict: The same dictionary as `calculate_ngram_performance`,
+            or with `group_by`, a dict of such dictionaries keyed by the
+            segment.
+    """
+    start, end = ngram_range
+    pruning = make_pruning(min_occurrences, top_k, rank_by)
 
-        ngram_performance_df = (
-            ngram_performance_df.groupby(ngram).apply(aggregate_by_dtype).reset_index()
+    if approximate:
+        return add_derived_metrics_to_analysis(
+            calculate_ngram_performance_approximate(
+                lambda: [input_data_df],
+                top_k,
+                rank_by,
+                start=start,
+                end=end,
+                width=sketch_width,
+                depth=sketch_depth,
+                lemmatize=lemmatize,
+                lemmatizer=lemmatizer,
+                stats=stats,
+                aggregations=aggregations,
+            ),
+            derived_metrics,
+            stats,
         )
-        ngram_performance_dict[ngram] = ngram_performance_df
 
-        print(f"Calculation of {ngram} done.")
+    if (store is not None or group_by is not None) and engine not in (
+        "vectorized",
+        "sharded",
+    ):
+        raise ValueError(
+            f"The n-gram store and the segments work with the vectorized and "
+            f"sharded engines, not {engine!r}."
+        )
 
-    ngram_performance_dict["Original Processed Data"] = input_data_with_ngrams_df.drop(
-        "index", axis=1
-    )
+    ngram_incidences = None
+    if store is not None:
+        input_data_cleaned_df, vocabulary, ngram_incidences = load_ngram_store(
+            input_data_df,
+            store,
+            lemmatize=lemmatize,
+            lemmatizer=lemmatizer,
+            start=start,
+            end=end,
+            stats=stats,
+        )
+    else:
+        input_data_cleaned_df = clean_input_data(
+            input_data_df, lemmatize=lemmatize, lemmatizer=lemmatizer, stats=stats
+        )
+        vocabulary = NgramVocabulary()
+        if group_by is not None or (
+            not deduplicate
+            and not include_processed_data
+            and engine in ("vectorized", "sharded")
+        ):
+            # Without the per-row sets of n-grams, the peak memory stays
+            # close to the size of the input.
+            ngram_incidences = create_ngram_incidence(
+                input_data_cleaned_df,
+                vocabulary,
+                start=start,
+                end=end,
+                stats=stats,
+                # The segments are pruned on their own.
+                pruning=pruning if group_by is None else None,
+            )
 
-    return ngram_performance_dict
+    if group_by is not None:
+        segment_performance_dict = calculate_segment_performance(
+            input_data_cleaned_df,
+            ngram_incidences,
+            vocabulary,
+            group_by,
+            pruning,
+            stats,
+            engine=engine,
+            shards=shards,
+            aggregations=aggregations,
+        )
+        for ngram_performance_dict in segment_performance_dict.values():
+            add_derived_metrics_to_analysis(
+                ngram_performance_dict, derived_metrics, stats
+            )
 
+        return segment_performance_dict
 
-###################
-# MAIN EXECUTABLE #
-###################
+    if ngram_incidences is not None:
+        ngram_performance_dict = calculate_incidence_performance(
+            input_data_cleaned_df,
+            ngram_incidences,
+            vocabulary,
+            pruning,
+            stats,
+            engine=engine,
+            shards=shards,
+            aggregations=aggregations,
+        )
+    elif deduplicate:
+        ngram_performance_dict = calculate_ngram_performance_deduplicated(
+            input_data_cleaned_df,
+            start=start,
+            end=end,
+            vocabulary=vocabulary,
+            pruning=pruning,
+            stats=stats,
+            include_processed_data=include_processed_data,
+            aggregations=aggregations,
+        )
+    else:
+        input_data_with_ngrams_df = create_ngrams(
+            input_data_cleaned_df,
+            start=start,
+            end=end,
+            vocabulary=vocabulary,
+            stats=stats,
+            pruning=pruning,
+        )
+        ngram_performance_dict = calculate_ngram_performance(
+            input_data_with_ngrams_df,
+            engine=engine,
+            vocabulary=vocabulary,
+            pruning=pruning,
+            stats=stats,
+            include_processed_data=include_processed_data,
+            shards=shards,
+            aggregations=aggregations,
+        )
+
+    return add_derived_metrics_to_analysis(
+        ngram_performance_dict, derived_metrics, stats
+    )
 
 
 def execute_ngram_analysis(
@@ -297,29 +3780,134 @@ def execute_ngram_analysis(
     output_folder="ngram_analysis",
     output_file_prefix="Analysis of ",
     lemmatize=False,
+    engine="vectorized",
+    chunksize=None,
+    lemmatizer=None,
+    deduplicate=False,
+    output_format="csv",
+    top_k=None,
+    rank_by="Unique Occurences",
+    state_file=None,
+    min_occurrences=None,
+    top_k_by=None,
+    stats=None,
+    stats_log=None,
+    ngram_range=(1, 4),
+    usecols=None,
+    compact_dtypes=True,
+    shards=None,
+    derived_metrics=None,
+    aggregations=None,
+    store=None,
+    group_by=None,
+    approximate=False,
+    sketch_width=2**18,
+    sketch_depth=4,
+    include_processed_data=True,
 ):
     """The main function that takes in the path to the .csv with raw
     data and returns the dict containing performance for each ngram.
 
-    Saves the analysis to .xlsx file.
+    Reads the csv, runs `analyze_dataframe` on it and saves the analysis
+    with `save_ngram_performance`.
 
     Args:
         - input_file (str): The relative path to the raw data file in a
             csv format.
         - output_folder (str, optional): The relative path to which the
-            output .xlsx files should be written.
+            output files should be written.
             Defaults to "ngram_analysis"
         - output_file_prefix (str, optional): The prefix that will be
-            attached to the .xlsx file containing the analysis.
+            attached to the file or folder containing the analysis.
         - lemmatize (bool, optional): If set to True the cleaned data
             will also be very conservatively lemmatized, trying to
             normalize only words that are more or less sure with
             omitting word that have special characters in them.
             Defaults to False.
+        - engine (str, optional): The aggregation engine passed to
+            `calculate_ngram_performance`. Defaults to "vectorized".
+        - chunksize (int, optional): If set, the csv is read and
+            processed in chunks of this many rows with
+            `calculate_ngram_performance_in_chunks`, for files larger
+            than the memory. `engine` is not used then, and there's no
+            "Original Processed Data". Defaults to None.
+        - lemmatizer (Lemmatizer, optional): The lemmatization service
+            to use when `lemmatize` is set, so its worker pool can be
+            reused across files. If not passed, one is started for
+            this file. Defaults to None.
+        - deduplicate (bool, optional): If set, rows with identical
+            cleaned text are collapsed before creating the n-grams, see
+            `calculate_ngram_performance_deduplicated`. `engine` is not
+            used then. Defaults to False.
+        - output_format (str, optional): One of `OUTPUT_FORMATS`,
+            passed to `save_ngram_performance`. Defaults to "csv".
+        - top_k (int, optional): Passed to `save_ngram_performance`,
+            saves only the top `top_k` n-grams for each n.
+            Defaults to None.
+        - rank_by (str, optional): Passed to `save_ngram_performance`,
+            the metric the n-grams are ranked by for `top_k`.
+            Defaults to "Unique Occurences".
+        - state_file (str, optional): If set, the analysis is updated
+            incrementally with `calculate_ngram_performance_incremental`,
+            keeping its state in this file. `engine` and `chunksize`
+            are not used then, and there's no "Original Processed Data".
+            Defaults to None.
+        - min_occurrences (int, optional): If set, the n-grams found in
+            fewer rows are dropped during the aggregation, see
+            `NgramPruning`. Defaults to None.
+        - top_k_by (str, optional): If set, only the `top_k` n-grams
+            by this metric are kept already during the aggregation,
+            instead of ranking them by `rank_by` when saving.
+            Defaults to None.
+        - stats (AnalysisStats, optional): Collects the wall time, rows,
+            unique n-grams and peak RSS of every stage of the analysis.
+            If not passed, a new one is used. Defaults to None.
+        - stats_log (str, optional): The relative path to a file the
+            stats are appended to as a line of JSON. Defaults to None.
+        - ngram_range (tuple, optional): The smallest and the largest n
+            of the n-grams (inclusive). Defaults to (1, 4).
+        - usecols (list, optional): The only columns of the csv to read,
+            see `read_input_data`. Defaults to None.
+        - compact_dtypes (bool, optional): If set, the csv is read with
+            compact dtypes, see `read_input_data`. Defaults to True.
+        - shards (int, optional): The number of worker processes of the
+            "sharded" engine. Defaults to the number of CPUs.
+        - derived_metrics (list, optional): DerivedMetric's added to
+            every n-gram DataFrame after the aggregation, see
+            `add_derived_metrics`. Defaults to None.
+        - aggregations (dict, optional): The column name and its
+            ColumnAggregation, for the columns that shouldn't be summed
+            or joined, see `aggregate_column`. Defaults to None.
+        - store (str, optional): If set, the tokenized texts and their
+            n-grams are kept in a `NgramStore` in a subfolder of this
+            folder named after the input file, and reused by the next
+            runs on the same file. There's no "Original Processed Data"
+            then, and `chunksize` and `state_file` are not supported.
+            Defaults to None.
+        - group_by (str, optional): If set, the n-grams are analyzed per
+            segment of this column (e.g. the campaign) in a single pass,
+            and each segment is saved with `save_segment_performance`.
+            `chunksize` and `state_file` are not supported then.
+            Defaults to None.
+        - approximate (bool, optional): If set, the csv is read twice in
+            chunks of `chunksize` (or `SKETCH_CHUNKSIZE`) rows, and only
+            the `top_k` n-grams by `top_k_by` (or `rank_by`) are found
+            with a fixed memory ceiling, see
+            `calculate_ngram_performance_approximate`. Requires `top_k`.
+            Defaults to False.
+        - sketch_width (int, optional): The width of the sketches of
+            `approximate`. Defaults to 2 ** 18.
+        - sketch_depth (int, optional): The depth of the sketches of
+            `approximate`. Defaults to 4.
+        - include_processed_data (bool, optional): Passed to
+            `analyze_dataframe`. If not set, the "Original Processed
+            Data" isn't saved, which takes much less memory.
+            Defaults to True.
 
     Returns:
         - dict: A dictionary containing key value pairs of the ngram
-            and ngram's performance DataFrame.
+            and ngram's performance DataFrame (with `group_by`, such a
+            dictionary for each segment).
 
             {
                 "1-gram": DataFrame({
@@ -335,7 +3923,7 @@ def execute_ngram_analysis(
             }
 
     Notes:
-        - Also saves the output to an .xlsx formatted file.
+        - Also saves the output in the `output_format`.
         - Requirements for the input .csv file:
             * The first column is required to be the text that you
                 wish to be analyzed, rest of the columns is
@@ -344,43 +3932,327 @@ def execute_ngram_analysis(
                 way (averages, ROI, etc.) as thiswill simply
                 return nonsense data due to summing them up.
     """
+    if lemmatize and lemmatizer is None:
+        try:
+            lemmatizer = Lemmatizer()
+        except OSError as e:
+            print(e)
+            print(
+                "Please make sure that you've ran `python -m spacy download en` via the console"
+            )
+            return None
+        # The lemmatizer started here is closed once the file is analyzed.
+        lemmatizer_context = lemmatizer
+    else:
+        lemmatizer_context = nullcontext()
+
+    with lemmatizer_context:
+        if stats is None:
+            stats = AnalysisStats()
+
+        # With `top_k_by`, the top K n-grams are kept during the aggregation
+        # instead of when saving.
+        aggregation_top_k = top_k if top_k_by else None
+        aggregation_rank_by = top_k_by or rank_by
+        if top_k_by:
+            top_k = None
+        start, end = ngram_range
+        input_filename = os.path.splitext(os.path.basename(input_file))[0]
+
+        if state_file:
+            print(f"\nReading {input_file}")
+            try:
+                with measure_stage(stats, "read") as record:
+                    input_data_df = read_input_data(
+                        input_file, compact_dtypes=compact_dtypes, usecols=usecols
+                    )
+                    record["rows_out"] = len(input_data_df)
+            except Exception as e:
+                print(f"Reading {input_file} has caused an error:\n{e}")
+                return None
+
+            print(f"Updating the analysis incrementally with {state_file}...")
+            ngram_performance_dict = calculate_ngram_performance_incremental(
+                input_data_df,
+                state_file,
+                lemmatize=lemmatize,
+                lemmatizer=lemmatizer,
+                start=start,
+                end=end,
+                deduplicate=deduplicate,
+                pruning=make_pruning(
+                    min_occurrences, aggregation_top_k, aggregation_rank_by
+                ),
+                stats=stats,
+                aggregations=aggregations,
+            )
+        elif approximate:
+            print(f"\nFinding the top {top_k} n-grams of {input_file} approximately")
+            try:
+                ngram_performance_dict = calculate_ngram_performance_approximate(
+                    lambda: read_input_data(
+                        input_file,
+                        compact_dtypes=compact_dtypes,
+                        usecols=usecols,
+                        chunksize=chunksize or SKETCH_CHUNKSIZE,
+                    ),
+                    aggregation_top_k or top_k,
+                    aggregation_rank_by,
+                    start=start,
+                    end=end,
+                    width=sketch_width,
+                    depth=sketch_depth,
+                    lemmatize=lemmatize,
+                    lemmatizer=lemmatizer,
+                    stats=stats,
+                    aggregations=aggregations,
+                )
+            except (OSError, pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+                print(f"Reading {input_file} has caused an error:\n{e}")
+                return None
+            # Only the top K n-grams are left already.
+            top_k = None
+        elif chunksize:
+            print(
+                f"\nReading and processing {input_file} in chunks of {chunksize} rows"
+            )
+            try:
+                input_data_chunks = read_input_data(
+                    input_file,
+                    compact_dtypes=compact_dtypes,
+                    usecols=usecols,
+                    chunksize=chunksize,
+                )
+                ngram_performance_dict = calculate_ngram_performance_in_chunks(
+                    input_data_chunks,
+                    lemmatize=lemmatize,
+                    start=start,
+                    end=end,
+                    lemmatizer=lemmatizer,
+                    deduplicate=deduplicate,
+                    pruning=make_pruning(
+                        min_occurrences, aggregation_top_k, aggregation_rank_by
+                    ),
+                    stats=stats,
+                    aggregations=aggregations,
+                )
+            except (OSError, pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+                print(f"Reading {input_file} has caused an error:\n{e}")
+                return None
+        else:
+            print(f"\nReading {input_file}")
+            try:
+                with measure_stage(stats, "read") as record:
+                    input_data_df = read_input_data(
+                        input_file, compact_dtypes=compact_dtypes, usecols=usecols
+                    )
+                    record["rows_out"] = len(input_data_df)
+            except Exception as e:
+                print(f"Reading {input_file} has caused an error:\n{e}")
+                return None
+
+            print("Cleaning and processing input data...")
+            ngram_performance_dict = analyze_dataframe(
+                input_data_df,
+                ngram_range=ngram_range,
+                lemmatize=lemmatize,
+                lemmatizer=lemmatizer,
+                engine=engine,
+                deduplicate=deduplicate,
+                min_occurrences=min_occurrences,
+                top_k=aggregation_top_k,
+                rank_by=aggregation_rank_by,
+                stats=stats,
+                shards=shards,
+                aggregations=aggregations,
+                store=os.path.join(store, input_filename) if store else None,
+                group_by=group_by,
+                include_processed_data=include_processed_data,
+            )
+
+        if group_by:
+            for segment_dict in ngram_performance_dict.values():
+                add_derived_metrics_to_analysis(segment_dict, derived_metrics, stats)
+        else:
+            ngram_performance_dict = add_derived_metrics_to_analysis(
+                ngram_performance_dict, derived_metrics, stats
+            )
+
+        print("Calculating performance's done. Saving...")
+        with measure_stage(stats, "write") as record:
+            if group_by:
+                full_output_path = save_segment_performance(
+                    ngram_performance_dict,
+                    output_folder,
+                    f"{output_file_prefix}{input_filename}",
+                    group_by,
+                    output_format=output_format,
+                    top_k=top_k,
+                    rank_by=rank_by,
+                )
+                record["rows_in"] = sum(
+                    len(df)
+                    for segment_dict in ngram_performance_dict.values()
+                    for df in segment_dict.values()
+                )
+            else:
+                full_output_path = save_ngram_performance(
+                    ngram_performance_dict,
+                    output_folder,
+                    f"{output_file_prefix}{input_filename}",
+                    output_format=output_format,
+                    top_k=top_k,
+                    rank_by=rank_by,
+                )
+                record["rows_in"] = sum(
+                    len(df) for df in ngram_performance_dict.values()
+                )
+        print(f"Saved to {full_output_path} successfully.")
+
+        if stats_log:
+            stats.save(stats_log, input_file=input_file)
+
+        return ngram_performance_dict
+
+
+FileAnalysisResult = namedtuple(
+    "FileAnalysisResult", ["file_location", "error", "seconds"]
+)
+
+# Lemmatizer of a folder analysis' worker process, reused for every file
+# the worker analyzes. Set once by `init_file_worker`.
+_file_worker_lemmatizer = None
+
+
+def init_file_worker(lemmatizer_kwargs):
+    """Pool initializer which starts an in-process Lemmatizer once per
+    folder analysis' worker, when lemmatizing.
+    """
+    global _file_worker_lemmatizer
+    if lemmatizer_kwargs is None:
+        return
+
     try:
-        if lemmatize:
-            spacy.load("en")
-    except OSError as e:
-        print(e)
-        print(
-            "Please make sure that you've ran `python -m spacy download en` via the console"
-        )
-        return None
+        _file_worker_lemmatizer = Lemmatizer(processes=1, **lemmatizer_kwargs)
+    except OSError:
+        # execute_ngram_analysis reports the missing model for each file.
+        _file_worker_lemmatizer = None
+
+
+def analyze_file(file_location, analysis_kwargs):
+    """Helper function which runs `execute_ngram_analysis` on a single
+    file and reports how it went instead of raising, so that one bad
+    file doesn't stop the whole folder.
+
+    Need it at top level due to how the multiprocessing module
+    handles such things.
+
+    Returns:
+        - FileAnalysisResult: The file, the error message (None on
+            success) and how many seconds the analysis took.
+    """
+    if analysis_kwargs.get("lemmatize") and _file_worker_lemmatizer is not None:
+        analysis_kwargs = dict(analysis_kwargs, lemmatizer=_file_worker_lemmatizer)
 
-    print(f"\nReading {input_file}")
+    start_time = time.perf_counter()
     try:
-        input_data_df = pd.read_csv(input_file)
+        ngram_performance_dict = execute_ngram_analysis(
+            file_location, **analysis_kwargs
+        )
+        error = None if ngram_performance_dict is not None else "No analysis returned."
     except Exception as e:
-        print(f"Reading {input_file} has caused an error:\n{e}")
-        return None
+        error = f"{type(e).__name__}: {e}"
 
-    print("Cleaning and processing input data...")
-    input_data_cleaned_df = clean_input_data(input_data_df, lemmatize=lemmatize)
-    input_data_with_ngrams_df = create_ngrams(input_data_cleaned_df)
-    print("File cleaning and processing done...")
-
-    print("Calculating performance...")
-    ngram_performance_dict = calculate_ngram_performance(input_data_with_ngrams_df)
-
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    input_filename = os.path.splitext(os.path.basename(input_file))[0]
-    output_file = f"{output_file_prefix}{input_filename}.xlsx"
-    full_output_path = os.path.join(output_folder, output_file)
-    print(f"Calculating performance's done. Saving to {full_output_path}")
-    with pd.ExcelWriter(full_output_path) as writer:
-        for ngram, performance_df in ngram_performance_dict.items():
-            performance_df.to_excel(writer, sheet_name=ngram, index=False)
-    print(f"Saved to file successfully.")
+    if _file_worker_lemmatizer is not None:
+        # Worker processes are never closed explicitly.
+        _file_worker_lemmatizer.cache.save()
 
-    return ngram_performance_dict
+    return FileAnalysisResult(file_location, error, time.perf_counter() - start_time)
+
+
+def execute_folder_analysis(
+    input_folder, workers=1, lemmatizer_kwargs=None, **analysis_kwargs
+):
+    """Runs `execute_ngram_analysis` on every file in the `input_folder`
+    and prints a summary with the timings at the end.
+
+    When lemmatizing, the spaCy model is loaded only once - either into
+    a single Lemmatizer shared by all of the files, or once per worker.
+
+    Args:
+        - input_folder (str): The relative path to the folder containing
+            only csv's of raw performance data.
+        - workers (int, optional): How many files are analyzed at once,
+            each in its own process. Defaults to 1.
+        - lemmatizer_kwargs (dict, optional): Passed to the Lemmatizer
+            when `lemmatize` is set. Defaults to None.
+        - **analysis_kwargs: Passed to `execute_ngram_analysis`.
+
+    Returns:
+        - list: FileAnalysisResult of every file, in the order they
+            have finished.
+    """
+    start_time = time.perf_counter()
+    file_locations = [
+        os.path.join(input_folder, filename)
+        for filename in sorted(os.listdir(input_folder))
+    ]
+    lemmatize = analysis_kwargs.get("lemmatize", False)
+    lemmatizer_kwargs = lemmatizer_kwargs or {}
+
+    if workers > 1:
+        results = []
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_file_worker,
+            initargs=(lemmatizer_kwargs if lemmatize else None,),
+        ) as executor:
+            futures = {
+                executor.submit(analyze_file, file_location, analysis_kwargs): (
+                    file_location
+                )
+                for file_location in file_locations
+            }
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # The worker process itself died.
+                    results.append(
+                        FileAnalysisResult(
+                            futures[future], f"{type(e).__name__}: {e}", 0.0
+                        )
+                    )
+    else:
+        lemmatizer = None
+        if lemmatize and analysis_kwargs.get("lemmatizer") is None:
+            try:
+                lemmatizer = Lemmatizer(**lemmatizer_kwargs)
+                analysis_kwargs["lemmatizer"] = lemmatizer
+            except OSError:
+                # execute_ngram_analysis reports the missing model for
+                # each file.
+                pass
+
+        try:
+            results = [
+                analyze_file(file_location, analysis_kwargs)
+                for file_location in file_locations
+            ]
+        finally:
+            if lemmatizer is not None:
+                lemmatizer.close()
+
+    failed = [result for result in results if result.error is not None]
+    print(
+        f"\nAnalyzed {len(results) - len(failed)}/{len(results)} files "
+        f"in {time.perf_counter() - start_time:.2f}s:"
+    )
+    for result in results:
+        status = "OK" if result.error is None else f"FAILED - {result.error}"
+        print(f"  {result.file_location} ({result.seconds:.2f}s): {status}")
+
+    return results
 
 
 #####################
@@ -390,8 +4262,8 @@ def execute_ngram_analysis(
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="""
-    Scripts that analyzes text information via n-gram analysis, and creates
-    Excel workbook(s) with said analysis.
+    Scripts that analyzes text information via n-gram analysis, and saves
+    said analysis as CSV, Parquet or Feather files, or Excel workbook(s).
     """
     )
 
@@ -425,13 +4297,422 @@ if __name__ == "__main__":
         """,
     )
 
+    parser.add_argument(
+        "--engine",
+        choices=AGGREGATION_ENGINES,
+        default="vectorized",
+        help="""
+        Engine used for aggregating the n-gram performance. "sharded" splits
+        the n-grams across --shards processes, "apply" is the old per n-gram
+        aggregation, kept for benchmarking.
+        """,
+    )
+
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="""
+        Read and process the CSV in chunks of this many rows, for files
+        that don't fit into memory. The output is the same as without it,
+        except that the "Original Processed Data" isn't saved.
+        """,
+    )
+
+    parser.add_argument(
+        "--no-processed-data",
+        dest="include_processed_data",
+        action="store_false",
+        help="""
+        Don't save the "Original Processed Data" with the n-grams of every
+        row, which takes the most memory and time of the analysis.
+        """,
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="""
+        How many files of the input folder are analyzed in parallel,
+        each in its own process.
+        """,
+    )
+
+    parser.add_argument(
+        "--lemmatize-batch-size",
+        type=int,
+        default=1000,
+        help="""
+        How many texts are sent at once to a lemmatizer worker and streamed
+        through spaCy.
+        """,
+    )
+
+    parser.add_argument(
+        "--lemma-cache",
+        type=str,
+        default=None,
+        help="""
+        Relative path to a JSON file caching the lemmatized texts between
+        runs. It's invalidated when the spaCy model or its version changes.
+        """,
+    )
+
+    parser.add_argument(
+        "--lemma-cache-size",
+        type=int,
+        default=100000,
+        help="""
+        How many lemmatized texts are kept in the cache at most.
+        """,
+    )
+
+    parser.add_argument(
+        "--deduplicate",
+        action="store_true",
+        help="""
+        Collapse rows with identical cleaned text before creating the
+        n-grams. Speeds up inputs where the same text repeats many times.
+        """,
+    )
+
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="""
+        Output format. For csv, parquet and feather a folder with a file per
+        n-gram is created, xlsx creates a single Excel workbook.
+        """,
+    )
+
+    parser.add_argument(
+        "--export-top-k",
+        type=int,
+        default=None,
+        help="""
+        Save only the top K n-grams of each n, ranked by --export-rank-by.
+        Keeps the Excel sheets small enough to open.
+        """,
+    )
+
+    parser.add_argument(
+        "--export-rank-by",
+        type=str,
+        default="Unique Occurences",
+        help="""
+        The metric the n-grams are ranked by for --export-top-k.
+        """,
+    )
+
+    parser.add_argument(
+        "--incremental-state",
+        type=str,
+        default=None,
+        help="""
+        Relative path to a state file with the partial aggregates of the
+        previous run. Only the rows added since then are processed. Use it
+        with --input-file only, since every file needs its own state.
+        """,
+    )
+
+    parser.add_argument(
+        "--min-occurrences",
+        type=int,
+        default=None,
+        help="""
+        Drop the n-grams found in fewer than N rows already during the
+        aggregation. Longer n-grams of a dropped n-gram are skipped too.
+        """,
+    )
+
+    parser.add_argument(
+        "--top-k-by",
+        type=str,
+        default=None,
+        help="""
+        Keep only the --export-top-k n-grams by this metric already during
+        the aggregation, instead of cutting them when saving.
+        """,
+    )
+
+    parser.add_argument(
+        "--stats-log",
+        type=str,
+        default=None,
+        help="""
+        Relative path to a file the wall time, rows, unique n-grams and peak
+        RSS of every stage are appended to, one line of JSON per file.
+        """,
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=str,
+        nargs="?",
+        const="ngram_analysis.prof",
+        default=None,
+        help="""
+        Run the analysis under cProfile, print the slowest functions and save
+        the profile to the given file (default ngram_analysis.prof). With
+        --workers, only the main process is profiled.
+        """,
+    )
+
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=None,
+        help="""
+        Number of worker processes of --engine sharded (default the number
+        of CPUs).
+        """,
+    )
+
+    parser.add_argument(
+        "--derived",
+        type=str,
+        nargs="+",
+        default=None,
+        metavar="NAME=NUMERATOR/DENOMINATOR",
+        help="""
+        Ratio metrics computed from the summed up columns of each n-gram,
+        e.g. "CTR=Clicks/Impressions" "CPA=Cost/Conversions". A zero
+        denominator leaves the cell empty.
+        """,
+    )
+
+    parser.add_argument(
+        "--aggregate",
+        type=str,
+        nargs="+",
+        default=None,
+        metavar="COLUMN=HOW",
+        help=f"""
+        How to aggregate a column instead of summing it (numeric) or joining
+        its unique values (text), with HOW one of {", ".join(COLUMN_AGGREGATIONS)}.
+        "first:N" keeps the first N unique values, e.g. "ad_id=nunique"
+        "ad_name=first:3" "cost=mean".
+        """,
+    )
+
+    parser.add_argument(
+        "--usecols",
+        type=str,
+        nargs="+",
+        default=None,
+        help="""
+        Read only these columns of the csv. The first of them in the file is
+        the text that will be analyzed.
+        """,
+    )
+
+    parser.add_argument(
+        "--no-compact-dtypes",
+        dest="compact_dtypes",
+        action="store_false",
+        help="""
+        Read the csv with pandas' default dtypes, instead of downcasting the
+        metrics and reading ID-like text columns as categoricals.
+        """,
+    )
+
+    parser.add_argument(
+        "--store",
+        type=str,
+        default=None,
+        help="""
+        Relative path to a folder keeping the tokenized texts and their
+        n-grams of each input file on the disk, so later runs on the same
+        file with other metrics, filters or n-gram ranges skip the cleaning
+        and tokenizing. The "Original Processed Data" isn't saved then.
+        """,
+    )
+
+    parser.add_argument(
+        "--group-by",
+        type=str,
+        default=None,
+        help="""
+        Column of the csv with the segment of each row (e.g. the campaign).
+        The n-grams are created once and aggregated per segment in a single
+        pass, and each segment is saved on its own.
+        """,
+    )
+
+    parser.add_argument(
+        "--approximate",
+        action="store_true",
+        help="""
+        Find only the --export-top-k n-grams with a fixed memory ceiling
+        however many unique n-grams there are. The csv is read twice, first
+        summing up the ranking metric of the hashed n-grams in count-min
+        sketches, then aggregating only the heavy hitters exactly.
+        """,
+    )
+
+    parser.add_argument(
+        "--sketch-width",
+        type=int,
+        default=2**18,
+        help="""
+        The width of the count-min sketches of --approximate. The error of
+        the estimates shrinks with it, each sketch takes 8 bytes per cell.
+        """,
+    )
+
+    parser.add_argument(
+        "--sketch-depth",
+        type=int,
+        default=4,
+        help="""
+        The depth of the count-min sketches of --approximate. The confidence
+        in the error bound grows with it.
+        """,
+    )
+
     args = parser.parse_args()
+    if args.top_k_by and not args.export_top_k:
+        parser.error("--top-k-by requires --export-top-k")
+    if args.store and (args.chunksize or args.incremental_state):
+        parser.error("--store can't be used with --chunksize or --incremental-state")
+    if args.store and args.engine == "apply":
+        parser.error("--store requires the vectorized or sharded engine")
+    if args.group_by and (args.chunksize or args.incremental_state):
+        parser.error("--group-by can't be used with --chunksize or --incremental-state")
+    if args.group_by and args.engine == "apply":
+        parser.error("--group-by requires the vectorized or sharded engine")
+    if args.approximate and not args.export_top_k:
+        parser.error("--approximate requires --export-top-k")
+    if args.approximate and (args.incremental_state or args.store or args.group_by):
+        parser.error(
+            "--approximate can't be used with --incremental-state, --store or "
+            "--group-by"
+        )
+    try:
+        derived_metrics = [parse_derived_metric(spec) for spec in args.derived or []]
+        aggregations = dict(
+            parse_column_aggregation(spec) for spec in args.aggregate or []
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    # The rank columns are checked up front, instead of failing after the
+    # aggregation. Files which can't be read are reported by the analysis.
+    if args.export_top_k:
+        if args.input_file:
+            input_files = [args.input_file]
+        else:
+            input_files = [
+                os.path.join(args.input_folder, filename)
+                for filename in sorted(os.listdir(args.input_folder))
+            ]
+        derived_names = [derived_metric.name for derived_metric in derived_metrics]
+        for input_file in input_files:
+            try:
+                columns = rankable_columns(input_file, args.usecols, aggregations)
+            except (OSError, ValueError):
+                continue
+
+            if args.top_k_by in derived_names:
+                parser.error(
+                    f"--top-k-by can't rank by the derived metric {args.top_k_by!r}, "
+                    f"it's only computed after the aggregation. Use "
+                    f"--export-rank-by instead."
+                )
+            if args.top_k_by:
+                rank_option, rank_by = "--top-k-by", args.top_k_by
+            else:
+                rank_option, rank_by = "--export-rank-by", args.export_rank_by
+                columns += derived_names
+            if rank_by not in columns:
+                parser.error(
+                    f"{rank_option} {rank_by!r} isn't a numeric column of "
+                    f"{input_file}, expected one of {columns}."
+                )
+
+    lemmatizer_kwargs = {
+        "batch_size": args.lemmatize_batch_size,
+        "cache_path": args.lemma_cache,
+        "cache_size": args.lemma_cache_size,
+    }
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
     if args.input_folder:
-        for filename in os.listdir(args.input_folder):
-            file_location = os.path.join(args.input_folder, filename)
-            execute_ngram_analysis(file_location, lemmatize=args.lemmatize)
+        execute_folder_analysis(
+            args.input_folder,
+            workers=args.workers,
+            lemmatizer_kwargs=lemmatizer_kwargs,
+            lemmatize=args.lemmatize,
+            engine=args.engine,
+            chunksize=args.chunksize,
+            deduplicate=args.deduplicate,
+            output_format=args.format,
+            top_k=args.export_top_k,
+            rank_by=args.export_rank_by,
+            min_occurrences=args.min_occurrences,
+            top_k_by=args.top_k_by,
+            stats_log=args.stats_log,
+            usecols=args.usecols,
+            compact_dtypes=args.compact_dtypes,
+            shards=args.shards,
+            derived_metrics=derived_metrics,
+            aggregations=aggregations,
+            store=args.store,
+            group_by=args.group_by,
+            approximate=args.approximate,
+            sketch_width=args.sketch_width,
+            sketch_depth=args.sketch_depth,
+            include_processed_data=args.include_processed_data,
+        )
     elif args.input_file:
-        execute_ngram_analysis(args.input_file, lemmatize=args.lemmatize)
+        lemmatizer = None
+        if args.lemmatize:
+            try:
+                lemmatizer = Lemmatizer(**lemmatizer_kwargs)
+            except OSError:
+                # execute_ngram_analysis reports the missing model.
+                pass
+
+        execute_ngram_analysis(
+            args.input_file,
+            lemmatize=args.lemmatize,
+            engine=args.engine,
+            chunksize=args.chunksize,
+            lemmatizer=lemmatizer,
+            deduplicate=args.deduplicate,
+            output_format=args.format,
+            top_k=args.export_top_k,
+            rank_by=args.export_rank_by,
+            state_file=args.incremental_state,
+            min_occurrences=args.min_occurrences,
+            top_k_by=args.top_k_by,
+            stats_log=args.stats_log,
+            usecols=args.usecols,
+            compact_dtypes=args.compact_dtypes,
+            shards=args.shards,
+            derived_metrics=derived_metrics,
+            aggregations=aggregations,
+            store=args.store,
+            group_by=args.group_by,
+            approximate=args.approximate,
+            sketch_width=args.sketch_width,
+            sketch_depth=args.sketch_depth,
+            include_processed_data=args.include_processed_data,
+        )
+
+        if lemmatizer is not None:
+            lemmatizer.close()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+        print(f"Saved the profile to {args.profile}.")
 
     print("\nAll done!")
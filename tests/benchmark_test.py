@@ -0,0 +1,33 @@
+import benchmark
+import pytest
+
+
+class TestGenerateInputData:
+    def test_same_seed_returns_same_data(self):
+        first_df = benchmark.generate_input_data(100, metrics=2, seed=7)
+        second_df = benchmark.generate_input_data(100, metrics=2, seed=7)
+
+        assert first_df.equals(second_df)
+        assert first_df.columns.tolist() == ["text", "metric_1", "metric_2", "ad_id"]
+
+    def test_unknown_kind_raises_error(self):
+        with pytest.raises(ValueError):
+            benchmark.generate_input_data(10, kind="tweets")
+
+
+class TestRunBenchmark:
+    def test_result_per_size_and_stage(self):
+        results = benchmark.run_benchmark([50, 100], kind="ad_copy", repeat=1)[
+            "results"
+        ]
+
+        assert [(result["rows"], result["stage"]) for result in results] == [
+            (rows, stage)
+            for rows in [50, 100]
+            for stage in [
+                "clean_input_data",
+                "create_ngrams",
+                "calculate_ngram_performance",
+            ]
+        ]
+        assert all(result["peak_memory_bytes"] > 0 for result in results)
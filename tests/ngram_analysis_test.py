@@ -1,9 +1,95 @@
+import os
+import json
+import subprocess
+import sys
 import pytest
 import ngram_analysis
 
+import numpy as np
+import openpyxl
 import pandas as pd
 import pandas.util.testing
 
+from concurrent.futures import ThreadPoolExecutor
+
+
+def make_input_df(**columns):
+    """Returns the ads most of the tests analyze, with the `columns`
+    added or replaced.
+    """
+    return pd.DataFrame(
+        {
+            "description": [
+                "Jack and Jill made money!",
+                "Jill and Bart made money.",
+                "Bart made money",
+                "Jack and Jill",
+                "Lost your card?",
+            ],
+            "link_clicks": [1000, 2000, 300, 40, 5],
+            "ad_id": ["ad_1", "ad_2", "ad_3", "ad_1", "ad_2"],
+            **columns,
+        }
+    )
+
+
+@pytest.fixture
+def input_df():
+    return make_input_df()
+
+
+def assert_same_analysis(ngram_performance_dict, expected_dict):
+    """Asserts that both analyses have the same DataFrames, compared as
+    dicts since DataFrames can't be compared with `==`.
+    """
+    assert {k: v.to_dict() for k, v in ngram_performance_dict.items()} == {
+        k: v.to_dict() for k, v in expected_dict.items()
+    }
+
+
+class TestReadInputData:
+    @pytest.fixture
+    def input_file(self, tmp_path):
+        input_file = tmp_path / "input.csv"
+        pd.DataFrame(
+            {
+                "description": ["jack and jill", "jill went up", "jack went up"] * 4,
+                "link_clicks": [1, 2, 300] * 4,
+                "cost": [0.5, 1.25, 2.0] * 4,
+                "in_ads": ["ad_1", "ad_2", "ad_1"] * 4,
+            }
+        ).to_csv(input_file, index=False)
+        return str(input_file)
+
+    def test_compact_dtypes(self, input_file):
+        result_df = ngram_analysis.read_input_data(input_file)
+
+        assert result_df["description"].dtype == "O"
+        assert result_df["link_clicks"].dtype == "int16"
+        assert result_df["cost"].dtype == "float32"
+        assert result_df["in_ads"].dtype == "category"
+        assert result_df["link_clicks"].tolist() == [1, 2, 300] * 4
+
+    def test_usecols(self, input_file):
+        result_df = ngram_analysis.read_input_data(
+            input_file, usecols=["description", "in_ads"]
+        )
+
+        assert result_df.columns.tolist() == ["description", "in_ads"]
+
+    def test_same_analysis_as_with_default_dtypes(self, input_file):
+        compact_dict = ngram_analysis.analyze_dataframe(
+            ngram_analysis.read_input_data(input_file)
+        )
+        default_dict = ngram_analysis.analyze_dataframe(
+            ngram_analysis.read_input_data(input_file, compact_dtypes=False)
+        )
+
+        for ngram in ["1-gram", "2-gram", "3-gram"]:
+            pandas.util.testing.assert_frame_equal(
+                compact_dict[ngram], default_dict[ngram]
+            )
+
 
 class TestCleanInputData:
     def test_digits_after_cleaning_being_togheter(self):
@@ -25,6 +111,12 @@ class TestCleanInputData:
         with pytest.raises(TypeError):
             ngram_analysis.clean_input_data(test_df)
 
+    def test_unique_occurences_column_raises_error(self):
+        test_df = pd.DataFrame({"description": ["spam"], "Unique Occurences": [3]})
+
+        with pytest.raises(ValueError, match="Unique Occurences"):
+            ngram_analysis.clean_input_data(test_df)
+
     def test_for_no_multiple_spaces_present(self):
         test_df = pd.DataFrame(
             {"description": ["Num.ber ... is 1 800 800", "$200,000...45"]}
@@ -88,13 +180,54 @@ class TestCleanInputData:
 
         pandas.util.testing.assert_series_equal(result_series, assert_series)
 
+    def test_for_regex_metacharacters_in_keywords(self):
+        test_df = pd.DataFrame(
+            {
+                "description": [
+                    "{KeyWord:C++ Course} for $5 000",
+                    "{=Price.Start (USD)} | {KeyWord:a+b}",
+                ]
+            }
+        )
+        result_df = ngram_analysis.clean_input_data(test_df)
+        result_series = result_df["cleaned_text"]
+
+        assert_series = pd.Series(
+            ["{keywordc++course} for $5000", "{=pricestartusd} | {keyworda+b}"],
+            name="cleaned_text",
+        )
+
+        pandas.util.testing.assert_series_equal(result_series, assert_series)
+
+    def test_input_is_left_as_it_is(self):
+        def make_raw_input_df():
+            return pd.DataFrame(
+                {
+                    "description": ["Jack and  Jill", None, "Jack and  Jill"],
+                    "link_clicks": [1, 2, 3],
+                }
+            )
+
+        input_df = make_raw_input_df()
+        cleaned_df = ngram_analysis.clean_input_data(input_df)
+
+        assert input_df.equals(make_raw_input_df())
+        assert cleaned_df.columns.tolist() == [
+            "description",
+            "Unique Occurences",
+            "link_clicks",
+            "cleaned_text",
+        ]
+        assert cleaned_df["cleaned_text"].tolist() == ["jack and jill"] * 2
+        assert cleaned_df["link_clicks"].tolist() == [1, 3]
+
     def test_lemmatization_support(self):
         test_df = pd.DataFrame(
             {
                 "description": [
                     "Who's getting popcorn?",
                     "Lost your card? Freeze it in seconds to keep it safe ❄️\nDefrost it if you find it again 🔥",
-                    "stress free planning for your big day customized & all inclusive packages"
+                    "stress free planning for your big day customized & all inclusive packages",
                 ]
             }
         )
@@ -261,6 +394,21 @@ class TestCreateNgrams:
 
         pandas.util.testing.assert_frame_equal(return_df, assert_df)
 
+    def test_ngram_range_is_same_as_ngrams_per_n(self):
+        tokens = "lost your card card is lost".split()
+
+        ngram_sets = ngram_analysis.ngram_range(tokens, 2, 7)
+
+        assert ngram_sets[0] == {
+            "lost your",
+            "your card",
+            "card card",
+            "card is",
+            "is lost",
+        }
+        assert ngram_sets[4] == {"lost your card card is lost"}
+        assert ngram_sets[5] == set()
+
 
 class TestCalculateNgramsPerformance:
     def test_numerical_aggregation(self):
@@ -514,3 +662,1055 @@ class TestCalculateNgramsPerformance:
         }
 
         assert (return_dict == assert_dict1) or (return_dict == assert_dict2)
+
+    def test_engines_return_the_same_aggregation(self):
+        def make_input_with_ngrams_df():
+            return pd.DataFrame(
+                {
+                    "cleaned_text": ["jack and jill", "jill and bart", "jack and jill"],
+                    "link_clicks": [1000, 2000, 500],
+                    "ad_id": ["ad_1", "ad_2", "ad_1"],
+                    "1-gram": [
+                        {"jack", "and", "jill"},
+                        {"jill", "and", "bart"},
+                        {"jack", "and", "jill"},
+                    ],
+                    "2-gram": [
+                        {"jack and", "and jill"},
+                        {"jill and", "and bart"},
+                        {"jack and", "and jill"},
+                    ],
+                }
+            )
+
+        def sort_joined_text(ngram_performance_dict):
+            return {
+                k: v.assign(ad_id=v["ad_id"].map(lambda s: sorted(s.split(", "))))
+                .astype({"link_clicks": "int64"})
+                .to_dict()
+                for k, v in ngram_performance_dict.items()
+                if k != "Original Processed Data"
+            }
+
+        vectorized_dict = ngram_analysis.calculate_ngram_performance(
+            make_input_with_ngrams_df(), engine="vectorized"
+        )
+        apply_dict = ngram_analysis.calculate_ngram_performance(
+            make_input_with_ngrams_df(), engine="apply"
+        )
+
+        assert sort_joined_text(vectorized_dict) == sort_joined_text(apply_dict)
+        assert vectorized_dict["1-gram"].columns.tolist() == [
+            "1-gram",
+            "link_clicks",
+            "ad_id",
+        ]
+
+    def test_engines_sum_float32_in_64_bits(self):
+        test_input_df = pd.DataFrame(
+            {
+                "description": ["jack", "jack", "jack"],
+                # A float32 sum loses the ones.
+                "cost": np.array([2.0**24, 1.0, 1.0], dtype=np.float32),
+            }
+        )
+        test_input_with_ngrams_df = ngram_analysis.create_ngrams(
+            ngram_analysis.clean_input_data(test_input_df), 1, 1
+        )
+
+        for engine in ["vectorized", "apply"]:
+            ngram_performance_dict = ngram_analysis.calculate_ngram_performance(
+                test_input_with_ngrams_df, engine=engine
+            )
+            assert ngram_performance_dict["1-gram"]["cost"].tolist() == [2.0**24 + 2]
+
+    def test_sharded_engine_returns_the_same_aggregation(self):
+        test_input_df = pd.DataFrame(
+            {
+                "description": ["Jack and Jill", "Jill and Bart", "Jack and Jill?"],
+                "link_clicks": [1000, 2000, 500],
+                "ad_id": ["ad_1", "ad_2", "ad_3"],
+            }
+        )
+        test_input_with_ngrams_df = ngram_analysis.create_ngrams(
+            ngram_analysis.clean_input_data(test_input_df), 1, 2
+        )
+
+        vectorized_dict = ngram_analysis.calculate_ngram_performance(
+            test_input_with_ngrams_df, engine="vectorized"
+        )
+        sharded_dict = ngram_analysis.calculate_ngram_performance(
+            test_input_with_ngrams_df, engine="sharded", shards=2
+        )
+        for ngram in ["1-gram", "2-gram"]:
+            pandas.util.testing.assert_frame_equal(
+                sharded_dict[ngram], vectorized_dict[ngram]
+            )
+
+        vectorized_dict = ngram_analysis.analyze_dataframe(
+            test_input_df, include_processed_data=False
+        )
+        sharded_dict = ngram_analysis.analyze_dataframe(
+            test_input_df, engine="sharded", shards=2, include_processed_data=False
+        )
+        for ngram in ["1-gram", "2-gram", "3-gram"]:
+            pandas.util.testing.assert_frame_equal(
+                sharded_dict[ngram], vectorized_dict[ngram]
+            )
+
+    def test_unknown_engine_raises_error(self):
+        test_input_df = pd.DataFrame(
+            {"cleaned_text": ["spam"], "link_clicks": [1], "1-gram": [{"spam"}]}
+        )
+
+        with pytest.raises(ValueError):
+            ngram_analysis.calculate_ngram_performance(test_input_df, engine="spam")
+
+
+class TestNgramIncidence:
+    def test_flattens_sets_into_row_positions(self):
+        test_series = pd.Series([{"jack"}, set(), {"jill", "bart"}], index=[5, 7, 9])
+
+        row_positions, ngrams = ngram_analysis.ngram_incidence(test_series)
+
+        assert row_positions.tolist() == [0, 2, 2]
+        assert ngrams[0] == "jack"
+        assert set(ngrams[1:]) == {"jill", "bart"}
+
+    def test_empty_series(self):
+        row_positions, ngrams = ngram_analysis.ngram_incidence(
+            pd.Series([], dtype=object)
+        )
+
+        assert len(row_positions) == 0
+        assert ngrams == []
+
+
+class TestNgramVocabulary:
+    def test_encoded_ngrams_decode_to_strings(self):
+        vocabulary = ngram_analysis.NgramVocabulary()
+        token_ids = vocabulary.encode_tokens("card card is lost card".split())
+
+        assert token_ids == [0, 0, 1, 2, 0]
+
+        bigram_ids = vocabulary.encode_ngrams(token_ids, 2)
+
+        assert sorted(vocabulary.decode(bigram_ids)) == [
+            "card card",
+            "card is",
+            "is lost",
+            "lost card",
+        ]
+
+    def test_same_performance_as_string_ngrams(self):
+        def make_cleaned_df():
+            return pd.DataFrame(
+                {
+                    "text": ["Jack and Jill", "Jill and Bart", "bart"],
+                    "cleaned_text": ["jack and jill", "jill and bart", "bart"],
+                    "link_clicks": [1000, 2000, 500],
+                    "ad_id": ["ad_1", "ad_2", "ad_2"],
+                }
+            )
+
+        vocabulary = ngram_analysis.NgramVocabulary()
+        encoded_dict = ngram_analysis.calculate_ngram_performance(
+            ngram_analysis.create_ngrams(make_cleaned_df(), vocabulary=vocabulary),
+            vocabulary=vocabulary,
+        )
+        string_dict = ngram_analysis.calculate_ngram_performance(
+            ngram_analysis.create_ngrams(make_cleaned_df())
+        )
+
+        assert_same_analysis(encoded_dict, string_dict)
+
+
+class TestCalculateNgramPerformanceInChunks:
+    def test_same_output_as_single_pass(self):
+        input_df = make_input_df(cost=[1.5, 2.25, 0.5, 0.0, 3.0])
+        input_data_chunks = [input_df.iloc[:2], input_df.iloc[2:3], input_df.iloc[3:]]
+        chunked_dict = ngram_analysis.calculate_ngram_performance_in_chunks(
+            input_data_chunks
+        )
+
+        vocabulary = ngram_analysis.NgramVocabulary()
+        single_pass_dict = ngram_analysis.calculate_ngram_performance(
+            ngram_analysis.create_ngrams(
+                ngram_analysis.clean_input_data(input_df), vocabulary=vocabulary
+            ),
+            vocabulary=vocabulary,
+        )
+        # The processed data of the chunks isn't kept.
+        del single_pass_dict["Original Processed Data"]
+
+        assert_same_analysis(chunked_dict, single_pass_dict)
+
+
+class TestNgramPruning:
+    def calculate(self, pruning=None, vocabulary=None):
+        if vocabulary is None:
+            vocabulary = ngram_analysis.NgramVocabulary()
+        return ngram_analysis.calculate_ngram_performance(
+            ngram_analysis.create_ngrams(
+                ngram_analysis.clean_input_data(make_input_df()),
+                vocabulary=vocabulary,
+            ),
+            vocabulary=vocabulary,
+            pruning=pruning,
+        )
+
+    def test_same_as_filtering_after_aggregation(self):
+        full_dict = self.calculate()
+        pruned_dict = self.calculate(ngram_analysis.NgramPruning(min_occurrences=2))
+
+        for ngram in ["1-gram", "2-gram", "3-gram", "4-gram"]:
+            full_df = full_dict[ngram]
+            expected_df = full_df[full_df["Unique Occurences"] >= 2]
+            assert (
+                pruned_dict[ngram].to_dict()
+                == expected_df.reset_index(drop=True).to_dict()
+            )
+
+    def test_frequent_ngrams_are_kept_for_the_next_order(self):
+        vocabulary = ngram_analysis.NgramVocabulary()
+        pruning = ngram_analysis.NgramPruning(min_occurrences=2)
+        self.calculate(pruning, vocabulary)
+
+        frequent_ngrams = {
+            n: sorted(vocabulary.decode(ngram_ids))
+            for n, ngram_ids in pruning.frequent_ngrams.items()
+        }
+        assert frequent_ngrams[2] == ["and jill", "bart made", "jack and", "made money"]
+        assert frequent_ngrams[3] == ["bart made money", "jack and jill"]
+        assert frequent_ngrams[4] == []
+
+    def test_rare_prefixes_are_not_extended(self):
+        vocabulary = ngram_analysis.NgramVocabulary()
+        input_data_with_ngrams_df = ngram_analysis.create_ngrams(
+            ngram_analysis.clean_input_data(make_input_df()),
+            vocabulary=vocabulary,
+            pruning=ngram_analysis.NgramPruning(min_occurrences=2),
+        )
+
+        ngram_sets = input_data_with_ngrams_df.iloc[0]
+        assert sorted(vocabulary.decode(ngram_sets["3-gram"])) == [
+            "and jill made",
+            "jack and jill",
+        ]
+        assert sorted(vocabulary.decode(ngram_sets["4-gram"])) == ["jack and jill made"]
+        assert input_data_with_ngrams_df.iloc[4]["3-gram"] == set()
+
+    def test_pruning_while_creating_ngrams(self):
+        pruning = ngram_analysis.NgramPruning(min_occurrences=2)
+        vocabulary = ngram_analysis.NgramVocabulary()
+        pruned_dict = ngram_analysis.calculate_ngram_performance(
+            ngram_analysis.create_ngrams(
+                ngram_analysis.clean_input_data(make_input_df()),
+                vocabulary=vocabulary,
+                pruning=pruning,
+            ),
+            vocabulary=vocabulary,
+            pruning=pruning,
+        )
+        expected_dict = self.calculate(ngram_analysis.NgramPruning(min_occurrences=2))
+
+        for ngram in ["1-gram", "2-gram", "3-gram", "4-gram"]:
+            assert pruned_dict[ngram].to_dict() == expected_dict[ngram].to_dict()
+
+    def test_apply_engine_with_every_ngram_pruned(self):
+        vocabulary = ngram_analysis.NgramVocabulary()
+        pruned_dict = ngram_analysis.calculate_ngram_performance(
+            ngram_analysis.create_ngrams(
+                ngram_analysis.clean_input_data(make_input_df()),
+                vocabulary=vocabulary,
+            ),
+            vocabulary=vocabulary,
+            pruning=ngram_analysis.NgramPruning(min_occurrences=2),
+            engine="apply",
+        )
+
+        assert pruned_dict["4-gram"].empty
+
+    def test_top_k_by_metric(self):
+        pruned_dict = self.calculate(
+            ngram_analysis.NgramPruning(top_k=2, rank_by="link_clicks")
+        )
+
+        assert pruned_dict["1-gram"]["1-gram"].tolist() == ["made", "money"]
+        assert pruned_dict["1-gram"]["link_clicks"].tolist() == [3300, 3300]
+
+    def test_top_k_without_longer_ngrams(self):
+        # None of the texts has 4 words.
+        input_df = make_input_df().iloc[2:]
+        pruned_dicts = []
+        for engine in ["vectorized", "apply"]:
+            vocabulary = ngram_analysis.NgramVocabulary()
+            pruned_dicts.append(
+                ngram_analysis.calculate_ngram_performance(
+                    ngram_analysis.create_ngrams(
+                        ngram_analysis.clean_input_data(input_df),
+                        vocabulary=vocabulary,
+                    ),
+                    engine=engine,
+                    vocabulary=vocabulary,
+                    pruning=ngram_analysis.NgramPruning(top_k=1, rank_by="link_clicks"),
+                )
+            )
+        pruned_dicts.append(
+            ngram_analysis.calculate_ngram_performance_deduplicated(
+                ngram_analysis.clean_input_data(input_df),
+                vocabulary=ngram_analysis.NgramVocabulary(),
+                pruning=ngram_analysis.NgramPruning(top_k=1, rank_by="link_clicks"),
+            )
+        )
+
+        for pruned_dict in pruned_dicts:
+            assert pruned_dict["3-gram"]["3-gram"].tolist() == ["bart made money"]
+            assert pruned_dict["4-gram"].empty
+
+    def test_unknown_rank_by_raises_error(self):
+        with pytest.raises(ValueError):
+            self.calculate(ngram_analysis.NgramPruning(top_k=2, rank_by="ad_id"))
+
+
+class TestCalculateNgramPerformanceIncremental:
+    def test_same_output_as_single_pass(self, tmp_path, capsys):
+        state_file = str(tmp_path / "state.pkl")
+        ngram_analysis.calculate_ngram_performance_incremental(
+            make_input_df().iloc[:3], state_file
+        )
+        incremental_dict = ngram_analysis.calculate_ngram_performance_incremental(
+            make_input_df(), state_file
+        )
+
+        vocabulary = ngram_analysis.NgramVocabulary()
+        single_pass_dict = ngram_analysis.calculate_ngram_performance(
+            ngram_analysis.create_ngrams(
+                ngram_analysis.clean_input_data(make_input_df()),
+                vocabulary=vocabulary,
+            ),
+            vocabulary=vocabulary,
+        )
+        del single_pass_dict["Original Processed Data"]
+
+        assert "Processing 2 new out of 5 rows." in capsys.readouterr().out
+        assert_same_analysis(incremental_dict, single_pass_dict)
+
+    def test_starts_over_when_rows_are_missing(self, tmp_path, capsys):
+        state_file = str(tmp_path / "state.pkl")
+        ngram_analysis.calculate_ngram_performance_incremental(
+            make_input_df(), state_file
+        )
+        incremental_dict = ngram_analysis.calculate_ngram_performance_incremental(
+            make_input_df().iloc[:4], state_file
+        )
+
+        assert "starting over" in capsys.readouterr().out
+        assert (
+            incremental_dict["1-gram"].set_index("1-gram").loc["jack", "link_clicks"]
+            == 1040
+        )
+
+
+class TestNgramStore:
+    def analyze(self, input_df, ngram_range, store=None):
+        return ngram_analysis.analyze_dataframe(
+            input_df,
+            ngram_range=ngram_range,
+            include_processed_data=False,
+            store=store,
+        )
+
+    def test_store_is_reused_and_extended(self, input_df, tmp_path, capsys):
+        # A row without text, which isn't in the store.
+        input_df.loc[2, "description"] = None
+        store = str(tmp_path / "store")
+        self.analyze(input_df, (1, 2), store)
+        store_dict = self.analyze(input_df, (2, 3), store)
+
+        out = capsys.readouterr().out
+        assert "Reusing the n-gram store" in out
+        assert "Adding the [3] n-grams to the store." in out
+        assert ngram_analysis.NgramStore(store).ngram_orders == {1, 2, 3}
+        assert_same_analysis(store_dict, self.analyze(input_df, (2, 3)))
+
+    def test_store_is_rebuilt_for_other_texts(self, input_df, tmp_path, capsys):
+        store = str(tmp_path / "store")
+        self.analyze(input_df, (1, 1), store)
+        input_df.loc[0, "description"] = "Jack made money"
+        store_dict = self.analyze(input_df, (1, 1), store)
+
+        assert capsys.readouterr().out.count("Building the n-gram store") == 2
+        assert (
+            store_dict["1-gram"].set_index("1-gram").loc["jill", "link_clicks"] == 2040
+        )
+
+
+class TestSegmentPerformance:
+    CAMPAIGNS = ["brand", "generic", "brand", "generic", None]
+
+    def test_same_output_as_analysis_per_segment(self):
+        input_df = make_input_df(campaign=self.CAMPAIGNS)
+        segment_dict = ngram_analysis.analyze_dataframe(
+            input_df, ngram_range=(1, 2), group_by="campaign"
+        )
+
+        assert list(segment_dict) == ["brand", "generic"]
+        for segment, ngram_performance_dict in segment_dict.items():
+            expected_dict = ngram_analysis.analyze_dataframe(
+                input_df[input_df["campaign"] == segment].drop(columns="campaign"),
+                ngram_range=(1, 2),
+                include_processed_data=False,
+            )
+            assert_same_analysis(ngram_performance_dict, expected_dict)
+
+    def test_pruning_is_per_segment(self):
+        input_df = make_input_df(campaign=self.CAMPAIGNS)
+        segment_dict = ngram_analysis.analyze_dataframe(
+            input_df,
+            ngram_range=(1, 1),
+            group_by="campaign",
+            min_occurrences=2,
+        )
+
+        assert segment_dict["brand"]["1-gram"]["1-gram"].tolist() == ["made", "money"]
+        assert segment_dict["generic"]["1-gram"]["1-gram"].tolist() == [
+            "and",
+            "jill",
+        ]
+
+    def test_derived_metrics_stages_are_collected(self):
+        stats = ngram_analysis.AnalysisStats()
+        ngram_analysis.analyze_dataframe(
+            make_input_df(campaign=self.CAMPAIGNS, impressions=10000),
+            ngram_range=(1, 1),
+            group_by="campaign",
+            derived_metrics=[
+                ngram_analysis.parse_derived_metric("CTR=link_clicks/impressions")
+            ],
+            stats=stats,
+        )
+
+        stages = [stage["stage"] for stage in stats.stages]
+        assert stages.count("derived metrics") == 2
+
+    def test_segments_are_saved(self, tmp_path):
+        input_file = tmp_path / "ads.csv"
+        make_input_df(campaign=self.CAMPAIGNS).to_csv(input_file, index=False)
+        ngram_analysis.execute_ngram_analysis(
+            str(input_file),
+            output_folder=str(tmp_path / "output"),
+            ngram_range=(1, 1),
+            group_by="campaign",
+        )
+
+        assert sorted(os.listdir(tmp_path / "output" / "Analysis of ads")) == [
+            "campaign brand",
+            "campaign generic",
+        ]
+
+    def test_unknown_column_raises_error(self):
+        with pytest.raises(ValueError):
+            ngram_analysis.analyze_dataframe(
+                make_input_df(campaign=self.CAMPAIGNS), group_by="spam"
+            )
+
+
+class TestApproximateAnalysis:
+    def test_same_top_k_as_exact_analysis(self, input_df):
+        approximate_dict = ngram_analysis.analyze_dataframe(
+            input_df,
+            ngram_range=(1, 2),
+            top_k=2,
+            rank_by="link_clicks",
+            approximate=True,
+            sketch_width=64,
+        )
+        exact_dict = ngram_analysis.analyze_dataframe(
+            input_df,
+            ngram_range=(1, 2),
+            top_k=2,
+            rank_by="link_clicks",
+            include_processed_data=False,
+        )
+
+        assert_same_analysis(approximate_dict, exact_dict)
+        assert approximate_dict["1-gram"].attrs["error_bound"] > 0
+
+    def test_ngrams_are_counted_once_per_row(self, input_df):
+        # An ad repeating an n-gram, which still counts once.
+        input_df.loc[5] = ["money money money", 7, "ad_5"]
+        ngram_performance_dict = ngram_analysis.calculate_ngram_performance_approximate(
+            lambda: [input_df], top_k=1, start=1, end=1
+        )
+
+        assert ngram_performance_dict["1-gram"].to_dict() == {
+            "1-gram": {0: "money"},
+            "Unique Occurences": {0: 4},
+            "link_clicks": {0: 3307},
+            "ad_id": {0: "ad_1, ad_2, ad_3, ad_5"},
+        }
+
+    def test_invalid_settings_raise_error(self, input_df):
+        input_df.loc[0, "link_clicks"] = -1
+        with pytest.raises(ValueError):
+            ngram_analysis.analyze_dataframe(input_df, approximate=True)
+        with pytest.raises(ValueError):
+            ngram_analysis.analyze_dataframe(
+                input_df, top_k=2, rank_by="link_clicks", approximate=True
+            )
+
+
+class TestExecuteFolderAnalysis:
+    def test_bad_file_does_not_stop_the_batch(self, tmp_path):
+        input_folder = tmp_path / "input"
+        input_folder.mkdir()
+        pd.DataFrame({"description": ["jack and jill"], "link_clicks": [1]}).to_csv(
+            input_folder / "good.csv", index=False
+        )
+        pd.DataFrame({"non_text_column": [1], "description": ["spam"]}).to_csv(
+            input_folder / "bad.csv", index=False
+        )
+
+        results = ngram_analysis.execute_folder_analysis(
+            str(input_folder), workers=2, output_folder=str(tmp_path / "output")
+        )
+        errors = {
+            os.path.basename(result.file_location): result.error for result in results
+        }
+
+        assert errors["good.csv"] is None
+        assert errors["bad.csv"].startswith("TypeError")
+        assert os.listdir(tmp_path / "output") == ["Analysis of good"]
+
+
+class TestAnalyzeDataframe:
+    def test_no_side_effects(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        input_df = make_input_df()
+
+        ngram_performance_dict = ngram_analysis.analyze_dataframe(
+            input_df, ngram_range=(1, 2), include_processed_data=False
+        )
+
+        assert input_df.equals(make_input_df())
+        assert os.listdir(tmp_path) == []
+        assert list(ngram_performance_dict) == ["1-gram", "2-gram"]
+        assert (
+            ngram_performance_dict["2-gram"]
+            .set_index("2-gram")
+            .loc["made money", "link_clicks"]
+            == 3300
+        )
+
+    def test_same_output_without_processed_data(self):
+        input_df = pd.concat(
+            [make_input_df(link_clicks=[clicks] * 5) for clicks in range(3)]
+        )
+
+        with_processed_data_dict = ngram_analysis.analyze_dataframe(input_df)
+        del with_processed_data_dict["Original Processed Data"]
+        without_processed_data_dict = ngram_analysis.analyze_dataframe(
+            input_df, include_processed_data=False
+        )
+
+        assert_same_analysis(without_processed_data_dict, with_processed_data_dict)
+
+    def test_analysis_saved_without_processed_data(self, tmp_path):
+        input_file = tmp_path / "ads.csv"
+        make_input_df().to_csv(input_file, index=False)
+
+        ngram_analysis.execute_ngram_analysis(
+            str(input_file),
+            output_folder=str(tmp_path / "output"),
+            include_processed_data=False,
+        )
+
+        assert sorted(os.listdir(tmp_path / "output" / "Analysis of ads")) == [
+            "1-gram.csv",
+            "2-gram.csv",
+            "3-gram.csv",
+            "4-gram.csv",
+        ]
+
+    def test_concurrent_calls_from_threads(self):
+        def analyze(clicks):
+            return ngram_analysis.analyze_dataframe(
+                make_input_df(link_clicks=[clicks] * 5)
+            )
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            threaded_dicts = list(executor.map(analyze, range(8)))
+
+        for clicks, threaded_dict in enumerate(threaded_dicts):
+            assert_same_analysis(threaded_dict, analyze(clicks))
+
+
+class TestColumnAggregations:
+    @pytest.fixture
+    def test_df(self):
+        return pd.DataFrame(
+            {
+                "description": ["jack and jill", "jack went up", "jack and bart"],
+                "link_clicks": [10, 30, 5],
+                "cost": [1.0, 2.0, None],
+                "ad_id": ["ad_1", "ad_2", "ad_1"],
+                "ad_name": ["spam", "ham", "eggs"],
+            }
+        )
+
+    @pytest.fixture
+    def aggregations(self):
+        return dict(
+            ngram_analysis.parse_column_aggregation(spec)
+            for spec in [
+                "link_clicks=max",
+                "cost=mean",
+                "ad_id=nunique",
+                "ad_name=first:2",
+            ]
+        )
+
+    def test_parse_column_aggregation(self):
+        assert ngram_analysis.parse_column_aggregation("ad name = first:3") == (
+            "ad name",
+            ngram_analysis.ColumnAggregation("first", 3),
+        )
+
+        for spec in ["ad_id", "ad_id=median", "ad_id=first", "ad_id=count:2"]:
+            with pytest.raises(ValueError):
+                ngram_analysis.parse_column_aggregation(spec)
+
+    def test_aggregations(self, test_df, aggregations):
+        result_df = ngram_analysis.analyze_dataframe(
+            test_df, ngram_range=(1, 1), aggregations=aggregations
+        )["1-gram"].set_index("1-gram")
+
+        assert result_df.loc["jack"].to_dict() == {
+            "Unique Occurences": 3,
+            "link_clicks": 30,
+            "cost": 1.5,
+            "ad_id": 2,
+            "ad_name": "spam, ham",
+        }
+        assert pd.isnull(result_df.loc["bart", "cost"])
+
+    def test_same_output_with_partials(self, test_df, aggregations):
+        result_dict = ngram_analysis.analyze_dataframe(
+            test_df, ngram_range=(1, 2), aggregations=aggregations
+        )
+        chunks_dict = ngram_analysis.calculate_ngram_performance_in_chunks(
+            [test_df[:2], test_df[2:]], start=1, end=2, aggregations=aggregations
+        )
+        deduplicated_dict = ngram_analysis.analyze_dataframe(
+            test_df, ngram_range=(1, 2), deduplicate=True, aggregations=aggregations
+        )
+
+        for ngram in ["1-gram", "2-gram"]:
+            pandas.util.testing.assert_frame_equal(
+                chunks_dict[ngram], result_dict[ngram]
+            )
+            pandas.util.testing.assert_frame_equal(
+                deduplicated_dict[ngram].drop(columns="ad_name"),
+                result_dict[ngram].drop(columns="ad_name"),
+            )
+
+    def test_invalid_aggregations_raise_error(self, test_df):
+        for column, aggregation in [
+            ("ad_id", ngram_analysis.ColumnAggregation("sum")),
+            ("link_clicks", ngram_analysis.ColumnAggregation("join")),
+            ("spam", ngram_analysis.ColumnAggregation("max")),
+        ]:
+            with pytest.raises(ValueError):
+                ngram_analysis.analyze_dataframe(
+                    test_df, aggregations={column: aggregation}
+                )
+
+
+class TestDerivedMetrics:
+    def test_parse_derived_metric(self):
+        assert ngram_analysis.parse_derived_metric(
+            "CTR = Link Clicks/Impressions"
+        ) == ngram_analysis.DerivedMetric("CTR", "Link Clicks", "Impressions")
+
+        for spec in ["CTR", "CTR=Clicks", "=Clicks/Impressions", "CTR=a/b/c"]:
+            with pytest.raises(ValueError):
+                ngram_analysis.parse_derived_metric(spec)
+
+    def test_ratio_of_the_sums_with_safe_division(self):
+        test_df = pd.DataFrame(
+            {
+                "description": ["jack and jill", "jack went up", "bart"],
+                "clicks": [10, 30, 5],
+                "impressions": [100, 100, 0],
+            }
+        )
+
+        result_dict = ngram_analysis.analyze_dataframe(
+            test_df,
+            ngram_range=(1, 1),
+            derived_metrics=[
+                ngram_analysis.parse_derived_metric("CTR=clicks/impressions")
+            ],
+        )
+        ctr = result_dict["1-gram"].set_index("1-gram")["CTR"]
+
+        assert ctr["jack"] == 0.2
+        assert ctr["jill"] == 0.1
+        assert pd.isnull(ctr["bart"])
+        assert "CTR" not in result_dict["Original Processed Data"].columns
+
+    def test_missing_column_raises_error(self):
+        test_df = pd.DataFrame({"description": ["jack"], "clicks": [1]})
+
+        with pytest.raises(ValueError):
+            ngram_analysis.analyze_dataframe(
+                test_df,
+                derived_metrics=[
+                    ngram_analysis.parse_derived_metric("CTR=clicks/impressions")
+                ],
+            )
+
+    def test_warns_about_ratio_like_columns(self):
+        test_df = pd.DataFrame(
+            {
+                "description": ["jack"],
+                "clicks": [1],
+                "in_ads": ["ad_1"],
+                "Cost per Conversion": [2.5],
+            }
+        )
+
+        with pytest.warns(UserWarning, match="Cost per Conversion"):
+            ngram_analysis.clean_input_data(test_df)
+
+
+class TestAnalysisStats:
+    def test_stages_are_collected_and_logged(self, tmp_path):
+        input_file = tmp_path / "ads.csv"
+        pd.DataFrame(
+            {"description": ["jack and jill", "jack"], "link_clicks": [1, 2]}
+        ).to_csv(input_file, index=False)
+        stats_log = tmp_path / "stats.jsonl"
+
+        stats = ngram_analysis.AnalysisStats()
+        ngram_analysis.execute_ngram_analysis(
+            str(input_file),
+            output_folder=str(tmp_path / "output"),
+            stats=stats,
+            stats_log=str(stats_log),
+        )
+
+        assert [stage["stage"] for stage in stats.stages] == [
+            "read",
+            "clean",
+            "create_ngrams",
+            "aggregate 1-gram",
+            "aggregate 2-gram",
+            "aggregate 3-gram",
+            "aggregate 4-gram",
+            "write",
+        ]
+        assert stats.stages[3]["unique_ngrams"] == 3
+        assert all(stage["seconds"] >= 0 for stage in stats.stages)
+        assert json.loads(stats_log.read_text()) == dict(
+            input_file=str(input_file), **stats.to_dict()
+        )
+
+    def test_peak_rss_is_measured_per_stage(self):
+        if not ngram_analysis.reset_peak_rss():
+            pytest.skip("The peak RSS can't be reset on this platform.")
+
+        stats = ngram_analysis.AnalysisStats()
+        with ngram_analysis.measure_stage(stats, "allocate"):
+            array = np.ones(2**25)
+            del array
+        with ngram_analysis.measure_stage(stats, "idle"):
+            pass
+
+        allocate_stage, idle_stage = stats.stages
+        assert allocate_stage["peak_rss_bytes"] - idle_stage["peak_rss_bytes"] > 2**27
+        assert stats.to_dict()["peak_rss_bytes"] == allocate_stage["peak_rss_bytes"]
+
+
+class TestLemmatizer:
+    class FakeNlp:
+        """Stands in for the spaCy model, "lemmatizing" by stripping
+        a trailing "s".
+        """
+
+        meta = {"lang": "xx", "name": "fake", "version": "1.0.0"}
+
+        def __init__(self):
+            self.batch_sizes = []
+            self.piped_texts = []
+
+        def pipe(self, texts, batch_size):
+            self.batch_sizes.append(batch_size)
+            for text in texts:
+                self.piped_texts.append(text)
+                yield [
+                    type("Token", (), {"lemma_": word.rstrip("s")})
+                    for word in text.split()
+                ]
+
+    def test_reused_lemmatizer_in_clean_input_data(self, monkeypatch):
+        fake_nlp = self.FakeNlp()
+        monkeypatch.setattr(
+            ngram_analysis, "load_lemmatizer_model", lambda model_name: fake_nlp
+        )
+        test_df = pd.DataFrame({"description": ["Rocks, rocks!", "cards"]})
+
+        with ngram_analysis.Lemmatizer(processes=1, batch_size=50) as lemmatizer:
+            result_df = ngram_analysis.clean_input_data(
+                test_df, lemmatize=True, lemmatizer=lemmatizer
+            )
+
+        assert result_df["cleaned_text"].tolist() == ["rock rock", "card"]
+        assert fake_nlp.batch_sizes == [50]
+
+    def test_cache_is_persisted_and_invalidated(self, monkeypatch, tmp_path):
+        fake_nlp = self.FakeNlp()
+        monkeypatch.setattr(
+            ngram_analysis, "load_lemmatizer_model", lambda model_name: fake_nlp
+        )
+        cache_path = str(tmp_path / "lemma_cache.json")
+        test_series = pd.Series(["rocks", "cards", "rocks"])
+
+        with ngram_analysis.Lemmatizer(
+            processes=1, cache_path=cache_path
+        ) as lemmatizer:
+            assert lemmatizer.lemmatize(test_series).tolist() == [
+                "rock",
+                "card",
+                "rock",
+            ]
+        assert fake_nlp.piped_texts == ["rocks", "cards"]
+
+        with ngram_analysis.Lemmatizer(
+            processes=1, cache_path=cache_path
+        ) as lemmatizer:
+            assert lemmatizer.lemmatize(test_series).tolist() == [
+                "rock",
+                "card",
+                "rock",
+            ]
+        assert fake_nlp.piped_texts == ["rocks", "cards"]
+
+        fake_nlp.meta = dict(fake_nlp.meta, version="2.0.0")
+        with ngram_analysis.Lemmatizer(
+            processes=1, cache_path=cache_path
+        ) as lemmatizer:
+            lemmatizer.lemmatize(test_series)
+        assert fake_nlp.piped_texts == ["rocks", "cards", "rocks", "cards"]
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = ngram_analysis.LemmaCache(max_size=2)
+        cache.put("rocks", "rock")
+        cache.put("cards", "card")
+        cache.get("rocks")
+        cache.put("boxes", "box")
+
+        assert cache.get("cards") is None
+        assert cache.get("rocks") == "rock"
+        assert len(cache) == 2
+
+
+class TestCalculateNgramPerformanceDeduplicated:
+    def test_same_performance_as_without_deduplication(self):
+        def make_search_terms_df():
+            return pd.DataFrame(
+                {
+                    "search_term": [
+                        "Jack and Jill",
+                        "jill and bart",
+                        "jack and jill!",
+                        "Jack and Jill",
+                    ],
+                    "link_clicks": [1000, 2000, 300, 40],
+                    "campaign": ["c_1", "c_2", "c_2", "c_3"],
+                }
+            )
+
+        deduplicated_dict = ngram_analysis.calculate_ngram_performance_deduplicated(
+            ngram_analysis.clean_input_data(make_search_terms_df())
+        )
+        assert_dict = ngram_analysis.calculate_ngram_performance(
+            ngram_analysis.create_ngrams(
+                ngram_analysis.clean_input_data(make_search_terms_df())
+            )
+        )
+
+        for ngram in ["1-gram", "2-gram", "3-gram", "4-gram"]:
+            result_df = deduplicated_dict[ngram]
+            assert_df = assert_dict[ngram]
+            assert result_df.drop(columns="campaign").equals(
+                assert_df.drop(columns="campaign")
+            )
+            assert (
+                result_df["campaign"]
+                .map(lambda s: sorted(s.split(", ")))
+                .equals(assert_df["campaign"].map(lambda s: sorted(s.split(", "))))
+            )
+
+        assert deduplicated_dict["1-gram"]["Unique Occurences"].tolist() == [4, 1, 3, 4]
+        assert len(deduplicated_dict["Original Processed Data"]) == 4
+
+
+class TestSaveNgramPerformance:
+    @pytest.mark.parametrize("output_format", ["csv", "parquet", "feather"])
+    def test_file_per_ngram(self, tmp_path, output_format):
+        if output_format != "csv":
+            pytest.importorskip("pyarrow")
+        ngram_performance_dict = {
+            "1-gram": pd.DataFrame(
+                {"1-gram": ["jack", "jill"], "link_clicks": [1000, 2000]}
+            ),
+            "Original Processed Data": pd.DataFrame(
+                {"cleaned_text": ["jack jill"], "1-gram": [{"jill", "jack"}]}
+            ),
+        }
+
+        output_path = ngram_analysis.save_ngram_performance(
+            ngram_performance_dict, str(tmp_path), "Analysis of test", output_format
+        )
+
+        assert sorted(os.listdir(output_path)) == [
+            f"1-gram.{output_format}",
+            f"Original Processed Data.{output_format}",
+        ]
+        read = getattr(pd, f"read_{output_format}")
+        result_df = read(os.path.join(output_path, f"1-gram.{output_format}"))
+        pandas.util.testing.assert_frame_equal(
+            result_df, ngram_performance_dict["1-gram"]
+        )
+        processed_df = read(
+            os.path.join(output_path, f"Original Processed Data.{output_format}")
+        )
+        if output_format == "csv":
+            assert processed_df["1-gram"][0] == "jack, jill"
+        else:
+            assert list(processed_df["1-gram"][0]) == ["jack", "jill"]
+
+    def test_unknown_format_raises_error(self, tmp_path):
+        with pytest.raises(ValueError):
+            ngram_analysis.save_ngram_performance({}, str(tmp_path), "test", "spam")
+
+    def test_xlsx_sheets_are_split_at_the_row_limit(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(ngram_analysis, "EXCEL_MAX_ROWS", 3)
+        ngram_performance_dict = {
+            "1-gram": pd.DataFrame(
+                {
+                    "1-gram": ["and", "bart", "jack", "jill", "money"],
+                    "link_clicks": [3000, 2000, 1000, 3000, 3000],
+                }
+            ),
+            "4-gram": pd.DataFrame({"4-gram": [], "link_clicks": []}),
+        }
+
+        output_path = ngram_analysis.save_ngram_performance(
+            ngram_performance_dict, str(tmp_path), "test", "xlsx"
+        )
+        sheets = pd.read_excel(output_path, sheet_name=None)
+
+        assert list(sheets) == ["1-gram", "1-gram (2)", "1-gram (3)", "4-gram"]
+        assert pd.concat(list(sheets.values())[:3], ignore_index=True).equals(
+            ngram_performance_dict["1-gram"]
+        )
+        assert sheets["4-gram"].columns.tolist() == ["4-gram", "link_clicks"]
+
+    def test_xlsx_missing_values_are_left_empty(self, tmp_path):
+        ngram_performance_dict = {
+            "1-gram": pd.DataFrame(
+                {
+                    "1-gram": [{"jill", "jack"}, "jack"],
+                    "CTR": [0.5, np.nan],
+                    "Conversions": pd.array([1, pd.NA], dtype="Int64"),
+                }
+            )
+        }
+
+        output_path = ngram_analysis.save_ngram_performance(
+            ngram_performance_dict, str(tmp_path), "test", "xlsx"
+        )
+        rows = list(openpyxl.load_workbook(output_path)["1-gram"].values)
+
+        assert rows == [
+            ("1-gram", "CTR", "Conversions"),
+            ("jack, jill", 0.5, 1),
+            ("jack", None, None),
+        ]
+
+    def test_top_k_ngrams_by_metric(self, tmp_path):
+        ngram_performance_dict = {
+            "1-gram": pd.DataFrame(
+                {"1-gram": ["and", "bart", "jack"], "link_clicks": [3000, 2000, 4000]}
+            ),
+            "Original Processed Data": pd.DataFrame({"cleaned_text": ["a", "b", "c"]}),
+        }
+
+        output_path = ngram_analysis.save_ngram_performance(
+            ngram_performance_dict,
+            str(tmp_path),
+            "test",
+            "xlsx",
+            top_k=2,
+            rank_by="link_clicks",
+        )
+        sheets = pd.read_excel(output_path, sheet_name=None)
+
+        assert sheets["1-gram"]["1-gram"].tolist() == ["jack", "and"]
+        assert len(sheets["Original Processed Data"]) == 3
+
+        with pytest.raises(ValueError):
+            ngram_analysis.save_ngram_performance(
+                ngram_performance_dict, str(tmp_path), "test", top_k=2, rank_by="spam"
+            )
+
+
+class TestCommandLine:
+    @pytest.fixture
+    def input_file(self, tmp_path):
+        input_file = tmp_path / "ads.csv"
+        pd.DataFrame(
+            {
+                "description": ["jack and jill", "jill went up"],
+                "Clicks": [10, 20],
+                "Impressions": [100, 400],
+                "ad_id": ["ad_1", "ad_2"],
+            }
+        ).to_csv(input_file, index=False)
+        return str(input_file)
+
+    def run(self, *args):
+        return subprocess.run(
+            [sys.executable, ngram_analysis.__file__, *args],
+            capture_output=True,
+            text=True,
+        )
+
+    @pytest.mark.parametrize(
+        "rank_args",
+        [
+            ["--export-rank-by", "Clikcs"],
+            ["--export-rank-by", "ad_id"],
+            ["--top-k-by", "CTR", "--derived", "CTR=Clicks/Impressions"],
+        ],
+    )
+    def test_invalid_rank_column_is_reported(self, input_file, rank_args):
+        result = self.run("--input-file", input_file, "--export-top-k", "1", *rank_args)
+
+        assert result.returncode == 2
+        assert "Traceback" not in result.stderr
+        assert repr(rank_args[1]) in result.stderr
+
+    def test_rankable_columns(self, input_file):
+        assert ngram_analysis.rankable_columns(input_file) == [
+            "Unique Occurences",
+            "Clicks",
+            "Impressions",
+        ]
+        assert ngram_analysis.rankable_columns(
+            input_file,
+            aggregations={"ad_id": ngram_analysis.ColumnAggregation("nunique")},
+        ) == ["Unique Occurences", "Clicks", "Impressions", "ad_id"]